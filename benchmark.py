@@ -0,0 +1,188 @@
+import argparse
+import json
+import platform
+import statistics
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import matplotlib.pyplot as plt
+import numpy as np
+
+import diagnosticos
+import geometria
+import graficos
+import lectura
+import sintetico
+
+
+def calcular_vorticidad_bucles(u_values, w_values, dx, altura_values):
+    # copia del núcleo con bucles de algoritmo_p2.py (sin impresiones) para comparar contra la versión vectorizada
+    u_interp_z = np.zeros_like(w_values)
+    for i in range(min(u_values.shape[1], u_interp_z.shape[1])):
+        u_interp_z[:, i, :, :] = u_values[:, min(i, u_values.shape[1]-1), :, :-1]
+
+    dw_dx = np.zeros_like(w_values)
+    for i in range(1, w_values.shape[3]-1):
+        dw_dx[:, :, :, i] = (w_values[:, :, :, i+1] - w_values[:, :, :, i-1]) / (2 * dx)
+    dw_dx[:, :, :, 0] = (w_values[:, :, :, 1] - w_values[:, :, :, 0]) / dx
+    dw_dx[:, :, :, -1] = (w_values[:, :, :, -1] - w_values[:, :, :, -2]) / dx
+
+    du_dz = np.zeros_like(w_values)
+    for i in range(1, min(altura_values.shape[1], u_interp_z.shape[1])-1):
+        delta_z = (altura_values[:, i+1, :, :] - altura_values[:, i-1, :, :]) / 2
+        mask = np.abs(delta_z) < 1e-10
+        safe_delta_z = np.where(mask, 1.0, delta_z)
+        du_dz_temp = (u_interp_z[:, i+1, :, :] - u_interp_z[:, i-1, :, :]) / (2 * safe_delta_z)
+        du_dz[:, i, :, :] = np.where(mask, 0.0, du_dz_temp)
+
+    if altura_values.shape[1] > 1 and u_interp_z.shape[1] > 1:
+        delta_z = altura_values[:, 1, :, :] - altura_values[:, 0, :, :]
+        mask = np.abs(delta_z) < 1e-10
+        safe_delta_z = np.where(mask, 1.0, delta_z)
+        du_dz_temp = (u_interp_z[:, 1, :, :] - u_interp_z[:, 0, :, :]) / safe_delta_z
+        du_dz[:, 0, :, :] = np.where(mask, 0.0, du_dz_temp)
+
+        last_idx = min(altura_values.shape[1], u_interp_z.shape[1]) - 1
+        delta_z = altura_values[:, last_idx, :, :] - altura_values[:, last_idx-1, :, :]
+        mask = np.abs(delta_z) < 1e-10
+        safe_delta_z = np.where(mask, 1.0, delta_z)
+        du_dz_temp = (u_interp_z[:, last_idx, :, :] - u_interp_z[:, last_idx-1, :, :]) / safe_delta_z
+        du_dz[:, last_idx, :, :] = np.where(mask, 0.0, du_dz_temp)
+
+    vorticidad = dw_dx - du_dz
+    vorticidad = np.where(np.isinf(vorticidad), np.nan, vorticidad)
+    return diagnosticos.recortar_percentiles(vorticidad)
+
+
+MOTORES_VORTICIDAD = {
+    'bucles': calcular_vorticidad_bucles,
+    'vectorizado': diagnosticos.calcular_vorticidad,
+}
+
+
+def medir(funcion, repeticiones):
+    # tiempo de pared, tiempo de CPU y memoria pico trazada de varias repeticiones de una etapa
+    tiempos_pared = []
+    tiempos_cpu = []
+    picos = []
+    resultado = None
+    for _ in range(repeticiones):
+        resultado = None
+        tracemalloc.start()
+        inicio_pared = time.perf_counter()
+        inicio_cpu = time.process_time()
+        resultado = funcion()
+        tiempos_cpu.append(time.process_time() - inicio_cpu)
+        tiempos_pared.append(time.perf_counter() - inicio_pared)
+        picos.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    medicion = {
+        'pared_min_s': min(tiempos_pared),
+        'pared_mediana_s': statistics.median(tiempos_pared),
+        'cpu_mediana_s': statistics.median(tiempos_cpu),
+        'memoria_pico_bytes': max(picos),
+    }
+    return resultado, medicion
+
+
+def _cargar(ruta):
+    # con el mismo lector que los diagnósticos: ndarray en la precisión de cálculo, sin MaskedArray
+    datos = lectura.obtener_datos(ruta)
+    try:
+        campos = lectura.leer_bloque(datos, ('U', 'W', 'T', 'P', 'PB', 'PH', 'PHB'),
+                                     slice(0, len(datos.dimensions['Time'])))
+        return campos, float(datos.DX)
+    finally:
+        datos.close()
+
+
+def _render(vorticidad, altura, dx, directorio):
+    ruta = Path(directorio) / 'vorticidad_bench.png'
+    malla = geometria.GeometriaMalla(dx, altura=altura[:1])
+    graficos.graficar_vorticidad_2d(vorticidad[0].mean(axis=1), malla.niveles_altura[0], malla, 0, ruta_salida=ruta)
+
+
+def ejecutar_caso(ruta, motores, repeticiones, directorio):
+    etapas = {}
+    (campos, dx), etapas['carga'] = medir(lambda: _cargar(ruta), repeticiones)
+    altura, etapas['altura'] = medir(lambda: diagnosticos.calcular_altura(campos['PH'], campos['PHB']), repeticiones)
+
+    resultados = {}
+    for motor in motores:
+        funcion = MOTORES_VORTICIDAD[motor]
+        resultados[motor], etapas[f'calcular_vorticidad_{motor}'] = medir(
+            lambda: funcion(campos['U'], campos['W'], dx, altura), repeticiones)
+    vorticidad = np.nan_to_num(resultados[motores[0]], nan=0.0)
+
+    def percentiles():
+        limites = np.percentile(vorticidad, [1, 5, 10, 25, 50, 75, 90, 95, 99])
+        return vorticidad > limites[5]
+    _, etapas['percentiles'] = medir(percentiles, repeticiones)
+
+    _, etapas['temperatura'] = medir(
+        lambda: diagnosticos.procesar_campo_temperatura(campos['T'], campos['P'], campos['PB'], altura), repeticiones)
+    _, etapas['render'] = medir(lambda: _render(vorticidad, altura, dx, directorio), repeticiones)
+
+    # diferencia entre motores para comprobar que comparan el mismo cálculo
+    diferencias = {motor: float(np.nanmax(np.abs(resultados[motor] - resultados[motores[0]])))
+                   for motor in motores[1:]}
+    return etapas, diferencias
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Pruebas de rendimiento con archivos sintéticos tipo WRF')
+    parser.add_argument('--tamanos', nargs='+', default=['43x100x1x2000'],
+                        help='tamaños tiempos x niveles x south_north x west_east')
+    parser.add_argument('--motores', default='bucles,vectorizado',
+                        help=f"motores de vorticidad a comparar ({', '.join(MOTORES_VORTICIDAD)})")
+    parser.add_argument('--repeticiones', type=int, default=3)
+    parser.add_argument('--semilla', type=int, default=0)
+    parser.add_argument('--directorio', help='directorio para los archivos sintéticos (por defecto uno temporal)')
+    parser.add_argument('--salida', default='benchmark.json', help='archivo JSON de resultados')
+    args = parser.parse_args(argv)
+
+    plt.switch_backend('Agg')
+    motores = [m.strip() for m in args.motores.split(',') if m.strip()]
+    for motor in motores:
+        if motor not in MOTORES_VORTICIDAD:
+            raise ValueError(f"motor desconocido: {motor}")
+
+    with tempfile.TemporaryDirectory() as temporal:
+        directorio = Path(args.directorio or temporal)
+        directorio.mkdir(parents=True, exist_ok=True)
+        casos = []
+        for tamano in args.tamanos:
+            n_tiempos, n_niveles, n_sn, n_we = sintetico.interpretar_tamano(tamano)
+            ruta = directorio / f'sintetico_{tamano}.nc'
+            if not ruta.exists():
+                print(f"Generando {ruta}")
+                sintetico.generar_archivo(ruta, n_tiempos, n_niveles, n_sn, n_we, semilla=args.semilla)
+
+            print(f"Midiendo {tamano}")
+            etapas, diferencias = ejecutar_caso(ruta, motores, args.repeticiones, directorio)
+            for nombre, medicion in etapas.items():
+                print(f"  {nombre}: {medicion['pared_mediana_s']:.4f} s, "
+                      f"pico {medicion['memoria_pico_bytes'] / 2**20:.1f} MiB")
+            casos.append({'tamano': tamano, 'bytes_archivo': ruta.stat().st_size,
+                          'etapas': etapas, 'diferencia_maxima_entre_motores': diferencias})
+
+    reporte = {
+        'entorno': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'plataforma': platform.platform(),
+            'procesador': platform.processor(),
+        },
+        'repeticiones': args.repeticiones,
+        'semilla': args.semilla,
+        'casos': casos,
+    }
+    with open(args.salida, 'w') as f:
+        json.dump(reporte, f, indent=2)
+    print(f"Resultados guardados en {args.salida}")
+
+
+if __name__ == "__main__":
+    main()
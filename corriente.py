@@ -0,0 +1,89 @@
+import numpy as np
+
+import instrumentacion
+
+
+def a_malla_masa(u, w):
+    # U (tiempo, nivel, sn, west_east_stag) y W (tiempo, nivel_stag, sn, west_east) promediados a los puntos de masa
+    # en la precisión de las entradas, al menos float32
+    tipo = np.result_type(u, w, np.float32)
+    u = np.asarray(u, dtype=tipo)
+    w = np.asarray(w, dtype=tipo)
+    return 0.5 * (u[..., :-1] + u[..., 1:]), 0.5 * (w[:, :-1] + w[:, 1:])
+
+
+def resolver_tridiagonal(inferior, diagonal, superior, derecha):
+    # algoritmo de Thomas a lo largo del último eje, vectorizado sobre todos los demás ejes;
+    # inferior[..., 0] y superior[..., -1] no se usan
+    n = derecha.shape[-1]
+    c = np.empty_like(derecha)
+    d = np.empty_like(derecha)
+    c[..., 0] = superior[..., 0] / diagonal[..., 0]
+    d[..., 0] = derecha[..., 0] / diagonal[..., 0]
+    for j in range(1, n):
+        denominador = diagonal[..., j] - inferior[..., j] * c[..., j - 1]
+        c[..., j] = superior[..., j] / denominador
+        d[..., j] = (derecha[..., j] - inferior[..., j] * d[..., j - 1]) / denominador
+    x = np.empty_like(derecha)
+    x[..., -1] = d[..., -1]
+    for j in range(n - 2, -1, -1):
+        x[..., j] = d[..., j] - c[..., j] * x[..., j + 1]
+    return x
+
+
+def _derivada_z(campo, z):
+    # derivada en el último eje sobre niveles no uniformes z (mismos ejes iniciales que campo, o difundibles)
+    d = np.empty_like(campo)
+    h_abajo = z[..., 1:-1] - z[..., :-2]
+    h_arriba = z[..., 2:] - z[..., 1:-1]
+    d[..., 1:-1] = ((campo[..., 2:] - campo[..., 1:-1]) * h_abajo / h_arriba
+                    + (campo[..., 1:-1] - campo[..., :-2]) * h_arriba / h_abajo) / (h_abajo + h_arriba)
+    d[..., 0] = (campo[..., 1] - campo[..., 0]) / (z[..., 1] - z[..., 0])
+    d[..., -1] = (campo[..., -1] - campo[..., -2]) / (z[..., -1] - z[..., -2])
+    return d
+
+
+@instrumentacion.medido('funcion_corriente')
+def funcion_corriente(u, w, dx, altura):
+    # ψ en la malla de masa con u = ∂ψ/∂z y w = -∂ψ/∂x, para todos los tiempos del bloque a la vez.
+    # Se resuelve ∇²ψ = ∂u/∂z - ∂w/∂x con FFT en x (dominio periódico) y un sistema tridiagonal por número
+    # de onda en z sobre las alturas medias de cada nivel, con ψ = 0 en la superficie y en el tope. El modo
+    # k = 0 no tiene ecuación de Poisson útil: es el flujo medio, que se integra directamente de la media de u.
+    # La discretización vertical es de segundo orden en el espesor de las capas. Con 100 niveles uniformes hasta
+    # 30 km (dz = 300 m) un modo analítico sin(m π z / H) cos(k x) con m = 1 sale con error relativo ~1e-4, que
+    # crece como m² y con el espesor de las capas más gruesas: con 100 niveles estirados de 48 a 930 m es ~5e-4
+    # para m = 1 y ~1e-2 para m = 3
+    u_masa, w_masa = a_malla_masa(u, w)
+    altura = np.asarray(altura)
+    n_we = u_masa.shape[-1]
+
+    # alturas medias (tiempo, nivel) de los niveles escalonados y de masa; la columna completa es necesaria
+    z_stag = altura.mean(axis=(2, 3))
+    z_masa = 0.5 * (z_stag[:, :-1] + z_stag[:, 1:])
+    z = np.concatenate([z_stag[:, :1], z_masa, z_stag[:, -1:]], axis=1)
+
+    # (tiempo, sn, k, nivel) para que el sistema quede en el último eje
+    u_k = np.fft.rfft(u_masa, axis=-1).transpose(0, 2, 3, 1)
+    w_k = np.fft.rfft(w_masa, axis=-1).transpose(0, 2, 3, 1)
+    k = (2 * np.pi * np.fft.rfftfreq(n_we, d=dx)).astype(u_masa.dtype)
+
+    z_niveles = z_masa[:, None, None, :]
+    derecha = _derivada_z(u_k, z_niveles) - 1j * k[:, None] * w_k
+
+    # segunda derivada no uniforme con ψ = 0 en los nodos fantasma de superficie y tope
+    h_abajo = (z[:, 1:-1] - z[:, :-2])[:, None, None, :]
+    h_arriba = (z[:, 2:] - z[:, 1:-1])[:, None, None, :]
+    inferior = 2 / (h_abajo * (h_abajo + h_arriba))
+    superior = 2 / (h_arriba * (h_abajo + h_arriba))
+    diagonal = -inferior - superior - (k ** 2)[:, None]
+    forma = derecha.shape
+    psi_k = resolver_tridiagonal(np.broadcast_to(inferior, forma), np.broadcast_to(diagonal, forma),
+                                 np.broadcast_to(superior, forma), derecha)
+
+    # modo medio: ψ0(z) = ∫ ū dz desde la superficie (regla del trapecio, u constante en la primera capa)
+    u_media = u_k[:, :, 0].real
+    espesores = np.diff(z[:, :-1], axis=1)[:, None, :]
+    tramos = np.concatenate([u_media[..., :1], 0.5 * (u_media[..., 1:] + u_media[..., :-1])], axis=-1)
+    psi_k[:, :, 0] = np.cumsum(tramos * espesores, axis=-1)
+
+    return np.fft.irfft(psi_k.transpose(0, 3, 1, 2), n=n_we, axis=-1).astype(u_masa.dtype)
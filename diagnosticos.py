@@ -0,0 +1,218 @@
+from functools import cached_property
+
+import numpy as np
+
+import geometria
+import instrumentacion
+import umbrales
+
+# constantes para Titán
+g_titan = 1.352  # gravedad (m/s^2)
+temperatura_base = 100  # temperatura superficial media (K), usada en los perfiles de temperatura potencial
+temperatura_referencia = 94.0  # temperatura de referencia para la temperatura real (K)
+rd = 290.0  # constante de los gases para aire seco
+cp_air = 1044.0  # calor específico a presión constante para el aire
+po = 1e5  # presión de referencia (Pa)
+richardson_critico = 0.25  # por debajo el flujo estratificado es dinámicamente inestable
+
+
+def calcular_altura(ph, phb):
+    # altura geométrica en metros a partir del geopotencial
+    return (ph + phb) / g_titan
+
+
+def interpolar_u(u_values, forma_w):
+    # llevar u a la malla de w: quitar el último punto en x (u tiene 2001, w tiene 2000)
+    # y copiar los niveles de u; el nivel superior extra de w queda en cero igual que en algoritmo_p2
+    u_interp_z = np.zeros(forma_w, dtype=u_values.dtype)
+    n = min(u_values.shape[1], forma_w[1])
+    u_interp_z[:, :n] = u_values[:, :n, :, :-1]
+    return u_interp_z
+
+
+def gradiente_x(campo, dx):
+    # diferencias centradas en el interior y hacia adelante/atrás en los bordes
+    d_dx = np.empty_like(campo)
+    d_dx[..., 1:-1] = (campo[..., 2:] - campo[..., :-2]) / (2 * dx)
+    d_dx[..., 0] = (campo[..., 1] - campo[..., 0]) / dx
+    d_dx[..., -1] = (campo[..., -1] - campo[..., -2]) / dx
+    return d_dx
+
+
+def gradiente_z(campo, altura, espesores=None):
+    # derivada vertical sobre niveles de altura no uniformes (eje 1):
+    # diferencias centradas en el interior y hacia adelante/atrás en los bordes. espesores son los Δz
+    # ya protegidos de geometria.espesores_protegidos para los mismos niveles; si no se dan se calculan aquí
+    d_dz = np.zeros_like(campo)
+    n = min(altura.shape[1], campo.shape[1])
+    if n < 2:
+        return d_dz
+    if espesores is None:
+        espesores = geometria.espesores_protegidos(altura[:, :n])
+
+    d_dz[:, 1:n - 1] = (campo[:, 2:n] - campo[:, :n - 2]) / espesores[:, 1:n - 1]
+    d_dz[:, 0] = (campo[:, 1] - campo[:, 0]) / espesores[:, 0]
+    d_dz[:, n - 1] = (campo[:, n - 1] - campo[:, n - 2]) / espesores[:, n - 1]
+    return d_dz
+
+
+@instrumentacion.medido('cortante')
+def cortante_vertical(u, altura, espesores=None):
+    # du/dz en la malla de w tal como lo usa la vorticidad (u interpolada con el nivel superior en cero)
+    altura = np.asarray(altura)
+    return gradiente_z(interpolar_u(np.asarray(u), altura.shape), altura, espesores)
+
+
+@instrumentacion.medido('calcular_vorticidad')
+def vorticidad_cruda(u, w, dx, altura, du_dz=None, dw_dx=None):
+    # vorticidad dw/dx - du/dz sin recortar; trabaja igual sobre el archivo completo o sobre un bloque de tiempos.
+    # du_dz y dw_dx se pueden pasar ya calculados para compartirlos con otros diagnósticos (o, con una
+    # ventana en x, calculados sobre el halo)
+    if du_dz is None:
+        du_dz = cortante_vertical(u, altura)
+    if dw_dx is None:
+        dw_dx = gradiente_x(np.asarray(w), dx)
+
+    vorticidad = dw_dx - du_dz
+
+    # reemplazar infinitos con NaN, en el mismo arreglo y en su tipo
+    vorticidad[np.isinf(vorticidad)] = np.nan
+    return vorticidad
+
+
+def limites_percentiles(vorticidad, percentil_inferior=1, percentil_superior=99):
+    # límites del recorte en el tipo del campo, o None si no hay datos válidos; un límite float64 haría que
+    # np.clip devolviera todo el campo en float64
+    if np.isnan(vorticidad).all():
+        return None
+    tipo = vorticidad.dtype.type
+    return (tipo(np.nanpercentile(vorticidad, percentil_inferior)),
+            tipo(np.nanpercentile(vorticidad, percentil_superior)))
+
+
+@instrumentacion.medido('recorte_percentiles')
+def recortar_percentiles(vorticidad, percentil_inferior=1, percentil_superior=99, limites=None, out=None):
+    # recortar valores extremos que podrían ser errores numéricos; con out=vorticidad se recorta en el mismo
+    # arreglo, sin copia
+    if limites is None:
+        limites = limites_percentiles(vorticidad, percentil_inferior, percentil_superior)
+    if limites is None:
+        return vorticidad
+    return np.clip(vorticidad, *limites, out=out)
+
+
+def aplicar_umbral(campo, umbral=None, umbral_percentil=75, modo='global', ventana=101):
+    # máscara campo > umbral; sin umbral fijo se usa el percentil del propio campo, de todo el campo o por
+    # nivel, por tiempo o en una ventana móvil en west_east según el modo (ver umbrales.umbral_local)
+    if umbral is None:
+        umbral = umbrales.umbral_local(campo, modo, umbral_percentil, ventana)
+    return campo > umbral, umbral
+
+
+def calcular_vorticidad(u, w, dx, altura):
+    # versión vectorizada de calcular_vorticidad de algoritmo_p2.py
+    return recortar_percentiles(vorticidad_cruda(u, w, dx, altura))
+
+
+@instrumentacion.medido('estabilidad')
+def frecuencia_brunt_vaisala(ptp, altura, malla=None):
+    # N² = g/θ dθ/dz con θ = T + 94 K sobre las alturas de los niveles de masa; con la geometría del
+    # bloque se reutilizan sus alturas de masa y espesores
+    theta = np.asarray(ptp) + temperatura_referencia
+    if malla is None:
+        malla = geometria.GeometriaMalla(None, altura=np.asarray(altura))
+    return g_titan / theta * gradiente_z(theta, np.asarray(malla.altura_masa), malla.espesores_dz_masa)
+
+
+@instrumentacion.medido('estabilidad')
+def numero_richardson(n2, du_dz):
+    # Ri = N²/(du/dz)² en los niveles de masa, con el cortante de la vorticidad; NaN donde no hay cortante
+    cortante2 = du_dz[:, :n2.shape[1]] ** 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ri = n2 / cortante2
+    return np.where(cortante2 > 0, ri, np.nan)
+
+
+def energia_cinetica_turbulenta(u_perturbacion, w_perturbacion):
+    # TKE resuelta ½(u'² + w'²) en el plano x-z
+    return 0.5 * (u_perturbacion ** 2 + w_perturbacion ** 2)
+
+
+class CamposBloque:
+    # variables leídas de un bloque y los derivados que comparten los diagnósticos; cada derivado se
+    # calcula la primera vez que alguien lo pide y se reutiliza en el resto del bloque. malla es la
+    # geometría fija del archivo (GeometriaMalla.desde_archivo). Con una ventana en x el bloque se lee con
+    # halo: las variables se entregan ya recortadas y solo las derivadas en x usan el halo
+
+    def __init__(self, bloque, malla=None):
+        self.bloque = bloque
+        self.malla = malla
+
+    def __getitem__(self, nombre):
+        if self.malla is None:
+            return self.bloque[nombre]
+        return self.malla.recortar_x(self.bloque[nombre])
+
+    def __contains__(self, nombre):
+        return nombre in self.bloque
+
+    @cached_property
+    def altura(self):
+        return calcular_altura(self['PH'], self['PHB'])
+
+    @cached_property
+    def geometria(self):
+        # geometría del bloque: la del archivo más las alturas, espesores y ejes de este bloque de tiempos
+        if self.malla is None:
+            return geometria.GeometriaMalla(None, altura=self.altura)
+        return self.malla.para_bloque(self.altura)
+
+    @cached_property
+    def u_interpolada(self):
+        # U en la malla de w, la misma que usan la vorticidad y la descomposición en perturbaciones
+        return interpolar_u(np.asarray(self['U']), self.altura.shape)
+
+    @cached_property
+    def cortante(self):
+        with instrumentacion.etapa('cortante'):
+            return gradiente_z(self.u_interpolada, np.asarray(self.altura), self.geometria.espesores_dz)
+
+    def _derivada_x(self, campo):
+        # diferencias en x sobre el bloque leído, halo incluido, recortadas a la ventana
+        return self.malla.recortar_x(gradiente_x(campo, self.malla.dx))
+
+    @cached_property
+    def dw_dx(self):
+        return self._derivada_x(np.asarray(self.bloque['W']))
+
+    @cached_property
+    def du_dx(self):
+        if not any(self.malla.halo_x):
+            return gradiente_x(self.u_interpolada, self.malla.dx)
+        return self._derivada_x(interpolar_u(np.asarray(self.bloque['U']), self.bloque['W'].shape))
+
+
+@instrumentacion.medido('temperatura')
+def procesar_campo_temperatura(ptp, pp, pb, altura, altura_masa=None):
+    # temperatura real, altura en niveles de masa y presión total para un bloque (tiempo, nivel, sn, we);
+    # altura es la altura geométrica ya calculada en los niveles escalonados
+    pres = pp + pb  # presión total
+    # altura de los niveles de masa: promedio de los escalonados adyacentes
+    height = (altura[:, :-1] + altura[:, 1:]) / 2 if altura_masa is None else altura_masa
+    tr = (ptp + temperatura_referencia) * (pres / po) ** (rd / cp_air)
+    return tr, height, pres
+
+
+def perfil_temperatura_potencial(ptp, altura, x_punto=None):
+    # perfiles verticales de temperatura potencial para cada tiempo del bloque en el punto x_punto
+    if x_punto is None:
+        x_punto = ptp.shape[3] // 2
+    temp_perfil = temperatura_base + ptp[:, :, 0, x_punto]
+    altura_perfil = altura[:, :, 0, x_punto]
+
+    # añadir un nivel con el promedio de los dos últimos para igualar los niveles escalonados de altura
+    if temp_perfil.shape[1] < altura_perfil.shape[1]:
+        nuevo_valor = (temp_perfil[:, -1:] + temp_perfil[:, -2:-1]) / 2
+        temp_perfil = np.concatenate([temp_perfil, nuevo_valor], axis=1)
+
+    return temp_perfil, altura_perfil
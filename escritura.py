@@ -0,0 +1,275 @@
+from pathlib import Path
+
+import netCDF4 as nc
+import numpy as np
+
+import lectura
+
+# campos derivados que se pueden guardar, con sus dimensiones y metadatos estilo CF
+VARIABLES_DERIVADAS = {
+    'vorticidad': {
+        'dimensiones': ('Time', 'bottom_top_stag', 'south_north', 'west_east'),
+        'tipo': 'f4',
+        'atributos': {'units': 's-1', 'long_name': 'vorticidad relativa en el plano x-z (dw/dx - du/dz)'},
+    },
+    'vorticidad_cruda': {
+        'dimensiones': ('Time', 'bottom_top_stag', 'south_north', 'west_east'),
+        'tipo': 'f4',
+        'atributos': {'units': 's-1', 'long_name': 'vorticidad relativa en el plano x-z sin recortar'},
+    },
+    'zonas_turbulencia': {
+        'dimensiones': ('Time', 'bottom_top_stag', 'south_north', 'west_east'),
+        'tipo': 'u1',
+        'atributos': {'long_name': 'zonas donde la vorticidad supera el umbral',
+                      'flag_values': np.array([0, 1], dtype=np.uint8),
+                      'flag_meanings': 'sin_turbulencia turbulencia'},
+    },
+    'temperatura_real': {
+        'dimensiones': ('Time', 'bottom_top', 'south_north', 'west_east'),
+        'tipo': 'f4',
+        'atributos': {'units': 'K', 'standard_name': 'air_temperature', 'long_name': 'temperatura real'},
+    },
+    'n2': {
+        'dimensiones': ('Time', 'bottom_top', 'south_north', 'west_east'),
+        'tipo': 'f4',
+        'atributos': {'units': 's-2', 'long_name': 'frecuencia de Brunt-Väisälä al cuadrado'},
+    },
+    'richardson': {
+        'dimensiones': ('Time', 'bottom_top', 'south_north', 'west_east'),
+        'tipo': 'f4',
+        'atributos': {'units': '1', 'long_name': 'número de Richardson de gradiente N²/(du/dz)²'},
+    },
+    'tke': {
+        'dimensiones': ('Time', 'bottom_top_stag', 'south_north', 'west_east'),
+        'tipo': 'f4',
+        'atributos': {'units': 'm2 s-2', 'long_name': "energía cinética turbulenta resuelta ½(u'² + w'²)"},
+    },
+    'flujo_uw': {
+        'dimensiones': ('Time', 'bottom_top_stag', 'south_north', 'west_east'),
+        'tipo': 'f4',
+        'atributos': {'units': 'm2 s-2', 'long_name': "flujo vertical de momento u'w'"},
+    },
+    'u_perturbacion': {
+        'dimensiones': ('Time', 'bottom_top_stag', 'south_north', 'west_east'),
+        'tipo': 'f4',
+        'atributos': {'units': 'm s-1', 'long_name': "perturbación u' en la malla de w"},
+    },
+    'w_perturbacion': {
+        'dimensiones': ('Time', 'bottom_top_stag', 'south_north', 'west_east'),
+        'tipo': 'f4',
+        'atributos': {'units': 'm s-1', 'long_name': "perturbación w'"},
+    },
+    'theta_perturbacion': {
+        'dimensiones': ('Time', 'bottom_top', 'south_north', 'west_east'),
+        'tipo': 'f4',
+        'atributos': {'units': 'K', 'long_name': "perturbación de temperatura potencial θ'"},
+    },
+    'corriente': {
+        'dimensiones': ('Time', 'bottom_top', 'south_north', 'west_east'),
+        'tipo': 'f4',
+        'atributos': {'units': 'm2 s-1',
+                      'long_name': 'función de corriente en el plano x-z (u = dψ/dz, w = -dψ/dx)'},
+    },
+    'altura': {
+        'dimensiones': ('Time', 'bottom_top_stag', 'south_north', 'west_east'),
+        'tipo': 'f4',
+        'atributos': {'units': 'm', 'standard_name': 'height',
+                      'long_name': 'altura geométrica en los niveles escalonados'},
+    },
+}
+
+# criterios de vórtices (vortices.CRITERIOS), expresados como intensidad, y sus máscaras
+for _criterio, _descripcion in (('q', 'criterio Q'), ('lambda2', 'criterio λ2 cambiado de signo (-λ2)'),
+                                ('remolino', 'intensidad de remolino (swirling strength)')):
+    VARIABLES_DERIVADAS[f'criterio_{_criterio}'] = {
+        'dimensiones': ('Time', 'bottom_top_stag', 'south_north', 'west_east'),
+        'tipo': 'f4',
+        'atributos': {'long_name': _descripcion},
+    }
+    VARIABLES_DERIVADAS[f'zonas_{_criterio}'] = {
+        'dimensiones': ('Time', 'bottom_top_stag', 'south_north', 'west_east'),
+        'tipo': 'u1',
+        'atributos': {'long_name': f'zonas donde {_descripcion} supera el umbral',
+                      'flag_values': np.array([0, 1], dtype=np.uint8),
+                      'flag_meanings': 'sin_vortice vortice'},
+    }
+
+MODOS_EMPAQUETADO = ('int16', 'float16')
+CODIGO_MAXIMO = 32767  # códigos int16 simétricos; -32768 queda como valor de relleno para NaN
+RELLENO_INT16 = -32768
+
+
+def empaquetar(arreglo, modo):
+    # campo recortado -> (codificado, atributos); el rango se toma del propio campo, que ya está acotado
+    # por el recorte de percentiles, y el error máximo se mide decodificando
+    arreglo = np.asarray(arreglo)
+    if modo == 'float16':
+        codificado = arreglo.astype(np.float16)
+        atributos = {}
+    elif modo == 'int16':
+        minimo, maximo = float(np.nanmin(arreglo)), float(np.nanmax(arreglo))
+        escala = np.float32((maximo - minimo) / (2 * CODIGO_MAXIMO) or 1.0)
+        desplazamiento = np.float32((maximo + minimo) / 2)
+        codificado = np.round((arreglo - desplazamiento) / escala)
+        codificado = np.where(np.isnan(arreglo), RELLENO_INT16, codificado).astype(np.int16)
+        atributos = {'scale_factor': escala, 'add_offset': desplazamiento}
+    else:
+        raise ValueError(f"modo de empaquetado desconocido: {modo}")
+    error = np.nanmax(np.abs(desempaquetar(codificado, atributos) - arreglo)) if arreglo.size else 0.0
+    atributos['error_cuantizacion_maximo'] = float(error)
+    return codificado, atributos
+
+
+def desempaquetar(codificado, atributos):
+    # inversa de empaquetar; siempre devuelve float32
+    if codificado.dtype == np.float16:
+        return codificado.astype(np.float32)
+    if 'scale_factor' not in atributos:
+        return codificado
+    valores = codificado * np.float32(atributos['scale_factor']) + np.float32(atributos['add_offset'])
+    return np.where(codificado == RELLENO_INT16, np.float32(np.nan), valores).astype(np.float32)
+
+
+def guardar_campo(ruta, arreglo, modo=None):
+    # ruta sin extensión; .npy tal cual o .npz cuantizado con sus parámetros. Devuelve el error máximo
+    ruta = Path(ruta)
+    if modo is None:
+        np.save(ruta.with_suffix('.npy'), arreglo)
+        return 0.0
+    codificado, atributos = empaquetar(arreglo, modo)
+    np.savez(ruta.with_suffix('.npz'), datos=codificado, modo=modo, **atributos)
+    return atributos['error_cuantizacion_maximo']
+
+
+def cargar_campo(ruta):
+    # lee un campo guardado con guardar_campo, decodificando si está cuantizado
+    ruta = Path(ruta)
+    if ruta.with_suffix('.npy').exists():
+        return np.load(ruta.with_suffix('.npy'))
+    with np.load(ruta.with_suffix('.npz')) as archivo:
+        atributos = {clave: archivo[clave][()] for clave in ('scale_factor', 'add_offset') if clave in archivo}
+        return desempaquetar(archivo['datos'], atributos)
+
+
+class EscritorDerivados:
+    # archivo NetCDF4 comprimido con un trozo (chunk) por paso de tiempo; los bloques se escriben
+    # a medida que se producen y leer un tiempo cuesta la lectura de un solo trozo. Con anexar=True se
+    # reabre un archivo existente para seguir agregando tiempos al final. columnas (inicio, fin) limita
+    # west_east a la ventana procesada; x conserva la posición en el dominio completo
+
+    def __init__(self, ruta, datos_origen, nivel_inicio, nivel_fin, nivel_compresion=4, atributos=None,
+                 anexar=False, columnas=None):
+        self.ruta = ruta
+        self.nivel_compresion = nivel_compresion
+        self.tiene_times = 'Times' in datos_origen.variables
+        self.origen = datos_origen
+        if anexar and Path(ruta).exists():
+            self.datos = nc.Dataset(ruta, 'a')
+            if int(self.datos.nivel_inicio) != nivel_inicio or \
+                    len(self.datos.dimensions['bottom_top']) != nivel_fin - nivel_inicio:
+                self.datos.close()
+                raise ValueError(f"{ruta} tiene otros niveles; no se puede anexar")
+            self.variables = {nombre: variable for nombre, variable in self.datos.variables.items()
+                              if nombre in VARIABLES_DERIVADAS}
+            return
+
+        self.datos = nc.Dataset(ruta, 'w', format='NETCDF4')
+        n_niveles = nivel_fin - nivel_inicio
+        n_sn = len(datos_origen.dimensions['south_north'])
+        columna_inicio, columna_fin = (0, len(datos_origen.dimensions['west_east'])) if columnas is None else columnas
+        n_we = columna_fin - columna_inicio
+
+        self.datos.createDimension('Time', None)
+        self.datos.createDimension('DateStrLen', 19)
+        self.datos.createDimension('bottom_top', n_niveles)
+        self.datos.createDimension('bottom_top_stag', n_niveles + 1)
+        self.datos.createDimension('south_north', n_sn)
+        self.datos.createDimension('west_east', n_we)
+
+        self.datos.Conventions = 'CF-1.8'
+        self.datos.source = datos_origen.filepath()
+        self.datos.DX = datos_origen.DX
+        self.datos.DY = datos_origen.DY
+        self.datos.nivel_inicio = np.int32(nivel_inicio)
+        self.datos.columna_inicio = np.int32(columna_inicio)
+        for nombre, valor in (atributos or {}).items():
+            self.datos.setncattr(nombre, valor)
+
+        x = self.datos.createVariable('x', 'f4', ('west_east',))
+        x.units = 'm'
+        x.long_name = 'distancia a lo largo de west_east'
+        x[:] = (columna_inicio + np.arange(n_we)) * float(datos_origen.DX)
+
+        indice = self.datos.createVariable('indice_tiempo', 'i4', ('Time',))
+        indice.long_name = 'índice del paso de tiempo en el archivo de origen'
+        self.datos.createVariable('Times', 'S1', ('Time', 'DateStrLen'))
+        self.variables = {}
+
+    @property
+    def n_tiempos(self):
+        return len(self.datos.dimensions['Time'])
+
+    def _variable(self, nombre, tipo=None, relleno=None):
+        if nombre not in self.variables:
+            definicion = VARIABLES_DERIVADAS[nombre]
+            dims = definicion['dimensiones']
+            trozo = (1,) + tuple(len(self.datos.dimensions[d]) for d in dims[1:])
+            variable = self.datos.createVariable(nombre, tipo or definicion['tipo'], dims, zlib=True,
+                                                 complevel=self.nivel_compresion, shuffle=True, chunksizes=trozo,
+                                                 fill_value=relleno)
+            for clave, valor in definicion['atributos'].items():
+                variable.setncattr(clave, valor)
+            variable.coordinates = 'x indice_tiempo'
+            self.variables[nombre] = variable
+        return self.variables[nombre]
+
+    # las escrituras toman el candado de netCDF porque pueden coincidir con la lectura anticipada
+
+    def escribir_tiempos(self, posiciones, indices):
+        # índices del archivo de origen y cadenas Times del bloque
+        with lectura.CANDADO_NETCDF:
+            self.datos.variables['indice_tiempo'][posiciones] = np.asarray(indices, dtype=np.int32)
+            if self.tiene_times:
+                self.datos.variables['Times'][posiciones] = self.origen.variables['Times'][indices[0]:indices[-1] + 1]
+
+    def escribir(self, nombre, posiciones, arreglo, niveles=slice(None)):
+        arreglo = np.asarray(arreglo)
+        with lectura.CANDADO_NETCDF:
+            self._variable(nombre)[posiciones, niveles] = arreglo
+
+    def escribir_empaquetado(self, nombre, arreglo, modo):
+        # campo completo cuantizado a int16 con scale_factor/add_offset (convención CF, netCDF4 lo
+        # decodifica solo al leer); NetCDF no tiene float16. Devuelve el error máximo de cuantización
+        if modo != 'int16':
+            raise ValueError(f"NetCDF solo admite el empaquetado int16, no {modo}")
+        codificado, atributos = empaquetar(arreglo, modo)
+        with lectura.CANDADO_NETCDF:
+            variable = self._variable(nombre, tipo='i2', relleno=RELLENO_INT16)
+            variable.setncatts(atributos)
+            variable.set_auto_maskandscale(False)
+            for posicion in range(len(codificado)):
+                variable[posicion] = codificado[posicion]
+            variable.set_auto_maskandscale(True)
+        return atributos['error_cuantizacion_maximo']
+
+    def atributos(self, nombre=None, **valores):
+        # metadatos globales o de una variable, p. ej. los límites de recorte y el umbral
+        destino = self.datos if nombre is None else self._variable(nombre)
+        for clave, valor in valores.items():
+            destino.setncattr(clave, valor)
+
+    def cerrar(self):
+        if self.datos.isopen():
+            self.datos.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excepcion):
+        self.cerrar()
+
+
+def leer_tiempo(ruta, nombre, posicion):
+    # un paso de tiempo de un campo derivado (un solo trozo del archivo)
+    with nc.Dataset(ruta) as datos:
+        return np.asarray(datos.variables[nombre][posicion])
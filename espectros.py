@@ -0,0 +1,55 @@
+import numpy as np
+
+import instrumentacion
+
+VENTANAS = ('hann', 'ninguna')
+DESTENDENCIAS = ('lineal', 'media', 'ninguna')
+
+
+def quitar_tendencia(campo, modo='lineal'):
+    # quita la media o la recta de mínimos cuadrados a lo largo de west_east (último eje), para todo el
+    # bloque a la vez
+    if modo == 'ninguna':
+        return campo
+    campo = campo - campo.mean(axis=-1, keepdims=True)
+    if modo == 'media':
+        return campo
+    x = np.arange(campo.shape[-1], dtype=campo.dtype)
+    x -= x.mean()
+    pendiente = (campo @ x) / (x @ x)
+    return campo - pendiente[..., None] * x
+
+
+def ventana(n, tipo='hann', dtype=np.float32):
+    if tipo == 'ninguna':
+        return np.ones(n, dtype=dtype)
+    return np.hanning(n).astype(dtype)
+
+
+def numero_onda(n, dx):
+    # número de onda en ciclos por metro de la FFT real de n puntos
+    return np.fft.rfftfreq(n, d=dx)
+
+
+@instrumentacion.medido('espectros')
+def espectro_potencia(campo, dx, tipo_ventana='hann', destendencia='lineal'):
+    # densidad espectral unilateral a lo largo de west_east para todas las filas del bloque en una sola FFT;
+    # campo (..., west_east) -> (..., n // 2 + 1) en la precisión del campo (al menos float32), integrando
+    # sobre k da la varianza
+    campo = np.asarray(campo, dtype=np.result_type(campo, np.float32))
+    n = campo.shape[-1]
+    w = ventana(n, tipo_ventana, campo.dtype)
+    transformada = np.fft.rfft(quitar_tendencia(campo, destendencia) * w, axis=-1)
+
+    densidad = (transformada.real ** 2 + transformada.imag ** 2) * campo.dtype.type(dx / (w @ w))
+    # la energía de las frecuencias negativas se suma a las positivas, salvo en 0 y Nyquist
+    densidad[..., 1:(n + 1) // 2] *= 2
+    return densidad
+
+
+def espectros_bloque(u, w, dx, tipo_ventana='hann', destendencia='lineal'):
+    # espectros de U (en los puntos de masa, sin el último punto escalonado como interpolar_u) y de W,
+    # promediados en south_north: (tiempo, nivel, número de onda)
+    espectro_u = espectro_potencia(np.asarray(u)[..., :-1], dx, tipo_ventana, destendencia).mean(axis=2)
+    espectro_w = espectro_potencia(w, dx, tipo_ventana, destendencia).mean(axis=2)
+    return espectro_u, espectro_w
@@ -0,0 +1,130 @@
+import numpy as np
+
+# por debajo de este espesor (m) la derivada vertical se deja en cero, como en algoritmo_p2
+ESPESOR_MINIMO = 1e-10
+
+
+def espesores_protegidos(altura):
+    # Δz de las diferencias que usa gradiente_z a lo largo del eje 1: hacia adelante en el primer nivel,
+    # centrada (z[k+1] - z[k-1]) en el interior y hacia atrás en el último. Donde el espesor es casi nulo
+    # queda infinito, así el cociente da cero sin máscara en cada derivada; en el interior el criterio se
+    # aplica a la semidiferencia, igual que el cociente original. Se divide en vez de multiplicar por 1/Δz
+    # para que el resultado sea idéntico bit a bit al de algoritmo_p2
+    altura = np.asarray(altura)
+    n = altura.shape[1]
+    if n < 2:
+        return np.full_like(altura, np.inf)
+    espesor = np.empty_like(altura)
+    espesor[:, 1:n - 1] = altura[:, 2:] - altura[:, :-2]
+    espesor[:, 0] = altura[:, 1] - altura[:, 0]
+    espesor[:, n - 1] = altura[:, n - 1] - altura[:, n - 2]
+
+    limite = np.full(n, ESPESOR_MINIMO)
+    limite[1:n - 1] *= 2
+    casi_nulo = np.abs(espesor) < limite.reshape((n,) + (1,) * (altura.ndim - 2))
+    espesor[casi_nulo] = np.inf
+    return espesor
+
+
+class GeometriaMalla:
+    # geometría de la malla compartida por núcleos y gráficas. La parte fija del archivo (dx, dy, tamaños
+    # y dimensiones escalonadas) se arma una vez con desde_archivo; para_bloque le agrega la altura de un
+    # bloque de tiempos y los arreglos derivados de ella se calculan la primera vez que se piden.
+    # Con una ventana en west_east la malla describe solo la ventana: n_we puntos desde columna_inicio,
+    # y halo_x cuenta los puntos leídos de más a cada lado para las diferencias centradas en x
+
+    __slots__ = ('dx', 'dy', 'n_we', 'n_sn', 'escalonadas', 'altura', 'columna_inicio', 'halo_x',
+                 '_distancia', '_distancia_u', '_altura_masa', '_niveles_altura', '_espesores', '_espesores_masa')
+
+    def __init__(self, dx, dy=None, n_we=None, n_sn=None, escalonadas=None, altura=None, columna_inicio=0,
+                 halo_x=(0, 0)):
+        self.dx = dx
+        self.dy = dx if dy is None else dy
+        self.n_we = n_we
+        self.n_sn = n_sn
+        self.escalonadas = escalonadas or {}
+        self.altura = altura
+        self.columna_inicio = columna_inicio
+        self.halo_x = halo_x
+        if altura is not None:
+            self.n_sn, self.n_we = altura.shape[-2:]
+        self._distancia = self._distancia_u = None
+        self._altura_masa = self._niveles_altura = self._espesores = self._espesores_masa = None
+
+    @classmethod
+    def desde_archivo(cls, datos, columnas=None, halo=1):
+        # dimensión escalonada de cada variable, p. ej. {'U': 'west_east_stag', 'W': 'bottom_top_stag'};
+        # columnas (inicio, fin) restringe la malla a esa ventana de west_east, con hasta halo puntos
+        # vecinos a cada lado mientras haya dominio
+        escalonadas = {nombre: dimension for nombre, variable in datos.variables.items()
+                       for dimension in variable.dimensions if dimension.endswith('_stag')}
+        n_total = len(datos.dimensions['west_east'])
+        inicio, fin = (0, n_total) if columnas is None else columnas
+        # dx y dy como float de Python: un escalar de numpy float64 (DX guardado como double) subiría a
+        # float64 cada derivada de un campo float32
+        dy = getattr(datos, 'DY', None)
+        return cls(float(datos.DX), None if dy is None else float(dy), fin - inicio,
+                   len(datos.dimensions['south_north']), escalonadas, columna_inicio=inicio,
+                   halo_x=(min(halo, inicio), min(halo, n_total - fin)))
+
+    def para_bloque(self, altura):
+        return GeometriaMalla(self.dx, self.dy, self.n_we, self.n_sn, self.escalonadas, altura, self.columna_inicio,
+                              self.halo_x)
+
+    @property
+    def columnas_lectura(self):
+        # slice de west_east que hay que leer: la ventana más su halo
+        return slice(self.columna_inicio - self.halo_x[0], self.columna_inicio + self.n_we + self.halo_x[1])
+
+    def recortar_x(self, arreglo):
+        # quita el halo en x de un arreglo leído o calculado sobre columnas_lectura (en la malla de masa
+        # o en la escalonada de U, que tiene un punto más)
+        izquierda, derecha = self.halo_x
+        if not (izquierda or derecha):
+            return arreglo
+        return arreglo[..., izquierda:arreglo.shape[-1] - derecha]
+
+    def escalonada(self, variable):
+        # nombre de la dimensión escalonada de la variable, o None si vive en los puntos de masa
+        return self.escalonadas.get(variable)
+
+    @property
+    def distancia(self):
+        # posición en metros de los puntos de masa (y de W) a lo largo de west_east
+        if self._distancia is None:
+            self._distancia = (self.columna_inicio + np.arange(self.n_we)) * self.dx
+        return self._distancia
+
+    @property
+    def distancia_u(self):
+        # posición de los puntos escalonados de U, medio dx antes de cada punto de masa
+        if self._distancia_u is None:
+            self._distancia_u = (self.columna_inicio + np.arange(self.n_we + 1) - 0.5) * self.dx
+        return self._distancia_u
+
+    @property
+    def altura_masa(self):
+        # altura en los niveles de masa, promedio de los escalonados vecinos
+        if self._altura_masa is None:
+            self._altura_masa = (self.altura[:, :-1] + self.altura[:, 1:]) / 2
+        return self._altura_masa
+
+    @property
+    def niveles_altura(self):
+        # altura media de cada nivel escalonado por tiempo, (tiempo, nivel), para los ejes de las gráficas
+        if self._niveles_altura is None:
+            self._niveles_altura = np.asarray(self.altura).mean(axis=2).mean(axis=2)
+        return self._niveles_altura
+
+    @property
+    def espesores_dz(self):
+        # Δz de los niveles escalonados (malla de w) con la protección de espesor casi nulo
+        if self._espesores is None:
+            self._espesores = espesores_protegidos(self.altura)
+        return self._espesores
+
+    @property
+    def espesores_dz_masa(self):
+        if self._espesores_masa is None:
+            self._espesores_masa = espesores_protegidos(self.altura_masa)
+        return self._espesores_masa
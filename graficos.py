@@ -0,0 +1,226 @@
+import numpy as np
+import matplotlib.pyplot as plt
+
+import instrumentacion
+
+
+def _terminar(ruta_salida):
+    # mostrar la gráfica o guardarla en archivo si se dio una ruta
+    if ruta_salida is None:
+        plt.show()
+    else:
+        plt.savefig(ruta_salida, dpi=100)
+        plt.close()
+
+
+@instrumentacion.medido('grafica')
+def graficar_vorticidad_2d(vorticidad_tiempo, niveles_altura, malla, tiempo_idx, ruta_salida=None):
+    # vorticidad_tiempo: (nivel, west_east) ya promediada en south_north; malla es la GeometriaMalla del archivo
+    distancia = malla.distancia  # distancia en metros
+
+    # ignorar valores extremos para mejor visualización
+    vmin, vmax = np.nanpercentile(vorticidad_tiempo, [5, 95])
+
+    print(f"Tiempo {tiempo_idx}:")
+    print(f"  Valores NaN: {np.isnan(vorticidad_tiempo).sum()} de {vorticidad_tiempo.size}")
+    print(f"  Rango de valores: {np.nanmin(vorticidad_tiempo)} a {np.nanmax(vorticidad_tiempo)}")
+    print(f"  Rango para visualización: {vmin} a {vmax}")
+
+    plt.figure(figsize=(12, 6))
+    contour = plt.contourf(distancia, niveles_altura, vorticidad_tiempo,
+                           cmap='coolwarm', levels=50,
+                           vmin=vmin, vmax=vmax)
+    plt.colorbar(contour, label='Vorticidad (1/s)')
+    plt.title(f'Vorticidad en Titán (Tiempo {tiempo_idx})')
+    plt.xlabel('Distancia (m)')
+    plt.ylabel('Altura (m)')
+    plt.grid(True, linestyle='--', alpha=0.7)
+    _terminar(ruta_salida)
+
+
+@instrumentacion.medido('grafica')
+def graficar_corriente(corriente_tiempo, niveles_altura, malla, tiempo_idx, ruta_salida=None):
+    # corriente_tiempo: (nivel, west_east) en la malla de masa, con las líneas de corriente como contornos
+    distancia = malla.distancia
+    plt.figure(figsize=(12, 6))
+    relleno = plt.contourf(distancia, niveles_altura, corriente_tiempo, levels=50, cmap='viridis')
+    plt.colorbar(relleno, label='Función de corriente (m²/s)')
+    plt.contour(distancia, niveles_altura, corriente_tiempo, levels=20, colors='white', linewidths=0.6)
+    plt.title(f'Función de corriente en Titán (Tiempo {tiempo_idx})')
+    plt.xlabel('Distancia (m)')
+    plt.ylabel('Altura (m)')
+    _terminar(ruta_salida)
+
+
+@instrumentacion.medido('grafica')
+def crear_grafica_temperatura(tr, height, pres, titulo='Perfil de Temperatura', ruta_salida=None):
+    # tr, height y pres: (nivel, west_east) para un tiempo
+    plt.figure(figsize=(12, 8))
+
+    X, Y = np.meshgrid(np.arange(tr.shape[1]), np.arange(tr.shape[0]))
+    levels = np.linspace(np.min(tr), np.max(tr), 50)
+
+    cf = plt.contourf(X, Y, tr, levels=levels, cmap=plt.cm.RdYlBu_r, extend='both')
+    plt.contour(X, Y, tr, levels=levels[::5], colors='black', alpha=0.3, linewidths=0.5)
+
+    # invertir el eje y (presión)
+    plt.gca().invert_yaxis()
+
+    x_ticks = np.linspace(0, tr.shape[1] - 1, 6)
+    x_labels = np.linspace(np.min(height[0, :]), np.max(height[0, :]), 6)
+    plt.xticks(x_ticks, [f'{x:0.0f}' for x in x_labels])
+
+    y_ticks = np.linspace(0, tr.shape[0] - 1, 6)
+    y_labels = np.linspace(np.min(pres[:, 0]), np.max(pres[:, 0]), 6)
+    plt.yticks(y_ticks, [f'{y:0.0f}' for y in y_labels])
+
+    cbar = plt.colorbar(cf)
+    cbar.set_label('Temperatura (K)', rotation=270, labelpad=15)
+
+    plt.xlabel('Altura (m)')
+    plt.ylabel('Presión (Pa)')
+    plt.title(titulo)
+    plt.grid(True, linestyle='--', alpha=0.3)
+    plt.tight_layout()
+    _terminar(ruta_salida)
+
+
+@instrumentacion.medido('grafica')
+def graficar_perfiles_temperatura(temp_perfiles, altura_perfiles, tiempos, ruta_salida=None):
+    # un perfil de temperatura potencial por cada tiempo
+    fig, ax = plt.subplots(figsize=(10, 6))
+    for temp_perfil, altura_perfil, tiempo in zip(temp_perfiles, altura_perfiles, tiempos):
+        ax.plot(temp_perfil, altura_perfil, linewidth=2, label=f'Tiempo {tiempo}')
+
+    ax.set_xlabel('Temperatura Potencial (K)')
+    ax.set_ylabel('Altura (m)')
+    ax.set_title('Perfil de Temperatura Potencial')
+    ax.grid(True)
+    ax.legend(loc='upper right', frameon=True)
+    _terminar(ruta_salida)
+
+
+@instrumentacion.medido('grafica')
+def graficar_perfil_vorticidad(vorticidad_por_nivel, ruta_salida=None):
+    plt.figure(figsize=(10, 6))
+    plt.plot(vorticidad_por_nivel, range(len(vorticidad_por_nivel)), 'b-')
+    plt.xlabel('Vorticidad promedio')
+    plt.ylabel('Nivel vertical')
+    plt.title('Perfil vertical de vorticidad')
+    plt.grid(True)
+    _terminar(ruta_salida)
+
+
+@instrumentacion.medido('grafica')
+def graficar_evolucion_vorticidad(tiempos, vorticidad_tiempo, ruta_salida=None):
+    plt.figure(figsize=(10, 6))
+    plt.plot(tiempos, vorticidad_tiempo, 'r-')
+    plt.xlabel('Paso de tiempo')
+    plt.ylabel('Vorticidad promedio')
+    plt.title('Evolución temporal de la vorticidad')
+    plt.grid(True)
+    _terminar(ruta_salida)
+
+
+@instrumentacion.medido('grafica')
+def graficar_perfil_estabilidad(n2_por_nivel, fraccion_inestable, ruta_salida=None):
+    # N² medio y fracción de puntos con Ri < 0.25 por nivel vertical
+    niveles = range(len(n2_por_nivel))
+    fig, (ax_n2, ax_ri) = plt.subplots(1, 2, figsize=(12, 6), sharey=True)
+    ax_n2.plot(n2_por_nivel, niveles, 'b-')
+    ax_n2.set_xlabel('N² promedio (1/s²)')
+    ax_n2.set_ylabel('Nivel vertical')
+    ax_n2.grid(True)
+    ax_ri.plot(fraccion_inestable, niveles, 'r-')
+    ax_ri.set_xlabel('Fracción con Ri < 0.25')
+    ax_ri.grid(True)
+    fig.suptitle('Perfil vertical de estabilidad')
+    _terminar(ruta_salida)
+
+
+@instrumentacion.medido('grafica')
+def graficar_espectros(numero_onda, espectro_u, espectro_w, ruta_salida=None):
+    # espectros promedio de U y W en escala log-log con la pendiente -5/3 de referencia
+    k = numero_onda[1:]
+    plt.figure(figsize=(10, 6))
+    plt.loglog(k, espectro_u[1:], 'b-', label='U')
+    plt.loglog(k, espectro_w[1:], 'r-', label='W')
+    referencia = espectro_u[1] * (k / k[0]) ** (-5 / 3)
+    plt.loglog(k, referencia, 'k--', alpha=0.5, label='k^(-5/3)')
+    plt.xlabel('Número de onda (ciclos/m)')
+    plt.ylabel('Densidad espectral (m² s⁻² / (ciclos/m))')
+    plt.title('Espectros de energía a lo largo de west_east')
+    plt.grid(True, which='both', alpha=0.3)
+    plt.legend()
+    _terminar(ruta_salida)
+
+
+@instrumentacion.medido('grafica')
+def graficar_perfil_tke(tke_por_nivel, flujo_uw_por_nivel, ruta_salida=None):
+    # TKE resuelta y flujo de momento u'w' promedio por nivel vertical
+    niveles = range(len(tke_por_nivel))
+    fig, (ax_tke, ax_flujo) = plt.subplots(1, 2, figsize=(12, 6), sharey=True)
+    ax_tke.plot(tke_por_nivel, niveles, 'b-')
+    ax_tke.set_xlabel('TKE resuelta (m²/s²)')
+    ax_tke.set_ylabel('Nivel vertical')
+    ax_tke.grid(True)
+    ax_flujo.plot(flujo_uw_por_nivel, niveles, 'r-')
+    ax_flujo.axvline(0, color='k', linewidth=0.5)
+    ax_flujo.set_xlabel("Flujo u'w' (m²/s²)")
+    ax_flujo.grid(True)
+    fig.suptitle('Descomposición en media y perturbaciones')
+    _terminar(ruta_salida)
+
+
+@instrumentacion.medido('grafica')
+def graficar_fraccion_vortices(fracciones, ruta_salida=None):
+    # fracción de puntos marcados por nivel para cada criterio de vórtices
+    plt.figure(figsize=(10, 6))
+    for nombre, fraccion in fracciones.items():
+        plt.plot(fraccion, range(len(fraccion)), label=nombre)
+    plt.xlabel('Fracción marcada')
+    plt.ylabel('Nivel vertical')
+    plt.title('Zonas de vórtices por criterio')
+    plt.grid(True)
+    plt.legend()
+    _terminar(ruta_salida)
+
+
+@instrumentacion.medido('grafica')
+def graficar_barrido_umbrales(umbrales, fracciones, umbral=None, ruta_salida=None):
+    # fracción turbulenta media (sobre tiempos y niveles) y su rango entre niveles para cada umbral
+    orden = np.argsort(umbrales)
+    umbrales = np.asarray(umbrales)[orden]
+    por_nivel = fracciones[orden].mean(axis=1)
+    plt.figure(figsize=(10, 6))
+    plt.fill_between(umbrales, por_nivel.min(axis=1), por_nivel.max(axis=1), alpha=0.3, label='rango entre niveles')
+    plt.plot(umbrales, por_nivel.mean(axis=1), label='media')
+    if umbral is not None:
+        plt.axvline(umbral, color='black', linestyle='--', label=f'umbral usado ({umbral:.3g})')
+    plt.xlabel('Umbral de vorticidad (1/s)')
+    plt.ylabel('Fracción turbulenta')
+    plt.title('Sensibilidad de las zonas de turbulencia al umbral')
+    plt.grid(True)
+    plt.legend()
+    _terminar(ruta_salida)
+
+
+def imagen_corte(corte, x, z, titulo, etiqueta, vmin=None, vmax=None):
+    # corte x-z (nivel, west_east) como PNG en memoria para el servidor; usa una Figure propia en vez de
+    # pyplot para poder dibujar desde varios hilos
+    from io import BytesIO
+
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    figura = Figure(figsize=(10, 4))
+    FigureCanvasAgg(figura)
+    ejes = figura.add_subplot()
+    malla = ejes.pcolormesh(x, z, corte, shading='nearest', cmap='coolwarm', vmin=vmin, vmax=vmax)
+    figura.colorbar(malla, ax=ejes, label=etiqueta)
+    ejes.set_title(titulo)
+    ejes.set_xlabel('Distancia (m)')
+    ejes.set_ylabel('Altura (m)')
+    salida = BytesIO()
+    figura.savefig(salida, format='png', dpi=80)
+    return salida.getvalue()
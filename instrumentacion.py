@@ -0,0 +1,171 @@
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# se activa con las variables de entorno o con activar(); desactivada no agrega costo medible
+VARIABLE_REPORTE = 'TITAN_INSTRUMENTACION'  # ruta del reporte JSON
+VARIABLE_TRAZA = 'TITAN_TRAZA'  # ruta opcional de la traza para chrome://tracing o Perfetto
+
+_estado = {
+    'activa': False,
+    'ruta_reporte': None,
+    'ruta_traza': None,
+    'origen': None,
+    'registros': [],
+}
+_pila = threading.local()
+
+
+def activa():
+    return _estado['activa']
+
+
+def activar(ruta_reporte=None, ruta_traza=None):
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _estado.update(activa=True, ruta_reporte=ruta_reporte, ruta_traza=ruta_traza,
+                   origen=time.perf_counter(), registros=[])
+
+
+def desactivar():
+    _estado['activa'] = False
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def _marcos():
+    if not hasattr(_pila, 'marcos'):
+        _pila.marcos = []
+    return _pila.marcos
+
+
+def registrar_lectura(n_bytes):
+    # bytes leídos del netCDF; se suman a la etapa actual y a las que la contienen, en el hilo que llama.
+    # Lo leído por adelantado en otro hilo se vuelve a registrar en el hilo que lo consume
+    if not _estado['activa']:
+        return
+    for marco in _marcos():
+        marco['bytes_leidos'] += n_bytes
+
+
+@contextmanager
+def etapa(nombre, **atributos):
+    # mide tiempo de pared, tiempo de CPU, memoria pico trazada y bytes leídos de un bloque de código.
+    # El pico de tracemalloc y process_time son de todo el proceso: solo el hilo principal los usa. En
+    # otros hilos (lectura anticipada, servidor) se mide el CPU del hilo y no se informa memoria, así no
+    # borran el pico de las etapas abiertas en el hilo principal
+    if not _estado['activa']:
+        yield
+        return
+
+    principal = threading.current_thread() is threading.main_thread()
+    reloj_cpu = time.process_time if principal else time.thread_time
+    marcos = _marcos()
+    actual = pico_previo = 0
+    if principal:
+        actual, pico_previo = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+    marco = {'bytes_leidos': 0, 'pico_hijos': 0}
+    marcos.append(marco)
+    inicio = time.perf_counter()
+    inicio_cpu = reloj_cpu()
+    try:
+        yield
+    finally:
+        duracion = time.perf_counter() - inicio
+        duracion_cpu = reloj_cpu() - inicio_cpu
+        pico = max(tracemalloc.get_traced_memory()[1], marco['pico_hijos']) if principal else 0
+        marcos.pop()
+        if marcos and principal:
+            # reset_peak borró el pico que llevaba la etapa de afuera; se le devuelve
+            marcos[-1]['pico_hijos'] = max(marcos[-1]['pico_hijos'], pico, pico_previo)
+        _estado['registros'].append({
+            'nombre': nombre,
+            'inicio_s': inicio - _estado['origen'],
+            'pared_s': duracion,
+            'cpu_s': duracion_cpu,
+            'memoria_pico_bytes': max(pico - actual, 0),
+            'bytes_leidos': marco['bytes_leidos'],
+            'profundidad': len(marcos),
+            'hilo': threading.get_ident(),
+            'atributos': atributos,
+        })
+
+
+def medido(nombre):
+    # decorador equivalente a envolver la función en etapa(nombre)
+    def decorador(funcion):
+        @functools.wraps(funcion)
+        def envoltura(*args, **kwargs):
+            if not _estado['activa']:
+                return funcion(*args, **kwargs)
+            with etapa(nombre):
+                return funcion(*args, **kwargs)
+        return envoltura
+    return decorador
+
+
+def resumen():
+    # totales por nombre de etapa
+    totales = {}
+    for registro in _estado['registros']:
+        total = totales.setdefault(registro['nombre'], {'llamadas': 0, 'pared_s': 0.0, 'cpu_s': 0.0,
+                                                        'memoria_pico_bytes': 0, 'bytes_leidos': 0})
+        total['llamadas'] += 1
+        total['pared_s'] += registro['pared_s']
+        total['cpu_s'] += registro['cpu_s']
+        total['memoria_pico_bytes'] = max(total['memoria_pico_bytes'], registro['memoria_pico_bytes'])
+        total['bytes_leidos'] += registro['bytes_leidos']
+    return totales
+
+
+def escribir_reporte(ruta):
+    with open(ruta, 'w') as f:
+        json.dump({'pid': os.getpid(), 'resumen': resumen(), 'etapas': _estado['registros']}, f, indent=2,
+                  default=str)
+
+
+def escribir_traza(ruta):
+    # formato de eventos de Chrome: una barra por etapa con sus mediciones como argumentos
+    eventos = [{
+        'name': registro['nombre'],
+        'ph': 'X',
+        'ts': registro['inicio_s'] * 1e6,
+        'dur': registro['pared_s'] * 1e6,
+        'pid': os.getpid(),
+        'tid': registro['hilo'],
+        'args': {'cpu_s': registro['cpu_s'], 'memoria_pico_bytes': registro['memoria_pico_bytes'],
+                 'bytes_leidos': registro['bytes_leidos'], **registro['atributos']},
+    } for registro in _estado['registros']]
+    with open(ruta, 'w') as f:
+        json.dump({'traceEvents': eventos, 'displayTimeUnit': 'ms'}, f, default=str)
+
+
+def escribir(ruta_reporte=None, ruta_traza=None):
+    # escribe el reporte y la traza (en las rutas dadas o las configuradas) y reinicia los registros
+    if not _estado['activa'] or not _estado['registros']:
+        return
+    ruta_reporte = ruta_reporte or _estado['ruta_reporte']
+    ruta_traza = ruta_traza or _estado['ruta_traza']
+    if ruta_reporte:
+        escribir_reporte(ruta_reporte)
+    if ruta_traza:
+        escribir_traza(ruta_traza)
+    totales = resumen()
+    if totales:
+        print("\nInstrumentación por etapa:")
+        for nombre, total in sorted(totales.items(), key=lambda item: -item[1]['pared_s']):
+            print(f"  {nombre}: {total['llamadas']} llamadas, {total['pared_s']:.3f} s, "
+                  f"CPU {total['cpu_s']:.3f} s, pico {total['memoria_pico_bytes'] / 2**20:.1f} MiB, "
+                  f"leídos {total['bytes_leidos'] / 2**20:.1f} MiB")
+    _estado['registros'] = []
+
+
+if os.environ.get(VARIABLE_REPORTE) or os.environ.get(VARIABLE_TRAZA):
+    activar(os.environ.get(VARIABLE_REPORTE) or None, os.environ.get(VARIABLE_TRAZA) or None)
+    atexit.register(escribir)
@@ -0,0 +1,416 @@
+import os
+import queue
+import re
+import threading
+
+import netCDF4 as nc
+import numpy as np
+from collections import namedtuple
+from pathlib import Path
+
+import instrumentacion
+
+# variables del archivo WRF que necesita cada diagnóstico
+VARIABLES_POR_DIAGNOSTICO = {
+    'temperatura': ('T', 'P', 'PB', 'PH', 'PHB'),
+    'vorticidad': ('U', 'W', 'PH', 'PHB'),
+    'perfil': ('T', 'PH', 'PHB'),
+    'estabilidad': ('T', 'U', 'PH', 'PHB'),
+    'espectros': ('U', 'W', 'PH', 'PHB'),
+    'descomposicion': ('U', 'W', 'T', 'PH', 'PHB'),
+    'corriente': ('U', 'W', 'PH', 'PHB'),
+    'vortices': ('U', 'W', 'PH', 'PHB'),
+}
+
+FORMATO_TIMES = '%Y-%m-%d_%H:%M:%S'
+# una selección de tiempos es por fechas si tiene una fecha AAAA-MM-DD; si no, son índices
+PATRON_FECHA = re.compile(r'\d{4}-\d{2}-\d{2}')
+
+# precisión de cálculo: los campos se leen del archivo como ndarray simples de este tipo y todos los núcleos
+# conservan el tipo de sus entradas. float32 (el tipo de las salidas de WRF) por defecto; float64 a pedido
+PRECISIONES = {'float32': np.float32, 'float64': np.float64}
+_politica = {'tipo': np.dtype(np.float32)}
+
+# la biblioteca netCDF/HDF5 no es segura entre hilos: toda lectura o escritura que pueda coincidir con el
+# hilo de lectura anticipada se hace con este candado tomado
+CANDADO_NETCDF = threading.RLock()
+
+
+def obtener_datos(ruta_archivo):
+    if not Path(ruta_archivo).exists():
+        raise FileNotFoundError(f"archivo no encontrado: {ruta_archivo}")
+    return nc.Dataset(ruta_archivo)
+
+
+def establecer_precision(nombre):
+    _politica['tipo'] = np.dtype(PRECISIONES[nombre])
+
+
+def tipo_calculo():
+    return _politica['tipo']
+
+
+def tamano_valor(variable):
+    # bytes que ocupa en memoria cada valor leído de la variable: las reales pasan al tipo de cálculo
+    return tipo_calculo().itemsize if variable.dtype.kind == 'f' else variable.dtype.itemsize
+
+
+def variables_necesarias(diagnosticos):
+    # unión ordenada de las variables de todos los diagnósticos pedidos, cada una una sola vez
+    variables = []
+    for diagnostico in diagnosticos:
+        for nombre in VARIABLES_POR_DIAGNOSTICO[diagnostico]:
+            if nombre not in variables:
+                variables.append(nombre)
+    return variables
+
+
+def interpretar_seleccion(texto, total):
+    # convierte '18', '0:43', '0:43:2' o '0,10,20' en una lista ordenada de índices válidos
+    if texto is None or texto == '':
+        return list(range(total))
+
+    indices = set()
+    for parte in texto.split(','):
+        parte = parte.strip()
+        if ':' in parte:
+            indices.update(range(*slice(*[int(x) if x else None for x in parte.split(':')]).indices(total)))
+        else:
+            indice = int(parte)
+            if not -total <= indice < total:
+                raise ValueError(f"índice {indice} fuera del rango 0 a {total - 1}")
+            indices.add(indice % total)
+    return sorted(indices)
+
+
+def interpretar_rango_x(texto, n_we, dx):
+    # 'i0:i1' en índices de west_east o '5000m:20000m' en metros (un extremo vacío queda abierto); devuelve
+    # (inicio, fin) de los puntos de masa. En metros entran los puntos cuya posición i * dx cae en el rango
+    if texto is None or texto == '':
+        return 0, n_we
+    partes = [parte.strip() for parte in texto.split(':')]
+    if len(partes) != 2:
+        raise ValueError(f"rango x inválido: {texto} (use 'i0:i1' o 'x0m:x1m')")
+    if any(parte.endswith('m') for parte in partes):
+        x0, x1 = (float(parte.rstrip('m')) if parte else None for parte in partes)
+        inicio = 0 if x0 is None else int(np.ceil(x0 / dx - 1e-9))
+        fin = n_we if x1 is None else int(np.floor(x1 / dx + 1e-9)) + 1
+    else:
+        inicio, fin, _ = slice(*[int(parte) if parte else None for parte in partes]).indices(n_we)
+    inicio, fin = max(inicio, 0), min(fin, n_we)
+    if fin <= inicio:
+        raise ValueError(f"el rango x {texto} no contiene puntos de west_east (hay {n_we})")
+    return inicio, fin
+
+
+def niveles_por_altura(alturas_niveles, texto, inicio=0, fin=None):
+    # niveles de masa [inicio, fin) dentro de la selección cuya altura media (m) cae en 'z0:z1'
+    partes = [parte.strip() for parte in texto.split(':')]
+    if len(partes) != 2:
+        raise ValueError(f"rango de alturas inválido: {texto} (use 'z0:z1' en metros)")
+    z0, z1 = (float(parte.rstrip('m')) if parte else None for parte in partes)
+    fin = len(alturas_niveles) if fin is None else fin
+    niveles = [k for k in range(inicio, fin)
+               if (z0 is None or alturas_niveles[k] >= z0) and (z1 is None or alturas_niveles[k] <= z1)]
+    if not niveles:
+        raise ValueError(f"ningún nivel tiene altura entre {texto} m")
+    return niveles[0], niveles[-1] + 1
+
+
+# Times decodificado de cada archivo, por (ruta, fecha de modificación, tamaño): un archivo que crece o se
+# reemplaza se vuelve a decodificar
+_INDICES_TIEMPO = {}
+
+
+def indice_tiempos(datos):
+    # fechas de Times como datetime64[s], decodificadas una sola vez por archivo; None si no hay Times
+    if 'Times' not in datos.variables:
+        return None
+    ruta = os.path.abspath(datos.filepath())
+    estado = os.stat(ruta)
+    clave = (ruta, estado.st_mtime_ns, estado.st_size, len(datos.dimensions['Time']))
+    if clave not in _INDICES_TIEMPO:
+        with CANDADO_NETCDF:
+            caracteres = np.ma.getdata(datos.variables['Times'][:])
+        cadenas = np.ascontiguousarray(caracteres, dtype='S1').view(f'S{caracteres.shape[-1]}').ravel()
+        # '2020-01-01_06:00:00' -> '2020-01-01T06:00:00', que NumPy convierte sin recorrer en Python
+        fechas = np.char.replace(np.char.strip(np.char.decode(cadenas, 'ascii')), '_', 'T')
+        for vieja in [c for c in _INDICES_TIEMPO if c[0] == ruta]:
+            del _INDICES_TIEMPO[vieja]
+        _INDICES_TIEMPO[clave] = fechas.astype('datetime64[s]')
+    return _INDICES_TIEMPO[clave]
+
+
+def es_seleccion_fechas(texto):
+    return bool(texto) and PATRON_FECHA.search(texto) is not None
+
+
+def _intervalo_fecha(texto, fin=False):
+    # una fecha parcial abarca toda su unidad: '2020-01-01' es el día completo y '2020-01-01T06' la hora;
+    # devuelve el inicio, o con fin=True el instante siguiente al final
+    texto = texto.strip().replace('_', 'T').replace(' ', 'T')
+    if not texto:
+        return None
+    try:
+        fecha = np.datetime64(texto)
+    except ValueError:
+        raise ValueError(f"fecha inválida: {texto} (use p. ej. 2020-01-01T06:00 o {FORMATO_TIMES})") from None
+    return (fecha + 1 if fin else fecha).astype('datetime64[s]')
+
+
+def indices_por_fechas(fechas, texto):
+    # índices ordenados de las fechas que caen en la selección: fechas sueltas o rangos 'a/b' (extremos
+    # incluidos, uno vacío queda abierto), separados por comas
+    if fechas is None:
+        raise ValueError("el archivo no tiene Times; seleccionar los tiempos por índice")
+    elegidos = np.zeros(len(fechas), dtype=bool)
+    for parte in texto.split(','):
+        if not parte.strip():
+            continue
+        desde, _, hasta = parte.partition('/') if '/' in parte else (parte, None, parte)
+        inicio, fin = _intervalo_fecha(desde), _intervalo_fecha(hasta, fin=True)
+        elegidos |= ((fechas >= inicio) if inicio is not None else True) & \
+                    ((fechas < fin) if fin is not None else True)
+    return np.flatnonzero(elegidos).tolist()
+
+
+def seleccionar_tiempos(datos, texto):
+    # índices de la selección --tiempos: enteros como interpretar_seleccion o fechas de Times
+    if es_seleccion_fechas(texto):
+        return indices_por_fechas(indice_tiempos(datos), texto)
+    return interpretar_seleccion(texto, len(datos.dimensions['Time']))
+
+
+def formatear_seleccion(indices):
+    # índices ordenados como rangos contiguos 'a:b' separados por comas (la forma que lee interpretar_seleccion)
+    return ','.join(f'{inicio}:{fin}' if fin - inicio > 1 else str(inicio)
+                    for inicio, fin in agrupar_contiguos(indices, len(indices)))
+
+
+class IndiceCorrida:
+    # índice de tiempos de una corrida partida en varios archivos (wrfout de una misma simulación): cada
+    # archivo se abre una vez para decodificar Times y una selección por fechas se resuelve al conjunto
+    # mínimo de archivos y rangos de índices contiguos, sin leer ningún otro dato. Si dos archivos repiten
+    # una fecha (p. ej. al reiniciar la corrida) se usa el primero que la tiene
+
+    def __init__(self, rutas):
+        self.rutas = list(rutas)
+        self.fechas = []
+        for ruta in self.rutas:
+            datos = obtener_datos(ruta)
+            try:
+                self.fechas.append(indice_tiempos(datos))
+            finally:
+                datos.close()
+
+    def seleccionar(self, texto):
+        # [(ruta, índices)] de los archivos que aportan algún tiempo, en orden cronológico
+        for ruta, fechas in zip(self.rutas, self.fechas):
+            if fechas is None:
+                raise ValueError(f"{ruta} no tiene Times; seleccionar los tiempos por índice")
+        orden = sorted((i for i in range(len(self.rutas)) if len(self.fechas[i])), key=lambda i: self.fechas[i][0])
+        vistas = np.empty(0, dtype='datetime64[s]')
+        seleccion = []
+        for i in orden:
+            indices = np.array(indices_por_fechas(self.fechas[i], texto), dtype=np.int64)
+            indices = indices[~np.isin(self.fechas[i][indices], vistas)]
+            if indices.size:
+                vistas = np.concatenate([vistas, self.fechas[i][indices]])
+                seleccion.append((self.rutas[i], indices.tolist()))
+        return seleccion
+
+
+def repartir_tiempos(rutas, texto):
+    # (ruta, selección) de cada archivo a procesar: con fechas, solo los archivos que tienen alguna y la
+    # selección ya como índices contiguos; con índices, todos los archivos con la misma selección
+    if not es_seleccion_fechas(texto):
+        return [(ruta, texto) for ruta in rutas]
+    seleccion = IndiceCorrida(rutas).seleccionar(texto)
+    if not seleccion:
+        raise ValueError(f"ningún archivo tiene tiempos en {texto}")
+    return [(ruta, formatear_seleccion(indices)) for ruta, indices in seleccion]
+
+
+def agrupar_contiguos(indices, tam_bloque):
+    # agrupa índices ordenados en rangos (inicio, fin) contiguos de a lo más tam_bloque elementos
+    bloques = []
+    for indice in indices:
+        if bloques and indice == bloques[-1][1] and indice - bloques[-1][0] < tam_bloque:
+            bloques[-1][1] = indice + 1
+        else:
+            bloques.append([indice, indice + 1])
+    return [tuple(b) for b in bloques]
+
+
+# niveles de masa [inicio, fin) que produce un bloque y niveles [lectura_inicio, lectura_fin) que se leen con el halo;
+# ultimo indica que el bloque llega al tope de la selección y también produce el nivel escalonado superior
+BloqueNiveles = namedtuple('BloqueNiveles', 'inicio fin lectura_inicio lectura_fin ultimo')
+
+
+def bloques_niveles(inicio, fin, tam_bloque, halo=1, total=None):
+    # parte los niveles [inicio, fin) en bloques con un halo para las diferencias centradas en la vertical.
+    # Con total (niveles del archivo) el halo también sale de la selección mientras haya niveles, así los
+    # bordes de una ventana vertical dan lo mismo que en la columna completa; el último bloque lee un nivel
+    # más porque también produce el nivel escalonado superior
+    limite_inferior, limite_superior = (inicio, fin) if total is None else (0, total)
+    for k0 in range(inicio, fin, tam_bloque):
+        k1 = min(k0 + tam_bloque, fin)
+        extra = int(k1 == fin and total is not None)
+        yield BloqueNiveles(k0, k1, max(k0 - halo, limite_inferior), min(k1 + halo + extra, limite_superior),
+                            k1 == fin)
+
+
+def _escalonado(rango):
+    # el mismo rango sobre la dimensión escalonada, con el punto extra del final
+    return slice(rango.start, None if rango.stop is None else rango.stop + 1)
+
+
+def _rellenos(variable):
+    # valores que marcan datos faltantes: _FillValue (o el relleno por defecto de netCDF si la variable no lo
+    # declara; None si se escribió sin relleno) y missing_value
+    rellenos = [] if variable.get_fill_value() is None else [variable.get_fill_value()]
+    if 'missing_value' in variable.ncattrs():
+        rellenos.extend(np.atleast_1d(variable.getncattr('missing_value')))
+    return rellenos
+
+
+def _sin_mascara(valores, variable, tipo):
+    # lo que enmascaraba netCDF4, resuelto sobre un ndarray simple: los datos faltantes de una variable real
+    # quedan en NaN y el arreglo pasa al tipo de cálculo (sin copia si ya lo es). Las demás variables
+    # (enteras, caracteres) se devuelven como están
+    if valores.dtype.kind != 'f':
+        return valores
+    faltantes = None
+    for relleno in _rellenos(variable):
+        iguales = valores == relleno
+        faltantes = iguales if faltantes is None else faltantes | iguales
+    valores = valores.astype(tipo, copy=False)
+    if faltantes is not None and faltantes.any():
+        valores[faltantes] = np.nan
+    return valores
+
+
+def leer_bloque(datos, variables, tiempos, niveles=None, columnas=None, tipo=None):
+    # lee un bloque contiguo de tiempos (slice) de cada variable una sola vez, como hiperrectángulo;
+    # niveles es un slice sobre bottom_top y columnas uno sobre west_east, las variables escalonadas
+    # leen un punto más en esa dimensión. Los campos llegan como ndarray de tipo (por defecto el de
+    # tipo_calculo) con NaN en los datos faltantes, sin MaskedArray que encarezca cada operación
+    return _leer_bloque(datos, variables, tiempos, niveles, columnas, tipo)[0]
+
+
+@instrumentacion.medido('carga')
+def _leer_bloque(datos, variables, tiempos, niveles, columnas, tipo):
+    # leer_bloque junto con los bytes que devolvió netCDF, antes de pasar al tipo de cálculo
+    tipo = tipo_calculo() if tipo is None else np.dtype(tipo)
+    rangos = {'bottom_top': niveles, 'west_east': columnas}
+    bloque = {}
+    leidos = 0
+    for nombre in variables:
+        variable = datos.variables[nombre]
+        seleccion = [tiempos]
+        for dim in variable.dimensions[1:]:
+            rango = rangos.get(dim.removesuffix('_stag'))
+            if rango is None:
+                seleccion.append(slice(None))
+            else:
+                seleccion.append(_escalonado(rango) if dim.endswith('_stag') else rango)
+        with CANDADO_NETCDF:
+            variable.set_auto_mask(False)
+            valores = variable[tuple(seleccion)]
+        instrumentacion.registrar_lectura(valores.nbytes)
+        leidos += valores.nbytes
+        bloque[nombre] = _sin_mascara(valores, variable, tipo)
+    return bloque, leidos
+
+
+class LectorAnticipado:
+    # lee en un hilo de fondo los bloques siguientes mientras se calcula el actual. La cola acota cuántos
+    # bloques leídos esperan (profundidad): si el cálculo va más lento el hilo se bloquea en vez de seguir
+    # leyendo. Con profundidad 0 lee en el mismo hilo, igual que sin anticipar.
+    # peticiones: iterable de (etiqueta, tiempos, niveles); al iterar devuelve (etiqueta, bloque). columnas
+    # es la ventana de west_east que se lee en todos los bloques (None para todo el dominio) y tipo el de
+    # los campos leídos (None para el de tipo_calculo, fijado al crear el lector)
+
+    _FIN = object()
+
+    def __init__(self, datos, variables, peticiones, profundidad=1, columnas=None, tipo=None):
+        self.datos = datos
+        self.variables = list(variables)
+        self.peticiones = peticiones
+        self.profundidad = profundidad
+        self.columnas = columnas
+        self.tipo = tipo_calculo() if tipo is None else np.dtype(tipo)
+        self.hilo = None
+        if profundidad > 0:
+            self.cola = queue.Queue(maxsize=profundidad)
+            self.detener = threading.Event()
+            self.hilo = threading.Thread(target=self._leer, name='lector-anticipado', daemon=True)
+            self.hilo.start()
+
+    def _poner(self, elemento):
+        # put con espera para poder cortar si el consumidor se fue
+        while not self.detener.is_set():
+            try:
+                self.cola.put(elemento, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _leer(self):
+        try:
+            for etiqueta, tiempos, niveles in self.peticiones:
+                if self.detener.is_set():
+                    return
+                bloque, leidos = _leer_bloque(self.datos, self.variables, tiempos, niveles, self.columnas, self.tipo)
+                if not self._poner((etiqueta, bloque, leidos)):
+                    return
+        except BaseException as e:
+            self._poner((self._FIN, e, 0))
+            return
+        self._poner((self._FIN, None, 0))
+
+    def __iter__(self):
+        if self.hilo is None:
+            for etiqueta, tiempos, niveles in self.peticiones:
+                yield etiqueta, leer_bloque(self.datos, self.variables, tiempos, niveles, self.columnas, self.tipo)
+            return
+        try:
+            while True:
+                etiqueta, bloque, leidos = self.cola.get()
+                if etiqueta is self._FIN:
+                    if bloque is not None:
+                        raise bloque
+                    return
+                # la carga quedó medida en el hilo lector; los bytes leídos (los de netCDF, antes de pasar al
+                # tipo de cálculo) se acreditan a las etapas que consumen
+                instrumentacion.registrar_lectura(leidos)
+                yield etiqueta, bloque
+        finally:
+            self.cerrar()
+
+    def cerrar(self):
+        if self.hilo is None:
+            return
+        self.detener.set()
+        # vaciar la cola libera al hilo si estaba esperando lugar
+        while self.hilo.is_alive():
+            try:
+                self.cola.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self.hilo.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excepcion):
+        self.cerrar()
+
+
+def iterar_bloques(datos, variables, tiempos, tam_bloque=1, niveles=None, anticipar=0, columnas=None, tipo=None):
+    # recorre los tiempos seleccionados en bloques contiguos, devolviendo los índices y los arreglos leídos;
+    # con anticipar > 0 los bloques siguientes se leen en segundo plano
+    peticiones = ((np.arange(inicio, fin), slice(inicio, fin), niveles)
+                  for inicio, fin in agrupar_contiguos(tiempos, tam_bloque))
+    yield from LectorAnticipado(datos, variables, peticiones, anticipar, columnas, tipo)
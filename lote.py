@@ -0,0 +1,203 @@
+import contextlib
+import glob
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from copy import copy
+from pathlib import Path
+
+import matplotlib.pyplot as plt
+
+import geometria
+import instrumentacion
+import lectura
+import pipeline
+import planificador
+import titan
+
+# la cadena de pipeline.py usa las mismas variables y temporales que el diagnóstico de vorticidad
+DIAGNOSTICOS_PIPELINE = ('vorticidad',)
+
+# argumentos que cambian los resultados de un archivo; entran en la huella del manifiesto junto con los
+# diagnósticos, así repetir el lote con otros valores vuelve a procesar los archivos ya completados
+ARGUMENTOS_RESULTADO = ('tiempos', 'graficar', 'niveles', 'alturas', 'x', 'precision', 'formato', 'empaquetar',
+                        'ventana', 'destendencia', 'media', 'perturbaciones', 'umbral', 'umbral_percentil',
+                        'modo_umbral', 'ventana_umbral', 'barrido', 'criterios', 'umbral_criterios',
+                        'percentil_inferior', 'percentil_superior')
+
+
+def planificar_archivo(ruta_archivo, nombres, args, memoria_objetivo):
+    # plan para la región de interés del archivo (tiempos, niveles y ventana en x); None si ningún tiempo
+    # cae en la selección
+    datos = lectura.obtener_datos(ruta_archivo)
+    try:
+        if not lectura.seleccionar_tiempos(datos, args.tiempos):
+            return None
+        tiempos, (nivel_inicio, nivel_fin), columnas = titan.resolver_region(datos, args)
+        malla = geometria.GeometriaMalla.desde_archivo(datos, columnas)
+        return planificador.planificar(datos, nombres, len(tiempos), nivel_fin - nivel_inicio,
+                                       memoria_objetivo=memoria_objetivo, bloque_tiempo=args.bloque,
+                                       bloque_niveles=args.bloque_niveles, anticipar=args.anticipar,
+                                       n_we=malla.n_we + sum(malla.halo_x))
+    finally:
+        datos.close()
+
+
+def huella_trabajo(ruta_archivo, nombres, args):
+    # huella del archivo, de los diagnósticos pedidos y de los argumentos que afectan sus resultados
+    argumentos = {nombre: getattr(args, nombre, None) for nombre in ARGUMENTOS_RESULTADO}
+    return pipeline.huella(pipeline.huella_archivo(ruta_archivo), list(nombres), argumentos)
+
+
+def expandir_patrones(patrones):
+    # archivos que coinciden con los patrones, sin repetir y en orden
+    rutas = []
+    for patron in patrones:
+        coincidencias = sorted(glob.glob(patron)) or ([patron] if Path(patron).exists() else [])
+        if not coincidencias:
+            print(f"Aviso: ningún archivo coincide con {patron}")
+        for ruta in coincidencias:
+            if ruta not in rutas:
+                rutas.append(ruta)
+    return rutas
+
+
+class ManifiestoLote:
+    # estado por archivo de un lote (pendiente, en_curso, completado, error) guardado en lote.json
+
+    def __init__(self, ruta):
+        self.ruta = Path(ruta)
+        self.archivos = {}
+        if self.ruta.exists():
+            with open(self.ruta) as f:
+                self.archivos = json.load(f)['archivos']
+
+    def guardar(self):
+        self.ruta.parent.mkdir(parents=True, exist_ok=True)
+        temporal = self.ruta.with_suffix('.tmp')
+        with open(temporal, 'w') as f:
+            json.dump({'archivos': self.archivos}, f, indent=2)
+        temporal.replace(self.ruta)
+
+    def completado(self, ruta_archivo, huella):
+        registro = self.archivos.get(ruta_archivo)
+        return registro is not None and registro['estado'] == 'completado' and registro['huella'] == huella
+
+    def actualizar(self, ruta_archivo, **campos):
+        self.archivos.setdefault(ruta_archivo, {}).update(campos)
+        self.guardar()
+
+
+def _inicializar_trabajador(instrumentar, precision):
+    plt.switch_backend('Agg')
+    lectura.establecer_precision(precision)
+    if instrumentar:
+        instrumentacion.activar()
+
+
+def _procesar_trabajo(ruta_archivo, nombres, args):
+    # corre en un proceso del grupo; la salida de cada archivo va a su propio registro
+    salida = Path(args.salida) / Path(ruta_archivo).stem
+    salida.mkdir(parents=True, exist_ok=True)
+    inicio = time.perf_counter()
+    with open(salida / 'registro.txt', 'w') as registro, contextlib.redirect_stdout(registro):
+        if nombres == ('pipeline',):
+            titan.ejecutar_pipeline(ruta_archivo, args)
+        else:
+            titan.procesar_archivo(ruta_archivo, nombres, args)
+        # con la instrumentación activa cada archivo deja su propio reporte junto a sus resultados
+        instrumentacion.escribir(salida / 'instrumentacion.json',
+                                 salida / 'traza.json' if args.traza else None)
+    return time.perf_counter() - inicio
+
+
+def _args_archivo(ruta_archivo, args, plan):
+    # cada corrida (A1...An) escribe en su propio subdirectorio para no mezclar wrfout con el mismo nombre
+    args_archivo = copy(args)
+    args_archivo.bloque = plan.bloque_tiempo
+    args_archivo.bloque_niveles = plan.bloque_niveles
+    args_archivo.memoria_objetivo = plan.memoria_objetivo and plan.memoria_objetivo / 2**30
+    args_archivo.salida = str(Path(args.salida) / Path(ruta_archivo).resolve().parent.name)
+    args_archivo.mostrar = False
+    # los trabajadores del lote no pueden crear procesos propios; el paralelismo ya es entre archivos
+    args_archivo.procesos = 1
+    return args_archivo
+
+
+def _crear_grupo(trabajadores, args):
+    return ProcessPoolExecutor(max_workers=trabajadores, initializer=_inicializar_trabajador,
+                               initargs=(instrumentacion.activa(), args.precision))
+
+
+def ejecutar_lote(patrones, nombres, args, memoria_maxima, trabajadores=None):
+    rutas = list(dict.fromkeys(os.path.abspath(ruta) for ruta in expandir_patrones(patrones)))
+    manifiesto = ManifiestoLote(Path(args.salida) / 'lote.json')
+    trabajadores = trabajadores or os.cpu_count() or 1
+    nombres_memoria = DIAGNOSTICOS_PIPELINE if nombres == ('pipeline',) else nombres
+
+    pendientes = []
+    for ruta_archivo in rutas:
+        huella = huella_trabajo(ruta_archivo, nombres, args)
+        if not args.forzar and manifiesto.completado(ruta_archivo, huella):
+            print(f"{ruta_archivo}: completado en una ejecución anterior")
+            continue
+        # cada archivo se planifica para su parte del presupuesto; si no cabe, para el presupuesto completo
+        plan = planificar_archivo(ruta_archivo, nombres_memoria, args, memoria_maxima // trabajadores)
+        if plan is None:
+            print(f"{ruta_archivo}: ningún tiempo en {args.tiempos}; se omite")
+            continue
+        if not plan.cabe:
+            plan = planificar_archivo(ruta_archivo, nombres_memoria, args, memoria_maxima)
+        if not plan.cabe:
+            print(f"Aviso: {ruta_archivo} necesita ~{plan.memoria_estimada / 2**30:.2f} GiB, "
+                  "más que el presupuesto; se ejecutará solo")
+        pendientes.append((ruta_archivo, huella, plan))
+        manifiesto.actualizar(ruta_archivo, estado='pendiente', huella=huella, plan=plan.como_dict())
+
+    print(f"{len(pendientes)} archivos por procesar con hasta {trabajadores} procesos "
+          f"y {memoria_maxima / 2**30:.2f} GiB de presupuesto")
+
+    en_curso = {}
+    memoria_en_uso = 0
+    grupo = _crear_grupo(trabajadores, args)
+    try:
+        while pendientes or en_curso:
+            # lanzar trabajos mientras quepan en el presupuesto de memoria (siempre al menos uno)
+            while pendientes and len(en_curso) < trabajadores and (
+                    not en_curso or memoria_en_uso + pendientes[0][2].memoria_estimada <= memoria_maxima):
+                ruta_archivo, huella, plan = pendientes.pop(0)
+                futuro = grupo.submit(_procesar_trabajo, ruta_archivo, nombres, _args_archivo(ruta_archivo, args, plan))
+                en_curso[futuro] = (ruta_archivo, plan.memoria_estimada)
+                memoria_en_uso += plan.memoria_estimada
+                manifiesto.actualizar(ruta_archivo, estado='en_curso')
+
+            terminados, _ = wait(en_curso, return_when=FIRST_COMPLETED)
+            if any(isinstance(futuro.exception(), BrokenProcessPool) for futuro in terminados):
+                # un proceso que murió (p. ej. por el OOM killer) rompe el grupo entero: todos los trabajos en
+                # curso terminan con error y los pendientes siguen en un grupo nuevo
+                print("Aviso: un proceso del lote terminó abruptamente (¿falta de memoria?); se reinicia el grupo")
+                grupo.shutdown(wait=True)
+                terminados = list(en_curso)
+                grupo = _crear_grupo(trabajadores, args)
+            for futuro in terminados:
+                ruta_archivo, memoria = en_curso.pop(futuro)
+                memoria_en_uso -= memoria
+                try:
+                    duracion = futuro.result()
+                except Exception as e:
+                    print(f"{ruta_archivo}: error {e}")
+                    manifiesto.actualizar(ruta_archivo, estado='error', error=str(e))
+                else:
+                    print(f"{ruta_archivo}: completado en {duracion:.1f} s")
+                    manifiesto.actualizar(ruta_archivo, estado='completado', duracion=duracion, error=None)
+    finally:
+        grupo.shutdown()
+
+    # solo los archivos de esta ejecución: los errores de otros lotes en el mismo manifiesto no se repiten
+    errores = [ruta for ruta in rutas if manifiesto.archivos.get(ruta, {}).get('estado') == 'error']
+    if errores:
+        print(f"{len(errores)} archivos con error; vuelva a ejecutar el lote para reintentarlos")
+    return errores
+
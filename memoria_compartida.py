@@ -0,0 +1,112 @@
+import weakref
+from collections import namedtuple
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+# lo que un proceso necesita para ver un campo publicado: nombre del segmento, forma y tipo. Los bloques
+# de lectura.leer_bloque son ndarray simples (los datos faltantes ya vienen como NaN), sin máscara que copiar
+CampoCompartido = namedtuple('CampoCompartido', 'segmento forma tipo')
+
+
+def _liberar(segmentos):
+    # cierra y elimina los segmentos del dueño; también corre al salir del intérprete
+    for segmento in segmentos.values():
+        segmento.close()
+        try:
+            segmento.unlink()
+        except FileNotFoundError:
+            pass
+    segmentos.clear()
+
+
+class AlmacenCampos:
+    # carga cada bloque una sola vez en segmentos de multiprocessing.shared_memory para que varios procesos
+    # lo lean sin copias. Los segmentos se reutilizan entre bloques mientras alcance su tamaño, así que
+    # el dueño solo debe publicar un bloque nuevo cuando los procesos terminaron con el anterior.
+    # Se liberan con liberar(), al salir del bloque with, al recolectarse el objeto o al terminar el
+    # intérprete; si el proceso muere sin pasar por ahí, el resource_tracker de multiprocessing los elimina
+
+    def __init__(self):
+        self.segmentos = {}
+        self._finalizador = weakref.finalize(self, _liberar, self.segmentos)
+
+    def _segmento(self, clave, n_bytes):
+        segmento = self.segmentos.get(clave)
+        if segmento is not None and segmento.size >= n_bytes:
+            return segmento
+        if segmento is not None:
+            segmento.close()
+            segmento.unlink()
+        segmento = shared_memory.SharedMemory(create=True, size=max(n_bytes, 1))
+        self.segmentos[clave] = segmento
+        return segmento
+
+    def _copiar(self, clave, arreglo):
+        segmento = self._segmento(clave, arreglo.nbytes)
+        np.ndarray(arreglo.shape, arreglo.dtype, buffer=segmento.buf)[...] = arreglo
+        return segmento.name
+
+    def publicar(self, bloque):
+        # copia los arreglos del bloque a memoria compartida y devuelve sus descriptores por nombre; el bloque
+        # leído y su copia conviven en el proceso dueño (planificador lo cuenta en la lectura)
+        descriptores = {}
+        for nombre, arreglo in bloque.items():
+            arreglo = np.asarray(arreglo)
+            descriptores[nombre] = CampoCompartido(self._copiar(nombre, arreglo), arreglo.shape, arreglo.dtype.str)
+        return descriptores
+
+    def liberar(self):
+        self._finalizador()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excepcion):
+        self.liberar()
+
+
+class VistasCompartidas:
+    # lado de los procesos que leen: abre los segmentos publicados y entrega vistas NumPy de solo lectura.
+    # Los segmentos abiertos se conservan mientras el dueño los siga publicando, así un segmento reutilizado
+    # entre bloques se abre una sola vez
+
+    def __init__(self):
+        self.abiertos = {}
+
+    def _abrir(self, nombre):
+        if nombre not in self.abiertos:
+            segmento = shared_memory.SharedMemory(name=nombre)
+            # antes de Python 3.13 abrir un segmento también lo registra en el resource_tracker, que lo
+            # eliminaría al salir este proceso; solo el dueño debe eliminarlo
+            resource_tracker.unregister(segmento._name, 'shared_memory')
+            self.abiertos[nombre] = segmento
+        return self.abiertos[nombre]
+
+    def _vista(self, nombre, forma, tipo):
+        vista = np.ndarray(forma, np.dtype(tipo), buffer=self._abrir(nombre).buf)
+        vista.flags.writeable = False
+        return vista
+
+    def vistas(self, descriptores):
+        usados = {d.segmento for d in descriptores.values()}
+        for nombre in set(self.abiertos) - usados:
+            self._cerrar(nombre)
+        return {nombre: self._vista(d.segmento, d.forma, d.tipo) for nombre, d in descriptores.items()}
+
+    def _cerrar(self, nombre):
+        try:
+            self.abiertos.pop(nombre).close()
+        except BufferError:
+            # todavía hay vistas vivas del segmento; el mapeo se libera cuando se recolecten
+            pass
+
+    def cerrar(self):
+        for nombre in list(self.abiertos):
+            self._cerrar(nombre)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excepcion):
+        self.cerrar()
@@ -0,0 +1,248 @@
+import hashlib
+import json
+from pathlib import Path
+
+import numpy as np
+
+import diagnosticos
+import geometria
+import graficos
+import instrumentacion
+import lectura
+import planificador
+import umbrales
+
+
+def huella(*partes):
+    # huella estable de parámetros y huellas de entrada
+    texto = json.dumps(partes, sort_keys=True, default=str)
+    return hashlib.sha256(texto.encode('utf-8')).hexdigest()
+
+
+def huella_archivo(ruta):
+    # huella barata de un archivo externo: ruta, tamaño y fecha de modificación
+    estado = Path(ruta).stat()
+    return huella(str(Path(ruta).resolve()), estado.st_size, estado.st_mtime_ns)
+
+
+class Etapa:
+    # una etapa declara sus artefactos de entrada y salida y los parámetros que afectan su resultado
+
+    def __init__(self, nombre, funcion, entradas, salidas, parametros=()):
+        self.nombre = nombre
+        self.funcion = funcion
+        self.entradas = tuple(entradas)
+        self.salidas = tuple(salidas)
+        self.parametros = tuple(parametros)
+
+
+class Pipeline:
+    # ejecuta las etapas en orden y solo vuelve a correr las que cambiaron sus entradas o parámetros;
+    # las huellas se guardan en pipeline.json dentro del directorio de trabajo
+
+    def __init__(self, etapas, directorio):
+        self.etapas = list(etapas)
+        self.directorio = Path(directorio)
+        self.ruta_manifiesto = self.directorio / 'pipeline.json'
+
+        producidos = set()
+        for etapa in self.etapas:
+            producidos.update(etapa.salidas)
+        self.fuentes = {e for etapa in self.etapas for e in etapa.entradas} - producidos
+
+    def cargar_manifiesto(self):
+        if self.ruta_manifiesto.exists():
+            with open(self.ruta_manifiesto) as f:
+                return json.load(f)
+        return {'etapas': {}}
+
+    def guardar_manifiesto(self, manifiesto):
+        temporal = self.ruta_manifiesto.with_suffix('.tmp')
+        with open(temporal, 'w') as f:
+            json.dump(manifiesto, f, indent=2)
+        temporal.replace(self.ruta_manifiesto)
+
+    def ejecutar(self, fuentes, parametros, forzar=False):
+        faltantes = self.fuentes - set(fuentes)
+        if faltantes:
+            raise ValueError(f"faltan entradas externas: {', '.join(sorted(faltantes))}")
+
+        self.directorio.mkdir(parents=True, exist_ok=True)
+        manifiesto = self.cargar_manifiesto()
+        rutas = {nombre: Path(ruta) for nombre, ruta in fuentes.items()}
+        huellas = {nombre: huella_archivo(ruta) for nombre, ruta in rutas.items()}
+        ejecutadas = []
+
+        for etapa in self.etapas:
+            valores = {p: parametros.get(p) for p in etapa.parametros}
+            huella_etapa = huella(etapa.nombre, valores, [huellas[e] for e in etapa.entradas])
+            for salida in etapa.salidas:
+                rutas[salida] = self.directorio / salida
+
+            registro = manifiesto['etapas'].get(etapa.nombre)
+            al_dia = (not forzar and registro is not None and registro['huella'] == huella_etapa
+                      and all(rutas[s].exists() for s in etapa.salidas))
+            if al_dia:
+                print(f"Etapa {etapa.nombre}: sin cambios")
+            else:
+                print(f"Etapa {etapa.nombre}: ejecutando")
+                with instrumentacion.etapa(f'etapa.{etapa.nombre}'):
+                    etapa.funcion({e: rutas[e] for e in etapa.entradas},
+                                  {s: rutas[s] for s in etapa.salidas},
+                                  parametros)
+                manifiesto['etapas'][etapa.nombre] = {'huella': huella_etapa, 'parametros': valores,
+                                                      'salidas': list(etapa.salidas)}
+                # guardar después de cada etapa para poder retomar una ejecución interrumpida
+                self.guardar_manifiesto(manifiesto)
+                ejecutadas.append(etapa.nombre)
+
+            # las salidas heredan la huella de la etapa que las produjo
+            for salida in etapa.salidas:
+                huellas[salida] = huella_etapa
+
+        return ejecutadas
+
+
+def _guardar_npy(ruta, arreglo):
+    # np.save agrega .npy si falta; escribir a un temporal y renombrar evita artefactos a medias
+    temporal = ruta.with_name(ruta.name + '.tmp.npy')
+    np.save(temporal, np.asarray(arreglo))
+    temporal.replace(ruta)
+
+
+def _bloque_tiempo(datos, tiempos, parametros):
+    # tiempos por bloque pedidos o, si no se dieron, los que elige el planificador de memoria
+    if parametros.get('bloque'):
+        return parametros['bloque']
+    return planificador.planificar(datos, ('vorticidad',), len(tiempos),
+                                   memoria_objetivo=parametros.get('memoria_objetivo'),
+                                   anticipar=parametros.get('anticipar', 0)).bloque_tiempo
+
+
+def _malla(datos, parametros):
+    # geometría de la ventana en x pedida (todo west_east si no hay)
+    columnas = lectura.interpretar_rango_x(parametros.get('x'), len(datos.dimensions['west_east']), float(datos.DX))
+    return geometria.GeometriaMalla.desde_archivo(datos, columnas)
+
+
+def _tipo(parametros):
+    # precisión de cálculo de las etapas que leen el archivo; es parámetro para que cambiarla las recalcule
+    return lectura.PRECISIONES[parametros.get('precision') or 'float32']
+
+
+def etapa_altura(entradas, salidas, parametros):
+    datos = lectura.obtener_datos(entradas['archivo'])
+    try:
+        tiempos = lectura.seleccionar_tiempos(datos, parametros.get('tiempos'))
+        tam_bloque = _bloque_tiempo(datos, tiempos, parametros)
+        # la altura no usa diferencias en x: se lee la ventana sin halo
+        malla = _malla(datos, parametros)
+        columnas = slice(malla.columna_inicio, malla.columna_inicio + malla.n_we)
+        partes = [diagnosticos.calcular_altura(bloque['PH'], bloque['PHB'])
+                  for _, bloque in lectura.iterar_bloques(datos, ('PH', 'PHB'), tiempos, tam_bloque,
+                                                                  anticipar=parametros.get('anticipar', 0),
+                                                                  columnas=columnas, tipo=_tipo(parametros))]
+    finally:
+        datos.close()
+    _guardar_npy(salidas['altura.npy'], np.concatenate(partes))
+
+
+def etapa_vorticidad_cruda(entradas, salidas, parametros):
+    altura = np.load(entradas['altura.npy'], mmap_mode='r')
+    datos = lectura.obtener_datos(entradas['archivo'])
+    try:
+        tiempos = lectura.seleccionar_tiempos(datos, parametros.get('tiempos'))
+        vorticidad = np.empty(altura.shape, dtype=_tipo(parametros))
+        posicion = 0
+        tam_bloque = _bloque_tiempo(datos, tiempos, parametros)
+        malla = _malla(datos, parametros)
+        for indices, bloque in lectura.iterar_bloques(datos, ('U', 'W'), tiempos, tam_bloque,
+                                                         anticipar=parametros.get('anticipar', 0),
+                                                         columnas=malla.columnas_lectura, tipo=_tipo(parametros)):
+            fin = posicion + len(indices)
+            campos = diagnosticos.CamposBloque(bloque, malla)
+            vorticidad[posicion:fin] = diagnosticos.vorticidad_cruda(campos['U'], campos['W'], malla.dx,
+                                                                      altura[posicion:fin], dw_dx=campos.dw_dx)
+            posicion = fin
+    finally:
+        datos.close()
+    _guardar_npy(salidas['vorticidad_cruda.npy'], vorticidad)
+
+
+def etapa_recorte(entradas, salidas, parametros):
+    vorticidad = diagnosticos.recortar_percentiles(np.load(entradas['vorticidad_cruda.npy']),
+                                                   parametros.get('percentil_inferior', 1),
+                                                   parametros.get('percentil_superior', 99))
+    _guardar_npy(salidas['vorticidad.npy'], np.nan_to_num(vorticidad, nan=0.0))
+
+
+def etapa_zonas_turbulencia(entradas, salidas, parametros):
+    vorticidad = np.load(entradas['vorticidad.npy'], mmap_mode='r')
+    zonas_turbulencia, umbral = diagnosticos.aplicar_umbral(vorticidad, parametros.get('umbral'),
+                                                            parametros.get('umbral_percentil', 75),
+                                                            parametros.get('modo_umbral', 'global'),
+                                                            parametros.get('ventana_umbral', 101))
+    print(f"Umbral seleccionado: {umbrales.describir_umbral(umbral)}")
+    _guardar_npy(salidas['zonas_turbulencia.npy'], zonas_turbulencia)
+
+
+def etapa_estadisticas(entradas, salidas, parametros):
+    vorticidad = np.load(entradas['vorticidad.npy'], mmap_mode='r')
+    zonas_turbulencia = np.load(entradas['zonas_turbulencia.npy'], mmap_mode='r')
+    percentiles = [1, 5, 10, 25, 50, 75, 90, 95, 99]
+    estadisticas = {
+        'percentiles': dict(zip(map(str, percentiles), np.percentile(vorticidad, percentiles).tolist())),
+        'vorticidad_por_nivel': np.nanmean(vorticidad, axis=(0, 2, 3)).tolist(),
+        'vorticidad_por_tiempo': np.nanmean(vorticidad, axis=(1, 2, 3)).tolist(),
+        'fraccion_turbulenta_por_nivel': zonas_turbulencia.mean(axis=(0, 2, 3)).tolist(),
+        'fraccion_turbulenta_por_tiempo': zonas_turbulencia.mean(axis=(1, 2, 3)).tolist(),
+    }
+    with open(salidas['estadisticas.json'], 'w') as f:
+        json.dump(estadisticas, f, indent=2)
+
+
+def etapa_graficas(entradas, salidas, parametros):
+    vorticidad = np.load(entradas['vorticidad.npy'], mmap_mode='r')
+    altura = np.load(entradas['altura.npy'], mmap_mode='r')
+    directorio = salidas['graficas']
+    directorio.mkdir(exist_ok=True)
+
+    datos = lectura.obtener_datos(entradas['archivo'])
+    try:
+        tiempos = lectura.seleccionar_tiempos(datos, parametros.get('tiempos'))
+        graficar = parametros.get('graficar')
+        graficar = tiempos[:1] if graficar is None else lectura.seleccionar_tiempos(datos, graficar)
+        malla = _malla(datos, parametros)
+    finally:
+        datos.close()
+
+    for tiempo in graficar:
+        if tiempo not in tiempos:
+            continue
+        i = tiempos.index(tiempo)
+        niveles_altura = malla.para_bloque(altura[i:i + 1]).niveles_altura[0]
+        graficos.graficar_vorticidad_2d(vorticidad[i].mean(axis=1), niveles_altura, malla, tiempo,
+                                        ruta_salida=directorio / f'vorticidad_t{tiempo:03d}.png')
+    graficos.graficar_perfil_vorticidad(np.nanmean(vorticidad, axis=(0, 2, 3)),
+                                        ruta_salida=directorio / 'perfil_vorticidad.png')
+    graficos.graficar_evolucion_vorticidad(tiempos, np.nanmean(vorticidad, axis=(1, 2, 3)),
+                                           ruta_salida=directorio / 'evolucion_vorticidad.png')
+
+
+# cadena de algoritmo_p2: archivo -> altura -> vorticidad -> recorte -> zonas_turbulencia -> estadísticas y gráficas
+ETAPAS_VORTICIDAD = [
+    Etapa('altura', etapa_altura, ['archivo'], ['altura.npy'], ['tiempos', 'x', 'precision']),
+    Etapa('vorticidad', etapa_vorticidad_cruda, ['archivo', 'altura.npy'], ['vorticidad_cruda.npy'],
+          ['tiempos', 'x', 'precision']),
+    Etapa('recorte', etapa_recorte, ['vorticidad_cruda.npy'], ['vorticidad.npy'],
+          ['percentil_inferior', 'percentil_superior']),
+    Etapa('zonas_turbulencia', etapa_zonas_turbulencia, ['vorticidad.npy'], ['zonas_turbulencia.npy'],
+          ['umbral', 'umbral_percentil', 'modo_umbral', 'ventana_umbral']),
+    Etapa('estadisticas', etapa_estadisticas, ['vorticidad.npy', 'zonas_turbulencia.npy'], ['estadisticas.json']),
+    Etapa('graficas', etapa_graficas, ['archivo', 'vorticidad.npy', 'altura.npy'], ['graficas'],
+          ['tiempos', 'graficar', 'x']),
+]
+
+
+def ejecutar_vorticidad(ruta_archivo, directorio, parametros, forzar=False):
+    return Pipeline(ETAPAS_VORTICIDAD, directorio).ejecutar({'archivo': ruta_archivo}, parametros, forzar)
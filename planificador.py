@@ -0,0 +1,211 @@
+import json
+import math
+import os
+
+import lectura
+
+# arreglos temporales del tamaño de un bloque que usa cada diagnóstico, sobre la variable de referencia
+TEMPORALES_POR_DIAGNOSTICO = {
+    'temperatura': ('T', 4),  # presión total, altura en niveles de masa, cociente de presiones y temperatura real
+    'vorticidad': ('W', 10),  # u interpolada, gradientes, máscaras y cocientes de calcular_vorticidad
+    'perfil': ('T', 1),
+    'estabilidad': ('W', 6),  # θ, alturas de masa, gradiente, N², cortante al cuadrado y Ri
+    'espectros': ('W', 6),  # campo sin tendencia y con ventana, transformada compleja y densidad de U y W
+    'descomposicion': ('W', 6),  # u interpolada, u', w', θ', TKE y u'w'
+    'corriente': ('W', 12),  # u y w en masa, sus transformadas complejas y los coeficientes del sistema
+    'vortices': ('W', 10),  # u interpolada, las cuatro derivadas y los temporales de cada criterio
+}
+
+# arreglos del tamaño de todos los tiempos seleccionados que se conservan hasta el final
+ACUMULADOS_POR_DIAGNOSTICO = {
+    'temperatura': ('T', 1),
+    # vorticidad (recortada en el mismo arreglo), la máscara de turbulencia (bool) y al finalizar una copia de
+    # trabajo a la vez: la de los percentiles o la de los NaN en cero
+    'vorticidad': ('W', 2.25),
+    'perfil': ('T', 0),
+    'estabilidad': ('T', 2),  # N² y Ri (no se acumulan si se escribe NetCDF)
+    'espectros': ('T', 0),  # solo espectros por nivel y bloque, despreciables frente a los campos
+    'descomposicion': ('T', 0),  # las medias ocupan un solo tiempo y los campos se escriben a disco por bloques
+    'corriente': ('T', 1),
+    'vortices': ('W', 6),  # intensidad y máscara de cada uno de los tres criterios
+}
+
+# diagnósticos que grafican al finalizar un corte (nivel, west_east) con contourf; las figuras se hacen de a
+# una, así que cuenta un solo corte. contourf con 50 niveles ocupa unos 500 bytes por punto del corte en
+# campos de WRF (medido con tracemalloc; un campo tan irregular como ruido blanco llega al doble), más que
+# varios campos completos en corridas cortas
+CORTES_GRAFICADOS = ('temperatura', 'vorticidad', 'corriente')
+BYTES_GRAFICA_POR_PUNTO = 512
+
+# con --procesos los bloques leídos se copian a memoria compartida (una copia más del bloque en el proceso
+# principal) y cada proceso de diagnósticos calcula sus propios derivados del bloque: altura, U interpolada
+# y cortante, sobre la variable de referencia. La estimación es entonces la del conjunto de procesos
+DERIVADOS_POR_PROCESO = ('W', 3)
+
+HALO_NIVELES = 1  # niveles extra que necesitan las diferencias centradas en la vertical
+
+# diagnósticos que resuelven la columna entera a la vez y no admiten bloques de niveles
+COLUMNA_COMPLETA = ('corriente',)
+
+
+def memoria_disponible():
+    # memoria disponible del sistema en bytes, o None si no se puede saber
+    try:
+        with open('/proc/meminfo') as f:
+            for linea in f:
+                if linea.startswith('MemAvailable:'):
+                    return int(linea.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def _bytes_por_nivel(variable, n_we=None):
+    # bytes en memoria de un tiempo y un nivel de la variable (tiempo, nivel, south_north, west_east), en
+    # la precisión de cálculo; con n_we se cuenta solo esa ventana de west_east (más el punto extra si la
+    # variable es escalonada en x)
+    forma = list(variable.shape[2:])
+    if n_we is not None:
+        forma[-1] = n_we + int(variable.dimensions[-1].endswith('_stag'))
+    return math.prod(forma) * lectura.tamano_valor(variable)
+
+
+def _niveles_leidos(variable, tam_niveles, n_niveles):
+    # niveles que se leen de una variable para un bloque, contando el halo y el nivel escalonado extra
+    leidos = min(tam_niveles + 2 * HALO_NIVELES, n_niveles)
+    return leidos + 1 if variable.dimensions[1].endswith('_stag') else leidos
+
+
+def estimar_memoria(datos, nombres, tam_tiempo, tam_niveles, n_tiempos, n_niveles, anticipar=0, n_we=None,
+                    procesos=1):
+    # desglose en bytes de la memoria pico: lectura del bloque, temporales por bloque, resultados acumulados
+    # (con las copias de trabajo al finalizar) y la gráfica de un corte; con lectura anticipada hay hasta
+    # anticipar bloques leídos esperando además del que se calcula, y con procesos > 1 la copia en memoria
+    # compartida y los derivados de cada proceso (ver DERIVADOS_POR_PROCESO)
+    variables = datos.variables
+    procesos = min(procesos, len(nombres)) if procesos > 1 else 1
+    lectura_bloque = (1 + anticipar + int(procesos > 1)) * sum(
+        tam_tiempo * _niveles_leidos(variables[v], tam_niveles, n_niveles) * _bytes_por_nivel(variables[v], n_we)
+        for v in lectura.variables_necesarias(nombres))
+    temporales = 0
+    acumulados = 0
+    for nombre in nombres:
+        referencia, factor = TEMPORALES_POR_DIAGNOSTICO[nombre]
+        temporales += (factor * tam_tiempo * _niveles_leidos(variables[referencia], tam_niveles, n_niveles)
+                       * _bytes_por_nivel(variables[referencia], n_we))
+        referencia, factor = ACUMULADOS_POR_DIAGNOSTICO[nombre]
+        niveles_referencia = n_niveles + 1 if variables[referencia].dimensions[1].endswith('_stag') else n_niveles
+        acumulados += int(factor * n_tiempos * niveles_referencia * _bytes_por_nivel(variables[referencia], n_we))
+    if procesos > 1:
+        referencia, factor = DERIVADOS_POR_PROCESO
+        temporales += (procesos * factor * tam_tiempo * _niveles_leidos(variables[referencia], tam_niveles, n_niveles)
+                       * _bytes_por_nivel(variables[referencia], n_we))
+    graficas = 0
+    if any(nombre in CORTES_GRAFICADOS for nombre in nombres):
+        ancho = variables['W'].shape[-1] if n_we is None else n_we
+        graficas = BYTES_GRAFICA_POR_PUNTO * (n_niveles + 1) * ancho
+    return {'lectura': lectura_bloque, 'temporales': temporales, 'acumulados': acumulados, 'graficas': graficas,
+            'total': lectura_bloque + temporales + acumulados + graficas}
+
+
+class Plan:
+    # tamaños de bloque elegidos y memoria estimada; se puede imprimir o guardar como JSON
+
+    def __init__(self, diagnosticos, n_tiempos, n_niveles, bloque_tiempo, bloque_niveles, memoria, memoria_objetivo):
+        self.diagnosticos = list(diagnosticos)
+        self.n_tiempos = n_tiempos
+        self.n_niveles = n_niveles
+        self.bloque_tiempo = bloque_tiempo
+        self.bloque_niveles = bloque_niveles
+        self.memoria = memoria
+        self.memoria_objetivo = memoria_objetivo
+
+    @property
+    def memoria_estimada(self):
+        return self.memoria['total']
+
+    @property
+    def cabe(self):
+        return self.memoria_objetivo is None or self.memoria_estimada <= self.memoria_objetivo
+
+    def como_dict(self):
+        return {
+            'diagnosticos': self.diagnosticos,
+            'n_tiempos': self.n_tiempos,
+            'n_niveles': self.n_niveles,
+            'bloque_tiempo': self.bloque_tiempo,
+            'bloque_niveles': self.bloque_niveles,
+            'memoria': self.memoria,
+            'memoria_objetivo': self.memoria_objetivo,
+            'cabe': self.cabe,
+        }
+
+    def como_json(self):
+        return json.dumps(self.como_dict(), indent=2)
+
+    def __str__(self):
+        objetivo = 'sin límite' if self.memoria_objetivo is None else f'{self.memoria_objetivo / 2**20:.1f} MiB'
+        texto = (f"Plan: bloques de {self.bloque_tiempo} tiempos x {self.bloque_niveles} niveles "
+                 f"({self.n_tiempos} tiempos, {self.n_niveles} niveles), "
+                 f"memoria estimada {self.memoria_estimada / 2**20:.1f} MiB "
+                 f"(lectura {self.memoria['lectura'] / 2**20:.1f}, "
+                 f"temporales {self.memoria['temporales'] / 2**20:.1f}, "
+                 f"acumulados {self.memoria['acumulados'] / 2**20:.1f}, "
+                 f"gráficas {self.memoria['graficas'] / 2**20:.1f}), objetivo {objetivo}")
+        if not self.cabe:
+            texto += ("\nAviso: los resultados acumulados y las gráficas no caben en el objetivo aun con "
+                      "bloques mínimos")
+        return texto
+
+
+def _mayor_que_cabe(costo, maximo, objetivo):
+    # mayor valor entre 1 y maximo cuyo costo no supera el objetivo (el costo crece con el valor)
+    if costo(maximo) <= objetivo:
+        return maximo
+    inferior, superior = 1, maximo
+    while inferior < superior:
+        medio = (inferior + superior + 1) // 2
+        if costo(medio) <= objetivo:
+            inferior = medio
+        else:
+            superior = medio - 1
+    return inferior
+
+
+def planificar(datos, nombres, n_tiempos, n_niveles=None, memoria_objetivo=None, fraccion_disponible=0.5,
+               bloque_tiempo=None, bloque_niveles=None, anticipar=0, n_we=None, procesos=1):
+    # elige bloques de tiempos y de niveles para que la memoria pico quede bajo memoria_objetivo;
+    # primero se reducen los tiempos por bloque y solo si un tiempo no cabe se parten los niveles;
+    # n_we es el ancho leído en west_east si hay una ventana en x y procesos los de --procesos
+    if n_niveles is None:
+        n_niveles = len(datos.dimensions['bottom_top'])
+    if memoria_objetivo is None:
+        disponible = memoria_disponible()
+        memoria_objetivo = None if disponible is None else int(disponible * fraccion_disponible)
+
+    def costo(tam_tiempo, tam_niveles):
+        return estimar_memoria(datos, nombres, tam_tiempo, tam_niveles, n_tiempos, n_niveles, anticipar, n_we,
+                               procesos)['total']
+
+    if any(nombre in COLUMNA_COMPLETA for nombre in nombres):
+        if bloque_niveles not in (None, n_niveles):
+            raise ValueError(f"{', '.join(n for n in nombres if n in COLUMNA_COMPLETA)} necesita columnas "
+                             "completas; no se puede usar bloque_niveles")
+        bloque_niveles = n_niveles
+
+    if bloque_niveles is None:
+        bloque_niveles = n_niveles
+        if memoria_objetivo is not None and bloque_tiempo in (None, 1) and costo(1, n_niveles) > memoria_objetivo:
+            bloque_niveles = _mayor_que_cabe(lambda tam: costo(1, tam), n_niveles, memoria_objetivo)
+    if bloque_tiempo is None:
+        bloque_tiempo = n_tiempos if memoria_objetivo is None else _mayor_que_cabe(
+            lambda tam: costo(tam, bloque_niveles), max(n_tiempos, 1), memoria_objetivo)
+
+    bloque_tiempo = max(1, min(bloque_tiempo, n_tiempos))
+    bloque_niveles = max(1, min(bloque_niveles, n_niveles))
+    memoria = estimar_memoria(datos, nombres, bloque_tiempo, bloque_niveles, n_tiempos, n_niveles, anticipar, n_we,
+                              procesos)
+    return Plan(nombres, n_tiempos, n_niveles, bloque_tiempo, bloque_niveles, memoria, memoria_objetivo)
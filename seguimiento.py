@@ -0,0 +1,255 @@
+import copy
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+
+import diagnosticos
+import escritura
+import geometria
+import graficos
+import lectura
+import tablas
+
+VARIABLES = ('U', 'W', 'PH', 'PHB')
+CASILLAS_POR_LADO = 4096  # casillas del histograma entre 0 y el mayor |percentil 1/99| del primer lote
+MAX_CASILLAS = 1 << 22  # los valores más allá caen en las casillas extremas
+
+
+def registro_completo(datos, tiempo):
+    # True si todas las VARIABLES del registro ya se escribieron. WRF escribe cada variable de un registro de
+    # una vez y lo que falta queda con el valor de relleno, que la lectura devuelve como NaN: alcanza con
+    # mirar el último punto de cada variable
+    n_niveles = len(datos.dimensions['bottom_top'])
+    n_we = len(datos.dimensions['west_east'])
+    ultimos = lectura.leer_bloque(datos, VARIABLES, slice(tiempo, tiempo + 1), slice(n_niveles - 1, n_niveles),
+                                  slice(n_we - 1, n_we))
+    return not any(np.isnan(valores[..., -1, -1, -1]) for valores in ultimos.values())
+
+
+class HistogramaAcumulado:
+    # histograma de ancho fijo que se extiende cuando llegan valores fuera de su rango; da los percentiles
+    # de todos los tiempos vistos con un error menor que una casilla sin guardar los valores
+
+    def __init__(self, ancho, inicio=0, conteos=None, nan=0):
+        self.ancho = ancho
+        self.inicio = inicio  # índice floor(valor / ancho) de la primera casilla
+        self.conteos = np.zeros(0, dtype=np.int64) if conteos is None else conteos
+        self.nan = nan
+
+    @classmethod
+    def para(cls, valores):
+        # ancho elegido con el primer lote de valores
+        valores = np.asarray(valores)
+        finitos = valores[np.isfinite(valores)]
+        escala = float(np.abs(np.percentile(finitos, [1, 99])).max()) if finitos.size else 0.0
+        return cls(escala / CASILLAS_POR_LADO if escala > 0 else 1e-12)
+
+    @classmethod
+    def cargar(cls, ruta):
+        with np.load(ruta) as archivo:
+            return cls(float(archivo['ancho']), int(archivo['inicio']), archivo['conteos'], int(archivo['nan']))
+
+    def copia(self):
+        return HistogramaAcumulado(self.ancho, self.inicio, self.conteos.copy(), self.nan)
+
+    def guardar(self, ruta):
+        temporal = Path(ruta).with_suffix('.tmp.npz')
+        np.savez(temporal, ancho=self.ancho, inicio=self.inicio, conteos=self.conteos, nan=self.nan)
+        temporal.replace(ruta)
+
+    def agregar(self, valores):
+        valores = np.asarray(valores, dtype=np.float64).ravel()
+        finitos = np.isfinite(valores)
+        self.nan += int(valores.size - np.count_nonzero(finitos))
+        indices = np.clip(np.floor(valores[finitos] / self.ancho), -(MAX_CASILLAS // 2), MAX_CASILLAS // 2 - 1)
+        if not indices.size:
+            return
+        indices = indices.astype(np.int64)
+        self._extender(int(indices.min()), int(indices.max()) + 1)
+        self.conteos += np.bincount(indices - self.inicio, minlength=self.conteos.size)
+
+    def _extender(self, inicio, fin):
+        if not self.conteos.size:
+            self.inicio = inicio
+            self.conteos = np.zeros(fin - inicio, dtype=np.int64)
+            return
+        antes = max(self.inicio - inicio, 0)
+        despues = max(fin - (self.inicio + self.conteos.size), 0)
+        if antes or despues:
+            self.conteos = np.pad(self.conteos, (antes, despues))
+            self.inicio -= antes
+
+    def percentil(self, p, ceros=0):
+        # percentil p (0-100) de los valores finitos, con ceros valores 0 extra (los NaN que nan_to_num
+        # convierte en 0 antes del umbral); None si no hay datos
+        conteos = self.conteos
+        inicio = self.inicio
+        if ceros:
+            antes = max(inicio, 0)
+            despues = max(1 - (inicio + conteos.size), 0)
+            conteos = np.pad(conteos, (antes, despues))
+            inicio -= antes
+            conteos[-inicio] += ceros
+        total = int(conteos.sum())
+        if not total:
+            return None
+        acumulado = np.cumsum(conteos)
+        # misma posición que la interpolación lineal de np.percentile, con los valores repartidos
+        # uniformemente dentro de cada casilla
+        objetivo = p / 100 * (total - 1)
+        k = int(np.searchsorted(acumulado, objetivo, side='right'))
+        previo = acumulado[k - 1] if k else 0
+        fraccion = min((objetivo - previo + 0.5) / conteos[k], 1.0)
+        return (inicio + k + fraccion) * self.ancho
+
+
+class Seguimiento:
+    # vorticidad de una corrida que todavía escribe su salida. El estado en el directorio guarda los tiempos
+    # ya procesados, el histograma de la vorticidad cruda y los límites y el umbral vigentes; cada
+    # actualización procesa solo los tiempos agregados desde la anterior. La vorticidad cruda se anexa a
+    # derivados.nc, las zonas de turbulencia de cada tiempo usan el umbral vigente al procesarlo (queda en
+    # la tabla) y solo se grafican los tiempos nuevos
+
+    def __init__(self, ruta_archivo, directorio, umbral=None, umbral_percentil=75, percentiles=(1, 99),
+                 bloque=1, anticipar=1, graficar=True, reiniciar=False):
+        self.ruta_archivo = ruta_archivo
+        self.directorio = Path(directorio)
+        self.directorio.mkdir(parents=True, exist_ok=True)
+        self.umbral = umbral
+        self.umbral_percentil = umbral_percentil
+        self.percentiles = percentiles
+        self.bloque = bloque
+        self.anticipar = anticipar
+        self.graficar = graficar
+        self.ruta_estado = self.directorio / 'seguimiento.json'
+        self.ruta_histograma = self.directorio / 'histograma_vorticidad.npz'
+        self.ruta_tabla = self.directorio / 'estadisticas_vorticidad.csv'
+        self.ruta_derivados = self.directorio / 'derivados.nc'
+        if reiniciar:
+            for ruta in (self.ruta_estado, self.ruta_histograma, self.ruta_tabla, self.ruta_derivados):
+                ruta.unlink(missing_ok=True)
+
+        self.estado = {'archivo': str(ruta_archivo), 'procesados': 0, 'tiempos': [], 'medias': [], 'umbrales': []}
+        if self.ruta_estado.exists():
+            with open(self.ruta_estado) as f:
+                self.estado = json.load(f)
+        self.histograma = HistogramaAcumulado.cargar(self.ruta_histograma) if self.ruta_histograma.exists() else None
+
+    def _guardar(self, histograma, estado):
+        # el estado del objeto cambia solo cuando el del directorio ya se escribió; si algo falla antes, el
+        # reintento de seguir() parte del mismo estado y no cuenta dos veces los tiempos en el histograma
+        histograma.guardar(self.ruta_histograma)
+        temporal = self.ruta_estado.with_suffix('.tmp')
+        with open(temporal, 'w') as f:
+            json.dump(estado, f, indent=2)
+        temporal.replace(self.ruta_estado)
+        self.histograma = histograma
+        self.estado = estado
+
+    def limites(self, histograma=None):
+        histograma = self.histograma if histograma is None else histograma
+        return tuple(histograma.percentil(p) for p in self.percentiles)
+
+    def actualizar(self):
+        # procesa los tiempos nuevos del archivo y devuelve sus índices
+        datos = lectura.obtener_datos(self.ruta_archivo)
+        escritor = None
+        try:
+            total = len(datos.dimensions['Time'])
+            procesados = self.estado['procesados']
+            if total < procesados:
+                raise ValueError(f"{self.ruta_archivo} tiene {total} tiempos pero ya se procesaron {procesados}; "
+                                 "usar --reiniciar si la corrida se reemplazó")
+            # el último registro puede estar a medio escribir: se procesa cuando aparece uno posterior o
+            # cuando todas sus variables ya tienen datos
+            listos = total if total > procesados and registro_completo(datos, total - 1) else total - 1
+            nuevos = list(range(procesados, listos))
+            if not nuevos:
+                return []
+
+            # copias de trabajo del histograma y del estado: se asignan en _guardar
+            histograma = None if self.histograma is None else self.histograma.copia()
+            estado = copy.deepcopy(self.estado)
+            malla = geometria.GeometriaMalla.desde_archivo(datos)
+            escritor = escritura.EscritorDerivados(self.ruta_derivados, datos, 0, len(datos.dimensions['bottom_top']),
+                                                   anexar=True)
+            # primera vuelta: vorticidad cruda de los tiempos nuevos al archivo y al histograma
+            niveles_altura = {}
+            for indices, bloque in lectura.iterar_bloques(datos, VARIABLES, nuevos, self.bloque,
+                                                          anticipar=self.anticipar):
+                campos = diagnosticos.CamposBloque(bloque, malla)
+                vorticidad = diagnosticos.vorticidad_cruda(campos['U'], campos['W'], malla.dx, campos.altura,
+                                                           du_dz=campos.cortante)
+                posiciones = slice(int(indices[0]), int(indices[-1]) + 1)
+                escritor.escribir_tiempos(posiciones, indices.tolist())
+                escritor.escribir('vorticidad_cruda', posiciones, vorticidad)
+                if histograma is None:
+                    histograma = HistogramaAcumulado.para(vorticidad)
+                histograma.agregar(vorticidad)
+                for i, tiempo in enumerate(indices):
+                    niveles_altura[int(tiempo)] = campos.geometria.niveles_altura[i]
+
+            # segunda vuelta, un tiempo a la vez: recorte y umbral con los límites actualizados
+            limites = self.limites(histograma)
+            umbral = self.umbral
+            if umbral is None:
+                umbral = histograma.percentil(self.umbral_percentil, ceros=histograma.nan)
+            escritor.atributos('vorticidad_cruda', percentil_inferior=float(self.percentiles[0]),
+                               percentil_superior=float(self.percentiles[1]), limite_inferior=limites[0],
+                               limite_superior=limites[1], umbral=umbral)
+            corrida = Path(self.ruta_archivo).resolve().parent.name
+            filas = []
+            for tiempo in nuevos:
+                cruda = np.asarray(escritor.datos.variables['vorticidad_cruda'][tiempo])
+                recortada = np.clip(cruda, *limites)
+                vorticidad = np.nan_to_num(recortada, nan=0.0)
+                zonas = vorticidad > umbral
+                escritor.escribir('zonas_turbulencia', tiempo, zonas.astype(np.uint8))
+
+                columnas = tablas.estadisticas_tiempo_nivel(recortada[None], zonas[None], [tiempo], corrida,
+                                                            Path(self.ruta_archivo).name)
+                columnas['umbral'] = np.full(len(columnas['tiempo']), umbral)
+                filas.append(columnas)
+                estado['tiempos'].append(tiempo)
+                estado['medias'].append(float(np.nanmean(vorticidad)))
+                estado['umbrales'].append(umbral)
+                if self.graficar:
+                    graficos.graficar_vorticidad_2d(vorticidad.mean(axis=1), niveles_altura[tiempo], malla, tiempo,
+                                                    ruta_salida=self.directorio / f'vorticidad_t{tiempo:03d}.png')
+            graficos.graficar_evolucion_vorticidad(estado['tiempos'], estado['medias'],
+                                                   ruta_salida=self.directorio / 'evolucion_vorticidad.png')
+            # la tabla se anexa de una vez al final, junto con el estado
+            tablas.anexar_tabla(self.ruta_tabla, {clave: np.concatenate([columnas[clave] for columnas in filas])
+                                                  for clave in filas[0]})
+        finally:
+            if escritor is not None:
+                escritor.cerrar()
+            datos.close()
+
+        estado['procesados'] = listos
+        self._guardar(histograma, estado)
+        print(f"Tiempos {nuevos[0]}-{nuevos[-1]} procesados; límites {limites[0]:.4g} a {limites[1]:.4g}, "
+              f"umbral {umbral:.4g}")
+        return nuevos
+
+
+def seguir(seguimientos, intervalo=60.0, una_vez=False):
+    # revisa los archivos cada intervalo segundos hasta Ctrl-C; mientras WRF escribe, abrir un archivo
+    # puede fallar y se reintenta en la siguiente vuelta
+    try:
+        while True:
+            for seguido in seguimientos:
+                try:
+                    seguido.actualizar()
+                except OSError as e:
+                    if una_vez:
+                        raise
+                    print(f"Aviso: no se pudo leer {seguido.ruta_archivo} ({e}); se reintenta")
+            if una_vez:
+                return
+            time.sleep(intervalo)
+    except KeyboardInterrupt:
+        for seguido in seguimientos:
+            print(f"{seguido.ruta_archivo}: seguimiento detenido con {seguido.estado['procesados']} tiempos procesados")
@@ -0,0 +1,228 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+import diagnosticos
+import geometria
+import graficos
+import lectura
+import vortices
+
+# campos calculados que se sirven además de las variables del archivo: variables que leen, unidades y cálculo
+# sobre los CamposBloque de un tiempo
+CAMPOS_DERIVADOS = {
+    'vorticidad': (('U', 'W', 'PH', 'PHB'), 's-1',
+                   lambda campos, malla: diagnosticos.vorticidad_cruda(campos['U'], campos['W'], malla.dx,
+                                                                       campos.altura, du_dz=campos.cortante)),
+    'temperatura_real': (('T', 'P', 'PB', 'PH', 'PHB'), 'K',
+                         lambda campos, malla: diagnosticos.procesar_campo_temperatura(
+                             campos['T'], campos['P'], campos['PB'], campos.altura, campos.geometria.altura_masa)[0]),
+    'altura': (('PH', 'PHB'), 'm', lambda campos, malla: campos.altura),
+}
+for _criterio in vortices.CRITERIOS:
+    CAMPOS_DERIVADOS[f'criterio_{_criterio}'] = (
+        ('U', 'W', 'PH', 'PHB'), '',
+        lambda campos, malla, criterio=_criterio: vortices.CRITERIOS[criterio](vortices.tensor_velocidad(
+            campos.u_interpolada, campos['W'], malla.dx, campos.altura, du_dz=campos.cortante,
+            espesores=campos.geometria.espesores_dz)))
+
+PAGINA = '''<!doctype html>
+<meta charset="utf-8"><title>Titán</title>
+<select id="variable"></select>
+<input id="tiempo" type="range" min="0" max="{maximo}" value="0" style="width:60%"> <span id="etiqueta">0</span>
+<br><img id="imagen">
+<script>
+const variable = document.getElementById('variable'), tiempo = document.getElementById('tiempo');
+function mostrar() {{
+  document.getElementById('etiqueta').textContent = tiempo.value;
+  document.getElementById('imagen').src = `/corte?variable=${{variable.value}}&tiempo=${{tiempo.value}}&formato=png`;
+}}
+fetch('/variables').then(r => r.json()).then(lista => {{
+  for (const nombre of lista.variables) variable.add(new Option(nombre, nombre));
+  variable.value = 'vorticidad';
+  mostrar();
+}});
+variable.onchange = tiempo.oninput = mostrar;
+</script>
+'''
+
+
+class CacheLRU:
+    # caché de capacidad en bytes que descarta lo usado hace más tiempo; segura entre hilos. Dos pedidos
+    # simultáneos de la misma clave pueden calcularla dos veces, pero nunca se bloquean entre sí
+
+    def __init__(self, capacidad):
+        self.capacidad = capacidad
+        self.entradas = OrderedDict()
+        self.ocupado = 0
+        self.aciertos = 0
+        self.fallos = 0
+        self.candado = threading.Lock()
+
+    @staticmethod
+    def _tamano(valor):
+        if isinstance(valor, (bytes, np.ndarray)):
+            return len(valor) if isinstance(valor, bytes) else valor.nbytes
+        return sum(CacheLRU._tamano(parte) for parte in valor)
+
+    def obtener(self, clave, calcular):
+        with self.candado:
+            if clave in self.entradas:
+                self.entradas.move_to_end(clave)
+                self.aciertos += 1
+                return self.entradas[clave][0]
+            self.fallos += 1
+        valor = calcular()
+        tamano = self._tamano(valor)
+        with self.candado:
+            if clave not in self.entradas:
+                self.entradas[clave] = (valor, tamano)
+                self.ocupado += tamano
+            while self.ocupado > self.capacidad and len(self.entradas) > 1:
+                _, (_, descartado) = self.entradas.popitem(last=False)
+                self.ocupado -= descartado
+        return valor
+
+
+class ServicioCortes:
+    # mantiene el archivo abierto y entrega cortes x-z (promediados en south_north) de cualquier variable y
+    # tiempo. El corte completo de cada (variable, tiempo) y cada imagen generada quedan en la caché, así que
+    # mover la ventana o volver a un tiempo ya visto no vuelve a leer ni a calcular
+
+    def __init__(self, ruta_archivo, capacidad=256 * 2**20):
+        self.ruta_archivo = ruta_archivo
+        self.datos = lectura.obtener_datos(ruta_archivo)
+        self.malla = geometria.GeometriaMalla.desde_archivo(self.datos)
+        self.n_tiempos = len(self.datos.dimensions['Time'])
+        self.cache = CacheLRU(capacidad)
+
+    def variables(self):
+        # derivados y variables del archivo con forma (Time, nivel, south_north, west_east)
+        propias = [nombre for nombre, variable in self.datos.variables.items()
+                   if variable.ndim == 4 and variable.dimensions[0] == 'Time']
+        return list(CAMPOS_DERIVADOS) + propias
+
+    def _calcular_corte(self, variable, tiempo):
+        if variable in CAMPOS_DERIVADOS:
+            necesarias, _, calcular = CAMPOS_DERIVADOS[variable]
+        elif variable in self.variables():
+            necesarias, calcular = (variable, 'PH', 'PHB'), lambda campos, malla: campos[variable]
+        else:
+            raise ValueError(f"variable desconocida: {variable}")
+        bloque = lectura.leer_bloque(self.datos, dict.fromkeys(necesarias), slice(tiempo, tiempo + 1))
+        campos = diagnosticos.CamposBloque(bloque, self.malla)
+        valores = np.asarray(calcular(campos, self.malla), dtype=np.float32)[0].mean(axis=1)
+
+        # coordenadas según la malla de la variable: niveles escalonados o de masa, puntos de U o de masa
+        z = campos.geometria.niveles_altura[0]
+        if valores.shape[0] != len(z):
+            z = (z[:-1] + z[1:]) / 2
+        x = self.malla.distancia_u if valores.shape[1] == self.malla.n_we + 1 else self.malla.distancia
+        return valores, x.astype(np.float32), z.astype(np.float32)
+
+    def corte(self, variable, tiempo, x=slice(None), niveles=slice(None)):
+        if not 0 <= tiempo < self.n_tiempos:
+            raise ValueError(f"tiempo fuera de rango: {tiempo} (hay {self.n_tiempos})")
+        valores, coord_x, coord_z = self.cache.obtener(('corte', variable, tiempo),
+                                                      lambda: self._calcular_corte(variable, tiempo))
+        return valores[niveles, x], coord_x[x], coord_z[niveles]
+
+    def imagen(self, variable, tiempo, x=slice(None), niveles=slice(None)):
+        def dibujar():
+            valores, coord_x, coord_z = self.corte(variable, tiempo, x, niveles)
+            vmin, vmax = np.nanpercentile(valores, [5, 95]) if np.isfinite(valores).any() else (None, None)
+            unidades = CAMPOS_DERIVADOS[variable][1] if variable in CAMPOS_DERIVADOS else \
+                getattr(self.datos.variables[variable], 'units', '')
+            return graficos.imagen_corte(valores, coord_x, coord_z, f'{variable} (tiempo {tiempo})',
+                                         f'{variable} ({unidades})' if unidades else variable, vmin, vmax)
+        clave = ('imagen', variable, tiempo, x.start, x.stop, niveles.start, niveles.stop)
+        return self.cache.obtener(clave, dibujar)
+
+    def cerrar(self):
+        self.datos.close()
+
+
+def _rango(parametros, inicio, fin):
+    # slice de los parámetros inicio:fin de la consulta; los que faltan quedan abiertos
+    return slice(*(int(parametros[nombre][0]) if nombre in parametros else None for nombre in (inicio, fin)))
+
+
+def crear_manejador(servicio):
+    class Manejador(BaseHTTPRequestHandler):
+        # GET /              página para recorrer los tiempos
+        # GET /variables     variables disponibles y número de tiempos
+        # GET /corte?variable=vorticidad&tiempo=18[&i0=&i1=&k0=&k1=][&formato=json|bin|png]
+        #     i0:i1 índices en west_east y k0:k1 niveles; bin devuelve float32 con la forma en cabeceras
+
+        def _responder(self, cuerpo, tipo, inicio, cabeceras=None, estado=200):
+            self.send_response(estado)
+            self.send_header('Content-Type', tipo)
+            self.send_header('Content-Length', str(len(cuerpo)))
+            self.send_header('X-Tiempo-ms', f'{(time.perf_counter() - inicio) * 1000:.1f}')
+            for clave, valor in (cabeceras or {}).items():
+                self.send_header(clave, valor)
+            self.end_headers()
+            self.wfile.write(cuerpo)
+
+        def _json(self, contenido, inicio, estado=200):
+            self._responder(json.dumps(contenido).encode(), 'application/json', inicio, estado=estado)
+
+        def do_GET(self):
+            inicio = time.perf_counter()
+            url = urlparse(self.path)
+            parametros = parse_qs(url.query)
+            try:
+                if url.path == '/':
+                    pagina = PAGINA.format(maximo=servicio.n_tiempos - 1)
+                    self._responder(pagina.encode(), 'text/html; charset=utf-8', inicio)
+                elif url.path == '/variables':
+                    self._json({'archivo': str(servicio.ruta_archivo), 'tiempos': servicio.n_tiempos,
+                                'variables': servicio.variables()}, inicio)
+                elif url.path == '/corte':
+                    variable = parametros['variable'][0]
+                    tiempo = int(parametros['tiempo'][0])
+                    x, niveles = _rango(parametros, 'i0', 'i1'), _rango(parametros, 'k0', 'k1')
+                    formato = parametros.get('formato', ['json'])[0]
+                    if formato == 'png':
+                        self._responder(servicio.imagen(variable, tiempo, x, niveles), 'image/png', inicio)
+                        return
+                    valores, coord_x, coord_z = servicio.corte(variable, tiempo, x, niveles)
+                    if formato == 'bin':
+                        self._responder(np.ascontiguousarray(valores, dtype='<f4').tobytes(),
+                                        'application/octet-stream', inicio,
+                                        {'X-Forma': ','.join(map(str, valores.shape)), 'X-Tipo': 'float32'})
+                    else:
+                        finitos = np.where(np.isfinite(valores), valores.astype(np.float64), None)
+                        self._json({'variable': variable, 'tiempo': tiempo, 'forma': list(valores.shape),
+                                    'x': coord_x.tolist(), 'z': coord_z.tolist(), 'valores': finitos.tolist()}, inicio)
+                else:
+                    self._json({'error': f'ruta desconocida: {url.path}'}, inicio, estado=404)
+            except KeyError as e:
+                self._json({'error': f'falta el parámetro {e.args[0]}'}, inicio, estado=400)
+            except (ValueError, IndexError) as e:
+                self._json({'error': str(e)}, inicio, estado=400)
+
+        def log_message(self, formato, *args):
+            pass
+
+    return Manejador
+
+
+def servir(ruta_archivo, puerto=8000, capacidad=256 * 2**20, direccion='127.0.0.1'):
+    # solo escucha en la máquina local; Ctrl-C para terminar
+    servicio = ServicioCortes(ruta_archivo, capacidad)
+    servidor = ThreadingHTTPServer((direccion, puerto), crear_manejador(servicio))
+    print(f"Sirviendo {ruta_archivo} en http://{direccion}:{servidor.server_port}/")
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        servidor.server_close()
+        print(f"Caché: {servicio.cache.aciertos} aciertos, {servicio.cache.fallos} fallos")
+        servicio.cerrar()
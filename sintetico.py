@@ -0,0 +1,131 @@
+import argparse
+
+import netCDF4 as nc
+import numpy as np
+
+import diagnosticos
+
+# atributos de las variables como los escribe WRF
+ATRIBUTOS = {
+    'U': ('x-wind component', 'm s-1', 'X'),
+    'W': ('z-wind component', 'm s-1', 'Z'),
+    'T': ('perturbation potential temperature (theta-t0)', 'K', ''),
+    'P': ('perturbation pressure', 'Pa', ''),
+    'PB': ('BASE STATE PRESSURE', 'Pa', ''),
+    'PH': ('perturbation geopotential', 'm2 s-2', 'Z'),
+    'PHB': ('base-state geopotential', 'm2 s-2', 'Z'),
+}
+
+DIMENSIONES = {
+    'U': ('Time', 'bottom_top', 'south_north', 'west_east_stag'),
+    'W': ('Time', 'bottom_top_stag', 'south_north', 'west_east'),
+    'T': ('Time', 'bottom_top', 'south_north', 'west_east'),
+    'P': ('Time', 'bottom_top', 'south_north', 'west_east'),
+    'PB': ('Time', 'bottom_top', 'south_north', 'west_east'),
+    'PH': ('Time', 'bottom_top_stag', 'south_north', 'west_east'),
+    'PHB': ('Time', 'bottom_top_stag', 'south_north', 'west_east'),
+}
+
+
+def interpretar_tamano(texto):
+    # '43x100x1x2000' -> (tiempos, niveles, south_north, west_east)
+    partes = tuple(int(x) for x in texto.lower().split('x'))
+    if len(partes) != 4 or min(partes) < 1:
+        raise ValueError(f"tamaño inválido '{texto}', se espera tiempos x niveles x south_north x west_east")
+    return partes
+
+
+def _campos_tiempo(t, n_niveles, n_sn, n_we, dx, z_stag, rng):
+    # campos de un paso de tiempo con cortante, ondas y ruido para que los diagnósticos no sean triviales
+    x = (np.arange(n_we + 1) * dx)[None, None, :]
+    z_masa = ((z_stag[:-1] + z_stag[1:]) / 2)[:, None, None]
+    z = z_stag[:, None, None]
+    fase = 2 * np.pi * t / 40
+    longitud = max(n_we * dx / 8, dx)
+    tope = z_stag[-1]
+
+    u = 2.0 * z_masa / tope + 0.5 * np.sin(2 * np.pi * x / longitud - fase) * np.cos(np.pi * z_masa / tope)
+    w = 0.1 * np.sin(2 * np.pi * x[..., :-1] / longitud - fase) * np.sin(np.pi * z / tope)
+    ptp = -6.0 + 10.0 * z_masa / tope + 0.2 * np.cos(2 * np.pi * x[..., :-1] / longitud - fase)
+    pb = 1.46e5 * np.exp(-z_masa / 20000.0) * np.ones_like(x[..., :-1])
+    pp = 50.0 * np.sin(2 * np.pi * x[..., :-1] / longitud - fase) * np.exp(-z_masa / tope)
+    phb = z * diagnosticos.g_titan * np.ones_like(x[..., :-1])
+    ph = 0.5 * np.sin(2 * np.pi * x[..., :-1] / longitud - fase) * np.sin(np.pi * z / tope)
+
+    campos = {
+        'U': np.broadcast_to(u, (n_niveles, n_sn, n_we + 1)),
+        'W': np.broadcast_to(w, (n_niveles + 1, n_sn, n_we)),
+        'T': np.broadcast_to(ptp, (n_niveles, n_sn, n_we)),
+        'P': np.broadcast_to(pp, (n_niveles, n_sn, n_we)),
+        'PB': np.broadcast_to(pb, (n_niveles, n_sn, n_we)),
+        'PH': np.broadcast_to(ph, (n_niveles + 1, n_sn, n_we)),
+        'PHB': np.broadcast_to(phb, (n_niveles + 1, n_sn, n_we)),
+    }
+    for nombre in ('U', 'W', 'T'):
+        campos[nombre] = campos[nombre] + rng.normal(scale=0.05, size=campos[nombre].shape)
+    return campos
+
+
+def generar_archivo(ruta, n_tiempos=43, n_niveles=100, n_sn=1, n_we=2000, dx=100.0, dy=100.0, tope=30000.0,
+                    semilla=0, comprimir=False):
+    # archivo netCDF con las variables, el escalonamiento y los atributos de una salida WRF de Titán;
+    # se escribe un tiempo a la vez para poder generar mallas grandes con poca memoria
+    rng = np.random.default_rng(semilla)
+    # niveles más finos cerca de la superficie, como en las corridas reales
+    eta = np.linspace(0.0, 1.0, n_niveles + 1)
+    z_stag = tope * (0.4 * eta + 0.6 * eta ** 2)
+
+    datos = nc.Dataset(ruta, 'w', format='NETCDF4' if comprimir else 'NETCDF3_64BIT_OFFSET')
+    try:
+        datos.createDimension('Time', None)
+        datos.createDimension('DateStrLen', 19)
+        datos.createDimension('bottom_top', n_niveles)
+        datos.createDimension('bottom_top_stag', n_niveles + 1)
+        datos.createDimension('south_north', n_sn)
+        datos.createDimension('west_east', n_we)
+        datos.createDimension('west_east_stag', n_we + 1)
+        datos.DX = np.float32(dx)
+        datos.DY = np.float32(dy)
+        datos.TITLE = 'salida sintética con la estructura de WRF para pruebas de rendimiento'
+
+        tiempos = datos.createVariable('Times', 'S1', ('Time', 'DateStrLen'))
+        variables = {}
+        for nombre, dims in DIMENSIONES.items():
+            opciones = {'zlib': True, 'complevel': 1} if comprimir else {}
+            variable = datos.createVariable(nombre, 'f4', dims, **opciones)
+            descripcion, unidades, stagger = ATRIBUTOS[nombre]
+            variable.FieldType = np.int32(104)
+            variable.MemoryOrder = 'XYZ'
+            variable.description = descripcion
+            variable.units = unidades
+            variable.stagger = stagger
+            variables[nombre] = variable
+
+        for t in range(n_tiempos):
+            segundos = t * 600
+            marca = f'2000-01-01_{segundos // 3600:02d}:{segundos % 3600 // 60:02d}:00'
+            tiempos[t] = nc.stringtochar(np.array([marca], dtype='S19'))[0]
+            for nombre, valores in _campos_tiempo(t, n_niveles, n_sn, n_we, dx, z_stag, rng).items():
+                variables[nombre][t] = valores.astype(np.float32)
+    finally:
+        datos.close()
+    return ruta
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generar un archivo netCDF sintético con estructura WRF')
+    parser.add_argument('ruta', help='archivo de salida')
+    parser.add_argument('--tamano', default='43x100x1x2000', help='tiempos x niveles x south_north x west_east')
+    parser.add_argument('--dx', type=float, default=100.0, help='resolución en x (m)')
+    parser.add_argument('--semilla', type=int, default=0)
+    parser.add_argument('--comprimir', action='store_true', help='escribir NetCDF4 comprimido')
+    args = parser.parse_args(argv)
+
+    n_tiempos, n_niveles, n_sn, n_we = interpretar_tamano(args.tamano)
+    generar_archivo(args.ruta, n_tiempos, n_niveles, n_sn, n_we, dx=args.dx, dy=args.dx, semilla=args.semilla,
+                    comprimir=args.comprimir)
+    print(f"Archivo generado: {args.ruta} ({args.tamano})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import csv
+from pathlib import Path
+
+import numpy as np
+
+PERCENTILES = (1, 5, 10, 25, 50, 75, 90, 95, 99)
+
+
+def _estadisticas_filas(valores):
+    # count, media, desviación y percentiles de cada fila de valores (fila, punto) con NaN
+    validos = ~np.isnan(valores)
+    conteo = validos.sum(axis=1)
+    con_datos = conteo > 0
+    # las filas sin datos válidos quedan en NaN sin advertencias de nanmean
+    seguro = np.where(con_datos[:, None], valores, 0.0)
+    filas = {
+        'count': conteo,
+        'media': np.where(con_datos, np.nanmean(seguro, axis=1), np.nan),
+        'desviacion': np.where(con_datos, np.nanstd(seguro, axis=1), np.nan),
+    }
+    for p, valor in zip(PERCENTILES, np.nanpercentile(seguro, PERCENTILES, axis=1)):
+        filas[f'p{p}'] = np.where(con_datos, valor, np.nan)
+    return filas
+
+
+def estadisticas_tiempo_nivel(vorticidad, zonas_turbulencia, tiempos, corrida, archivo, nivel_inicio=0):
+    # tabla ordenada (una fila por tiempo y nivel) como diccionario de columnas; vorticidad recortada con
+    # sus NaN para que count y la fracción de datos válidos tengan sentido. Se calcula un tiempo a la vez:
+    # las copias de trabajo de nanstd y nanpercentile ocupan un tiempo y no el campo completo
+    n_tiempos, n_niveles = vorticidad.shape[:2]
+    valores = np.asarray(vorticidad).reshape(n_tiempos, n_niveles, -1)
+    por_tiempo = [_estadisticas_filas(valores[t]) for t in range(n_tiempos)]
+
+    columnas = {
+        'corrida': np.full(n_tiempos * n_niveles, corrida, dtype=object),
+        'archivo': np.full(n_tiempos * n_niveles, archivo, dtype=object),
+        'tiempo': np.repeat(np.asarray(tiempos), n_niveles),
+        'nivel': np.tile(np.arange(nivel_inicio, nivel_inicio + n_niveles), n_tiempos),
+    }
+    for nombre in por_tiempo[0]:
+        columnas[nombre] = np.concatenate([filas[nombre] for filas in por_tiempo])
+        if nombre == 'count':
+            columnas['fraccion_validos'] = columnas['count'] / valores.shape[2]
+    columnas['fraccion_sobre_umbral'] = np.asarray(zonas_turbulencia).reshape(n_tiempos, n_niveles, -1) \
+        .mean(axis=2).ravel()
+    return columnas
+
+
+def escribir_tabla(ruta, columnas):
+    # ruta sin extensión; Parquet si pyarrow está instalado, si no CSV. Devuelve la ruta escrita
+    ruta = Path(ruta)
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        ruta = ruta.with_suffix('.csv')
+        with open(ruta, 'w', newline='') as f:
+            escritor = csv.writer(f)
+            escritor.writerow(columnas)
+            escritor.writerows(zip(*(c.tolist() for c in columnas.values())))
+        return ruta
+
+    ruta = ruta.with_suffix('.parquet')
+    tabla = pa.table({nombre: columna.tolist() if columna.dtype == object else columna
+                      for nombre, columna in columnas.items()})
+    pq.write_table(tabla, ruta)
+    return ruta
+
+
+def anexar_tabla(ruta, columnas):
+    # agrega filas al final de un CSV (con encabezado si es nuevo); para tablas que crecen por tiempos
+    ruta = Path(ruta).with_suffix('.csv')
+    nueva = not ruta.exists()
+    with open(ruta, 'a', newline='') as f:
+        escritor = csv.writer(f)
+        if nueva:
+            escritor.writerow(columnas)
+        escritor.writerows(zip(*(c.tolist() for c in columnas.values())))
+    return ruta
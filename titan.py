@@ -0,0 +1,1009 @@
+import argparse
+import functools
+import multiprocessing
+import traceback
+from copy import copy
+from pathlib import Path
+
+import matplotlib.pyplot as plt
+import numpy as np
+
+import corriente
+import diagnosticos
+import escritura
+import espectros
+import geometria
+import graficos
+import instrumentacion
+import lectura
+import memoria_compartida
+import pipeline
+import planificador
+import seguimiento
+import servidor
+import tablas
+import trayectorias
+import umbrales
+import vortices
+
+DIAGNOSTICOS = ('temperatura', 'vorticidad', 'perfil', 'estabilidad', 'espectros', 'descomposicion', 'corriente',
+                'vortices')
+FORMATOS = ('npy', 'netcdf')
+MEDIAS = ('tiempo', 'tiempo_x')
+
+
+def rangos_niveles(nivel, nivel_inicio, escalonado=False):
+    # posiciones dentro del bloque leído y dentro de la selección de los niveles que produce el bloque
+    extra = int(escalonado and nivel.ultimo)
+    desde = nivel.inicio - nivel.lectura_inicio
+    destino = nivel.inicio - nivel_inicio
+    return (slice(desde, desde + nivel.fin - nivel.inicio + extra),
+            slice(destino, destino + nivel.fin - nivel.inicio + extra))
+
+
+class Diagnostico:
+    # los diagnósticos reciben bloques de tiempos x niveles; cerrar_bloque se llama cuando un bloque
+    # de tiempos ya tiene todos sus niveles y finalizar al terminar el archivo. Los que necesitan más de
+    # una lectura del archivo declaran pasadas > 1 y reciben iniciar_pasada antes de cada una
+
+    pasadas = 1
+
+    def __init__(self, contexto):
+        self.contexto = contexto
+
+    def rangos_niveles(self, nivel, escalonado=False):
+        return rangos_niveles(nivel, self.contexto['nivel_inicio'], escalonado)
+
+    def iniciar_pasada(self, pasada):
+        pass
+
+    def cerrar_bloque(self, posiciones, tiempos):
+        pass
+
+    def finalizar(self):
+        pass
+
+
+class DiagnosticoTemperatura(Diagnostico):
+    # temperatura real a partir de T, P, PB y la altura compartida; con un escritor NetCDF los bloques
+    # se escriben al producirse y no se acumula el campo completo
+
+    def __init__(self, contexto):
+        super().__init__(contexto)
+        self.tr = None
+        self.graficas = {}
+
+    def procesar(self, posiciones, tiempos, nivel, campos):
+        tr, height, pres = diagnosticos.procesar_campo_temperatura(campos['T'], campos['P'], campos['PB'],
+                                                                   campos.altura, campos.geometria.altura_masa)
+        origen, destino = self.rangos_niveles(nivel)
+        escritor = self.contexto['escritor']
+        if escritor is not None:
+            escritor.escribir('temperatura_real', posiciones, tr[:, origen], destino)
+        else:
+            if self.tr is None:
+                self.tr = np.empty((len(self.contexto['tiempos']), self.contexto['n_niveles']) + tr.shape[2:],
+                                   dtype=tr.dtype)
+            self.tr[posiciones, destino] = tr[:, origen]
+
+        for i, tiempo in enumerate(tiempos):
+            if tiempo in self.contexto['graficar']:
+                if tiempo not in self.graficas:
+                    forma = (self.contexto['n_niveles'], tr.shape[3])
+                    self.graficas[tiempo] = tuple(np.empty(forma, dtype=campo.dtype) for campo in (tr, height, pres))
+                for grafica, campo in zip(self.graficas[tiempo], (tr, height, pres)):
+                    grafica[destino] = campo[i, origen, 0, :]
+
+    def cerrar_bloque(self, posiciones, tiempos):
+        for tiempo in tiempos:
+            if tiempo in self.graficas:
+                tr, height, pres = self.graficas.pop(tiempo)
+                graficos.crear_grafica_temperatura(
+                    tr, height, pres,
+                    titulo=f'Temperatura Real vs Altura y Presión (Tiempo {tiempo})',
+                    ruta_salida=self.contexto['ruta_grafica'](f'temperatura_t{tiempo:03d}.png'))
+
+    def finalizar(self):
+        if self.tr is not None:
+            np.save(self.contexto['salida'] / 'temperatura_real.npy', self.tr)
+
+
+class DiagnosticoPerfil(Diagnostico):
+    # perfiles verticales de temperatura potencial en el centro del dominio
+
+    def __init__(self, contexto):
+        super().__init__(contexto)
+        self.columnas = {}
+        self.temp_perfiles = []
+        self.altura_perfiles = []
+        self.tiempos = []
+
+    def procesar(self, posiciones, tiempos, nivel, campos):
+        x_punto = campos['T'].shape[3] // 2
+        origen, destino = self.rangos_niveles(nivel)
+        origen_stag, destino_stag = self.rangos_niveles(nivel, escalonado=True)
+        for i, tiempo in enumerate(tiempos):
+            if tiempo in self.contexto['graficar']:
+                if tiempo not in self.columnas:
+                    n_niveles = self.contexto['n_niveles']
+                    self.columnas[tiempo] = (np.empty(n_niveles, dtype=campos['T'].dtype),
+                                             np.empty(n_niveles + 1, dtype=campos.altura.dtype))
+                self.columnas[tiempo][0][destino] = campos['T'][i, origen, 0, x_punto]
+                self.columnas[tiempo][1][destino_stag] = campos.altura[i, origen_stag, 0, x_punto]
+
+    def cerrar_bloque(self, posiciones, tiempos):
+        for tiempo in tiempos:
+            if tiempo in self.columnas:
+                ptp, altura = self.columnas.pop(tiempo)
+                temp_perfil, altura_perfil = diagnosticos.perfil_temperatura_potencial(
+                    ptp[None, :, None, None], altura[None, :, None, None], x_punto=0)
+                self.temp_perfiles.append(temp_perfil[0])
+                self.altura_perfiles.append(altura_perfil[0])
+                self.tiempos.append(tiempo)
+
+    def finalizar(self):
+        for temp_perfil, tiempo in zip(self.temp_perfiles, self.tiempos):
+            print(f"Tiempo {tiempo}: temperatura potencial de {np.min(temp_perfil)} a {np.max(temp_perfil)}")
+        graficos.graficar_perfiles_temperatura(self.temp_perfiles, self.altura_perfiles, self.tiempos,
+                                               ruta_salida=self.contexto['ruta_grafica']('perfil_temperatura.png'))
+
+
+class DiagnosticoVorticidad(Diagnostico):
+    # vorticidad por bloques; el recorte por percentiles y el umbral se aplican al final sobre todos los tiempos
+
+    def __init__(self, contexto):
+        super().__init__(contexto)
+        self.vorticidad = None
+        self.niveles_altura = {}
+
+    def procesar(self, posiciones, tiempos, nivel, campos):
+        vorticidad = diagnosticos.vorticidad_cruda(campos['U'], campos['W'], self.contexto['dx'], campos.altura,
+                                                   du_dz=campos.cortante, dw_dx=campos.dw_dx)
+        origen, destino = self.rangos_niveles(nivel, escalonado=True)
+        if self.vorticidad is None:
+            self.vorticidad = np.empty((len(self.contexto['tiempos']), self.contexto['n_niveles'] + 1)
+                                       + vorticidad.shape[2:], dtype=vorticidad.dtype)
+        self.vorticidad[posiciones, destino] = vorticidad[:, origen]
+
+        for i, tiempo in enumerate(tiempos):
+            if tiempo in self.contexto['graficar']:
+                niveles_altura = self.niveles_altura.setdefault(tiempo, np.empty(self.contexto['n_niveles'] + 1))
+                niveles_altura[destino] = campos.geometria.niveles_altura[i, origen]
+
+    def finalizar(self):
+        # los límites del recorte dependen de todos los tiempos, por eso se escribe recién aquí
+        # la vorticidad cruda no se vuelve a usar: se recorta en el mismo arreglo, y la copia con los NaN en
+        # cero solo se hace si hay NaN (la tabla necesita los NaN)
+        limites = diagnosticos.limites_percentiles(self.vorticidad)
+        recortada = diagnosticos.recortar_percentiles(self.vorticidad, limites=limites, out=self.vorticidad)
+        vorticidad = np.nan_to_num(recortada, nan=0.0) if np.isnan(recortada).any() else recortada
+        print("Valor mínimo de vorticidad:", np.min(vorticidad))
+        print("Valor máximo de vorticidad:", np.max(vorticidad))
+
+        # todos los percentiles con una sola copia de trabajo
+        percentiles = [1, 5, 10, 25, 50, 75, 90, 95, 99]
+        for p, valor in zip(percentiles, np.percentile(vorticidad, percentiles).astype(vorticidad.dtype)):
+            print(f"Percentil {p}%: {valor}")
+
+        with instrumentacion.etapa('umbral'):
+            zonas_turbulencia, umbral = diagnosticos.aplicar_umbral(vorticidad, self.contexto['umbral'],
+                                                                    self.contexto['umbral_percentil'],
+                                                                    self.contexto['modo_umbral'],
+                                                                    self.contexto['ventana_umbral'])
+            print(f"Umbral seleccionado: {umbrales.describir_umbral(umbral)}")
+
+        escritor = self.contexto['escritor']
+        empaquetado = self.contexto['empaquetado']
+        error = 0.0
+        if escritor is not None:
+            if empaquetado is not None:
+                error = escritor.escribir_empaquetado('vorticidad', vorticidad, empaquetado)
+            for posicion in range(len(vorticidad)):
+                if empaquetado is None:
+                    escritor.escribir('vorticidad', posicion, vorticidad[posicion])
+                escritor.escribir('zonas_turbulencia', posicion, zonas_turbulencia[posicion].astype(np.uint8))
+            if limites is not None:
+                escritor.atributos('vorticidad', percentil_inferior=1.0, percentil_superior=99.0,
+                                   limite_inferior=float(limites[0]), limite_superior=float(limites[1]))
+            _guardar_umbral(self.contexto, 'zonas_turbulencia', umbral)
+        else:
+            error = escritura.guardar_campo(self.contexto['salida'] / 'vorticidad', vorticidad, empaquetado)
+            np.save(self.contexto['salida'] / 'zonas_turbulencia.npy', zonas_turbulencia)
+            _guardar_umbral(self.contexto, 'zonas_turbulencia', umbral)
+        columnas = tablas.estadisticas_tiempo_nivel(recortada, zonas_turbulencia, self.contexto['tiempos'],
+                                                    self.contexto['corrida'], self.contexto['archivo'],
+                                                    self.contexto['nivel_inicio'])
+        ruta_tabla = tablas.escribir_tabla(self.contexto['salida'] / 'estadisticas_vorticidad', columnas)
+        print(f"Tabla de estadísticas por tiempo y nivel: {ruta_tabla}")
+        if self.contexto['barrido'] is not None:
+            self.barrido(vorticidad, umbral)
+        if empaquetado is not None:
+            print(f"Vorticidad empaquetada como {empaquetado}, error máximo de cuantización: {error}")
+
+        tiempos = self.contexto['tiempos']
+        for tiempo, niveles_altura in sorted(self.niveles_altura.items()):
+            graficos.graficar_vorticidad_2d(vorticidad[tiempos.index(tiempo)].mean(axis=1), niveles_altura,
+                                            self.contexto['geometria'], tiempo,
+                                            ruta_salida=self.contexto['ruta_grafica'](f'vorticidad_t{tiempo:03d}.png'))
+
+        # sin NaN a esta altura: mean no necesita la copia y la máscara de nanmean
+        vorticidad_por_nivel = vorticidad.mean(axis=(0, 2, 3))
+        print("\nEstadísticas de vorticidad por nivel vertical:")
+        for i, valor in enumerate(vorticidad_por_nivel):
+            print(f"Nivel {i}: {valor}")
+        graficos.graficar_perfil_vorticidad(vorticidad_por_nivel,
+                                            ruta_salida=self.contexto['ruta_grafica']('perfil_vorticidad.png'))
+        graficos.graficar_evolucion_vorticidad(tiempos, vorticidad.mean(axis=(1, 2, 3)),
+                                               ruta_salida=self.contexto['ruta_grafica']('evolucion_vorticidad.png'))
+
+    def barrido(self, vorticidad, umbral):
+        # fracción turbulenta por tiempo y nivel para todos los umbrales del barrido en una pasada
+        valores = self.contexto['barrido']
+        fracciones = umbrales.barrido_umbrales(vorticidad, valores, self.contexto['bloque_tiempo'])
+        np.savez(self.contexto['salida'] / 'barrido_umbrales.npz', umbrales=valores, fraccion=fracciones,
+                 tiempos=np.asarray(self.contexto['tiempos']),
+                 niveles=np.arange(self.contexto['nivel_inicio'], self.contexto['nivel_inicio'] + fracciones.shape[2]))
+        medias = fracciones.mean(axis=(1, 2))
+        print(f"Barrido de {len(valores)} umbrales: fracción turbulenta media "
+              f"de {medias.max():.3f} a {medias.min():.3f}")
+        graficos.graficar_barrido_umbrales(valores, fracciones, umbral if np.ndim(umbral) == 0 else None,
+                                           ruta_salida=self.contexto['ruta_grafica']('barrido_umbrales.png'))
+
+
+class DiagnosticoEstabilidad(Diagnostico):
+    # N² y número de Richardson en la misma lectura que la vorticidad, reutilizando su du/dz; los perfiles
+    # se acumulan por nivel y los campos completos solo se guardan si no hay escritor NetCDF
+
+    def __init__(self, contexto):
+        super().__init__(contexto)
+        self.campos = {}
+        n_niveles = contexto['n_niveles']
+        self.suma_n2 = np.zeros(n_niveles)
+        self.conteo_n2 = np.zeros(n_niveles, dtype=np.int64)
+        self.inestables = np.zeros(n_niveles, dtype=np.int64)
+        self.con_cortante = np.zeros(n_niveles, dtype=np.int64)
+
+    def procesar(self, posiciones, tiempos, nivel, campos):
+        n2 = diagnosticos.frecuencia_brunt_vaisala(campos['T'], campos.altura, campos.geometria)
+        ri = diagnosticos.numero_richardson(n2, campos.cortante)
+        origen, destino = self.rangos_niveles(nivel)
+        n2, ri = n2[:, origen], ri[:, origen]
+
+        self.suma_n2[destino] += np.nansum(n2, axis=(0, 2, 3))
+        self.conteo_n2[destino] += (~np.isnan(n2)).sum(axis=(0, 2, 3))
+        self.inestables[destino] += (ri < diagnosticos.richardson_critico).sum(axis=(0, 2, 3))
+        self.con_cortante[destino] += (~np.isnan(ri)).sum(axis=(0, 2, 3))
+
+        escritor = self.contexto['escritor']
+        for nombre, valores in (('n2', n2), ('richardson', ri)):
+            if escritor is not None:
+                escritor.escribir(nombre, posiciones, valores, destino)
+                continue
+            if nombre not in self.campos:
+                forma = (len(self.contexto['tiempos']), self.contexto['n_niveles']) + valores.shape[2:]
+                self.campos[nombre] = np.empty(forma, dtype=valores.dtype)
+            self.campos[nombre][posiciones, destino] = valores
+
+    def finalizar(self):
+        n2_por_nivel = self.suma_n2 / np.maximum(self.conteo_n2, 1)
+        # fracción de puntos dinámicamente inestables sobre los que tienen cortante
+        fraccion_por_nivel = self.inestables / np.maximum(self.con_cortante, 1)
+        print(f"N² medio: {self.suma_n2.sum() / max(self.conteo_n2.sum(), 1)} s-2")
+        print(f"Fracción con Ri < {diagnosticos.richardson_critico}: "
+              f"{self.inestables.sum() / max(self.con_cortante.sum(), 1):.3f}")
+
+        for nombre, valores in self.campos.items():
+            np.save(self.contexto['salida'] / f'{nombre}.npy', valores)
+        graficos.graficar_perfil_estabilidad(n2_por_nivel, fraccion_por_nivel,
+                                             ruta_salida=self.contexto['ruta_grafica']('perfil_estabilidad.png'))
+
+
+class DiagnosticoEspectros(Diagnostico):
+    # espectros de potencia de U y W a lo largo de west_east; se promedian por bloque de tiempos a medida
+    # que se leen, así nunca hace falta el campo completo
+
+    def __init__(self, contexto):
+        super().__init__(contexto)
+        self.suma = {}
+        self.por_bloque = {'u': [], 'w': []}
+        self.inicios = []
+        self.total = {}
+        self.n_tiempos = 0
+        self.numero_onda = None
+
+    def _acumular(self, nombre, destino, espectro, n_niveles):
+        if nombre not in self.suma:
+            self.suma[nombre] = np.zeros((n_niveles, espectro.shape[-1]), dtype=np.float64)
+        self.suma[nombre][destino] += espectro.sum(axis=0)
+
+    def procesar(self, posiciones, tiempos, nivel, campos):
+        origen, destino = self.rangos_niveles(nivel)
+        origen_stag, destino_stag = self.rangos_niveles(nivel, escalonado=True)
+        espectro_u, espectro_w = espectros.espectros_bloque(
+            campos['U'][:, origen], campos['W'][:, origen_stag], self.contexto['dx'],
+            self.contexto['ventana'], self.contexto['destendencia'])
+        self.numero_onda = espectros.numero_onda(campos['W'].shape[3], self.contexto['dx'])
+        self._acumular('u', destino, espectro_u, self.contexto['n_niveles'])
+        self._acumular('w', destino_stag, espectro_w, self.contexto['n_niveles'] + 1)
+
+    def cerrar_bloque(self, posiciones, tiempos):
+        for nombre, suma in self.suma.items():
+            self.por_bloque[nombre].append((suma / len(tiempos)).astype(self.contexto['tipo']))
+            self.total[nombre] = self.total.get(nombre, 0) + suma
+        self.suma = {}
+        self.inicios.append(tiempos[0])
+        self.n_tiempos += len(tiempos)
+
+    def finalizar(self):
+        k = self.numero_onda
+        media = {nombre: (total / self.n_tiempos).astype(self.contexto['tipo'])
+                 for nombre, total in self.total.items()}
+        np.savez(self.contexto['salida'] / 'espectros.npz', numero_onda=k, tiempo_inicio_bloque=self.inicios,
+                 u=media['u'], w=media['w'], u_por_bloque=np.stack(self.por_bloque['u']),
+                 w_por_bloque=np.stack(self.por_bloque['w']))
+        print(f"Espectros de {len(k)} números de onda en {len(self.inicios)} bloques de tiempo")
+        graficos.graficar_espectros(k, media['u'].mean(axis=0), media['w'].mean(axis=0),
+                                    ruta_salida=self.contexto['ruta_grafica']('espectros.png'))
+
+
+class DiagnosticoDescomposicion(Diagnostico):
+    # primera pasada: medias temporales (y opcionalmente en x) de U, W y θ; segunda pasada: perturbaciones,
+    # TKE resuelta y flujo u'w'. U se lleva a la malla de w con interpolar_u. La memoria queda acotada por
+    # el bloque: las medias ocupan un tiempo y los campos completos se escriben por bloques
+
+    pasadas = 2
+
+    def __init__(self, contexto):
+        super().__init__(contexto)
+        self.pasada = 0
+        self.sumas = {}
+        self.medias = {}
+        self.perfiles = {}
+        self.archivos = {}
+
+    def iniciar_pasada(self, pasada):
+        self.pasada = pasada
+        if pasada == 1:
+            n_tiempos = len(self.contexto['tiempos'])
+            self.medias = {nombre: (suma / n_tiempos).astype(self.contexto['tipo'])
+                           for nombre, suma in self.sumas.items()}
+            self.sumas = {}
+
+    def _campos(self, campos, nivel):
+        origen, destino = self.rangos_niveles(nivel)
+        origen_stag, destino_stag = self.rangos_niveles(nivel, escalonado=True)
+        return {
+            'u': (campos.u_interpolada[:, origen_stag], destino_stag),
+            'w': (np.asarray(campos['W'])[:, origen_stag], destino_stag),
+            'theta': (np.asarray(campos['T'])[:, origen] + diagnosticos.temperatura_referencia, destino),
+        }
+
+    def procesar(self, posiciones, tiempos, nivel, campos):
+        por_variable = self._campos(campos, nivel)
+        if self.pasada == 0:
+            for nombre, (valores, destino) in por_variable.items():
+                suma = valores.sum(axis=0, dtype=np.float64)
+                if self.contexto['media'] == 'tiempo_x':
+                    suma = suma.mean(axis=-1, keepdims=True)
+                if nombre not in self.sumas:
+                    n_niveles = self.contexto['n_niveles'] + (nombre != 'theta')
+                    self.sumas[nombre] = np.zeros((n_niveles,) + suma.shape[1:])
+                self.sumas[nombre][destino] += suma
+            return
+
+        perturbaciones = {nombre: valores - self.medias[nombre][destino]
+                          for nombre, (valores, destino) in por_variable.items()}
+        destino_stag = por_variable['u'][1]
+        resultados = {
+            'tke': diagnosticos.energia_cinetica_turbulenta(perturbaciones['u'], perturbaciones['w']),
+            'flujo_uw': perturbaciones['u'] * perturbaciones['w'],
+        }
+        for nombre, valores in resultados.items():
+            if nombre not in self.perfiles:
+                self.perfiles[nombre] = np.empty((len(self.contexto['tiempos']), self.contexto['n_niveles'] + 1),
+                                                 dtype=np.float64)
+            self.perfiles[nombre][posiciones, destino_stag] = valores.mean(axis=(2, 3))
+            self._escribir(nombre, posiciones, valores, destino_stag)
+        if self.contexto['perturbaciones']:
+            for nombre, valores in perturbaciones.items():
+                self._escribir(f'{nombre}_perturbacion', posiciones, valores, por_variable[nombre][1])
+
+    def _escribir(self, nombre, posiciones, valores, destino):
+        escritor = self.contexto['escritor']
+        if escritor is not None:
+            escritor.escribir(nombre, posiciones, valores, destino)
+            return
+        # sin NetCDF se escribe un .npy en disco por bloques para no tener el campo completo en memoria
+        if nombre not in self.archivos:
+            n_niveles = self.contexto['n_niveles'] + (nombre != 'theta_perturbacion')
+            forma = (len(self.contexto['tiempos']), n_niveles) + valores.shape[2:]
+            self.archivos[nombre] = np.lib.format.open_memmap(self.contexto['salida'] / f'{nombre}.npy', mode='w+',
+                                                              dtype=valores.dtype, shape=forma)
+        self.archivos[nombre][posiciones, destino] = valores
+
+    def finalizar(self):
+        for archivo in self.archivos.values():
+            archivo.flush()
+        self.archivos = {}
+        np.savez(self.contexto['salida'] / 'descomposicion.npz', tke_por_tiempo_nivel=self.perfiles['tke'],
+                 flujo_uw_por_tiempo_nivel=self.perfiles['flujo_uw'],
+                 **{f'media_{nombre}': media for nombre, media in self.medias.items()})
+        tke_por_nivel = self.perfiles['tke'].mean(axis=0)
+        flujo_por_nivel = self.perfiles['flujo_uw'].mean(axis=0)
+        print(f"TKE resuelta media: {tke_por_nivel.mean()} m2 s-2, flujo u'w' medio: {flujo_por_nivel.mean()} m2 s-2")
+        graficos.graficar_perfil_tke(tke_por_nivel, flujo_por_nivel,
+                                     ruta_salida=self.contexto['ruta_grafica']('perfil_tke.png'))
+
+
+class DiagnosticoCorriente(Diagnostico):
+    # función de corriente x-z por bloque de tiempos; el planificador asegura columnas completas
+
+    def __init__(self, contexto):
+        super().__init__(contexto)
+        self.corriente = None
+
+    def procesar(self, posiciones, tiempos, nivel, campos):
+        if nivel.fin - nivel.inicio != self.contexto['n_niveles']:
+            raise ValueError("la función de corriente necesita la columna completa en cada bloque")
+        origen, _ = self.rangos_niveles(nivel)
+        origen_stag, _ = self.rangos_niveles(nivel, escalonado=True)
+        altura = campos.altura[:, origen_stag]
+        psi = corriente.funcion_corriente(campos['U'][:, origen], campos['W'][:, origen_stag],
+                                          self.contexto['dx'], altura)
+        escritor = self.contexto['escritor']
+        if escritor is not None:
+            escritor.escribir('corriente', posiciones, psi)
+        else:
+            if self.corriente is None:
+                self.corriente = np.empty((len(self.contexto['tiempos']),) + psi.shape[1:], dtype=psi.dtype)
+            self.corriente[posiciones] = psi
+
+        for i, tiempo in enumerate(tiempos):
+            if tiempo in self.contexto['graficar']:
+                z_stag = campos.geometria.niveles_altura[i, origen_stag]
+                graficos.graficar_corriente(psi[i].mean(axis=1), (z_stag[:-1] + z_stag[1:]) / 2,
+                                            self.contexto['geometria'], tiempo,
+                                            ruta_salida=self.contexto['ruta_grafica'](f'corriente_t{tiempo:03d}.png'))
+
+    def finalizar(self):
+        if self.corriente is not None:
+            np.save(self.contexto['salida'] / 'corriente.npy', self.corriente)
+
+
+class DiagnosticoVortices(Diagnostico):
+    # criterios Q, λ2 y swirling strength desde un mismo tensor de gradientes por bloque; cada criterio pasa
+    # por el mismo umbral que la vorticidad (fijo o por percentil) al final, sobre todos los tiempos
+
+    def __init__(self, contexto):
+        super().__init__(contexto)
+        self.campos = {}
+        desconocidos = set(contexto['criterios']) - set(vortices.CRITERIOS)
+        if desconocidos:
+            raise ValueError(f"criterios desconocidos: {', '.join(sorted(desconocidos))}")
+
+    def procesar(self, posiciones, tiempos, nivel, campos):
+        origen, destino = self.rangos_niveles(nivel, escalonado=True)
+        tensor = vortices.tensor_velocidad(campos.u_interpolada, campos['W'], self.contexto['dx'], campos.altura,
+                                           du_dz=campos.cortante, espesores=campos.geometria.espesores_dz,
+                                           du_dx=campos.du_dx, dw_dx=campos.dw_dx)
+        for nombre, valores in vortices.intensidades(tensor, self.contexto['criterios']).items():
+            if nombre not in self.campos:
+                forma = (len(self.contexto['tiempos']), self.contexto['n_niveles'] + 1) + valores.shape[2:]
+                self.campos[nombre] = np.empty(forma, dtype=valores.dtype)
+            self.campos[nombre][posiciones, destino] = valores[:, origen]
+
+    def finalizar(self):
+        escritor = self.contexto['escritor']
+        fracciones = {}
+        for nombre, valores in self.campos.items():
+            with instrumentacion.etapa('umbral'):
+                zonas, umbral = diagnosticos.aplicar_umbral(valores, self.contexto['umbral_criterios'],
+                                                            self.contexto['umbral_percentil'],
+                                                            self.contexto['modo_umbral'],
+                                                            self.contexto['ventana_umbral'])
+            print(f"Criterio {nombre}: umbral {umbrales.describir_umbral(umbral)}, "
+                  f"fracción marcada {zonas.mean():.3f}")
+            fracciones[nombre] = zonas.mean(axis=(0, 2, 3))
+            if escritor is not None:
+                for posicion in range(len(valores)):
+                    escritor.escribir(f'criterio_{nombre}', posicion, valores[posicion])
+                    escritor.escribir(f'zonas_{nombre}', posicion, zonas[posicion].astype(np.uint8))
+            else:
+                np.save(self.contexto['salida'] / f'criterio_{nombre}.npy', valores)
+                np.save(self.contexto['salida'] / f'zonas_{nombre}.npy', zonas)
+            _guardar_umbral(self.contexto, f'zonas_{nombre}', umbral)
+        graficos.graficar_fraccion_vortices(fracciones,
+                                            ruta_salida=self.contexto['ruta_grafica']('fraccion_vortices.png'))
+
+
+CLASES_DIAGNOSTICO = {
+    'temperatura': DiagnosticoTemperatura,
+    'vorticidad': DiagnosticoVorticidad,
+    'perfil': DiagnosticoPerfil,
+    'estabilidad': DiagnosticoEstabilidad,
+    'espectros': DiagnosticoEspectros,
+    'descomposicion': DiagnosticoDescomposicion,
+    'corriente': DiagnosticoCorriente,
+    'vortices': DiagnosticoVortices,
+}
+
+
+def _ruta_grafica(salida, mostrar, nombre):
+    return None if mostrar else salida / nombre
+
+
+def _guardar_umbral(contexto, variable, umbral):
+    # un umbral único va como atributo de la variable de zonas; uno local no cabe en un atributo y se
+    # guarda como arreglo difundible contra el campo, umbral_<variable>.npy
+    escritor = contexto['escritor']
+    if np.ndim(umbral) == 0:
+        if escritor is not None:
+            escritor.atributos(variable, umbral=float(umbral))
+        return
+    np.save(contexto['salida'] / f'umbral_{variable}.npy', umbral)
+    if escritor is not None:
+        escritor.atributos(variable, modo_umbral=contexto['modo_umbral'])
+
+
+def _trabajador_diagnosticos(nombres, contexto, conexion):
+    # proceso que mantiene sus propios diagnósticos y los alimenta con vistas de los bloques publicados
+    # en memoria compartida; responde cada orden con 'ok' o con el traceback del error
+    plt.switch_backend('Agg')
+    activos = [CLASES_DIAGNOSTICO[nombre](contexto) for nombre in nombres]
+    pasada = 0
+    with memoria_compartida.VistasCompartidas() as vistas:
+        while True:
+            orden, *argumentos = conexion.recv()
+            if orden == 'salir':
+                break
+            try:
+                if orden == 'iniciar_pasada':
+                    pasada, = argumentos
+                participantes = [diagnostico for diagnostico in activos if diagnostico.pasadas > pasada]
+                if orden == 'iniciar_pasada':
+                    for diagnostico in participantes:
+                        diagnostico.iniciar_pasada(pasada)
+                elif orden == 'procesar':
+                    posiciones, tiempos, nivel, descriptores = argumentos
+                    campos = diagnosticos.CamposBloque(vistas.vistas(descriptores), contexto['geometria'])
+                    for diagnostico in participantes:
+                        diagnostico.procesar(posiciones, tiempos, nivel, campos)
+                    del campos
+                elif orden == 'cerrar_bloque':
+                    for diagnostico in participantes:
+                        diagnostico.cerrar_bloque(*argumentos)
+                elif orden == 'finalizar':
+                    for diagnostico in activos:
+                        diagnostico.finalizar()
+                conexion.send(('ok',))
+            except Exception:
+                conexion.send(('error', traceback.format_exc()))
+
+
+class GrupoProcesos:
+    # reparte los diagnósticos entre procesos y se comporta como un diagnóstico más para el recorrido de
+    # bloques. Cada bloque se publica una sola vez en memoria compartida y todos los procesos leen la
+    # misma copia; se espera a que todos terminen antes de publicar el siguiente. Lo compartido son las
+    # variables leídas: los derivados del bloque (altura, geometría, cortante) los calcula cada proceso
+
+    def __init__(self, nombres, contexto, procesos):
+        self.pasadas = max(CLASES_DIAGNOSTICO[nombre].pasadas for nombre in nombres)
+        self.almacen = memoria_compartida.AlmacenCampos()
+        self.procesos = []
+        self.conexiones = []
+        for i in range(min(procesos, len(nombres))):
+            propia, remota = multiprocessing.Pipe()
+            proceso = multiprocessing.Process(target=_trabajador_diagnosticos, daemon=True,
+                                              args=(nombres[i::procesos], contexto, remota),
+                                              name=f'diagnosticos-{i}')
+            proceso.start()
+            self.procesos.append(proceso)
+            self.conexiones.append(propia)
+
+    def _ordenar(self, *orden):
+        for conexion in self.conexiones:
+            conexion.send(orden)
+        errores = [respuesta[1] for respuesta in (conexion.recv() for conexion in self.conexiones)
+                   if respuesta[0] == 'error']
+        if errores:
+            raise RuntimeError("error en un proceso de diagnósticos:\n" + errores[0])
+
+    def iniciar_pasada(self, pasada):
+        self._ordenar('iniciar_pasada', pasada)
+
+    def procesar(self, posiciones, tiempos, nivel, campos):
+        self._ordenar('procesar', posiciones, tiempos, nivel, self.almacen.publicar(campos.bloque))
+
+    def cerrar_bloque(self, posiciones, tiempos):
+        self._ordenar('cerrar_bloque', posiciones, tiempos)
+
+    def finalizar(self):
+        self._ordenar('finalizar')
+
+    def cerrar(self):
+        for conexion, proceso in zip(self.conexiones, self.procesos):
+            if proceso.is_alive():
+                try:
+                    conexion.send(('salir',))
+                except (BrokenPipeError, OSError):
+                    pass
+        for proceso in self.procesos:
+            proceso.join(timeout=10)
+            if proceso.is_alive():
+                proceso.terminate()
+        self.almacen.liberar()
+
+
+# 'all' agrupa los diagnósticos que se resuelven con una sola lectura del archivo y que admiten bloques de niveles
+DIAGNOSTICOS_UNA_LECTURA = tuple(nombre for nombre in DIAGNOSTICOS if CLASES_DIAGNOSTICO[nombre].pasadas == 1
+                                 and nombre not in planificador.COLUMNA_COMPLETA)
+
+
+def procesar_archivo(ruta_archivo, nombres, args):
+    with instrumentacion.etapa('archivo', ruta=str(ruta_archivo)):
+        _procesar_archivo(ruta_archivo, nombres, args)
+
+
+def _procesar_archivo(ruta_archivo, nombres, args):
+    datos = lectura.obtener_datos(ruta_archivo)
+    escritor = None
+    grupo = None
+    try:
+        tiempos, (nivel_inicio, nivel_fin), columnas = resolver_region(datos, args)
+        if args.graficar is None:
+            graficar = set(tiempos[:1])
+        else:
+            graficar = set(lectura.seleccionar_tiempos(datos, args.graficar)) & set(tiempos)
+        malla = geometria.GeometriaMalla.desde_archivo(datos, columnas)
+
+        memoria_objetivo = None if args.memoria_objetivo is None else int(args.memoria_objetivo * 2**30)
+        plan = planificador.planificar(datos, nombres, len(tiempos), nivel_fin - nivel_inicio, memoria_objetivo,
+                                       bloque_tiempo=args.bloque, bloque_niveles=args.bloque_niveles,
+                                       anticipar=args.anticipar, n_we=malla.n_we + sum(malla.halo_x),
+                                       procesos=args.procesos)
+        print(plan)
+        if malla.n_we != len(datos.dimensions['west_east']):
+            print(f"Ventana en x: columnas {columnas[0]} a {columnas[1] - 1} "
+                  f"({malla.distancia[0]:.0f} a {malla.distancia[-1]:.0f} m), halo {malla.halo_x}")
+
+        salida = Path(args.salida) / Path(ruta_archivo).stem
+        salida.mkdir(parents=True, exist_ok=True)
+        if args.formato == 'netcdf' and args.empaquetar == 'float16':
+            raise ValueError("NetCDF no tiene float16; usar --empaquetar int16 o --formato npy")
+        if args.formato == 'netcdf' and args.procesos > 1:
+            raise ValueError("el escritor NetCDF no se comparte entre procesos; usar --procesos 1 o --formato npy")
+        if args.formato == 'netcdf':
+            escritor = escritura.EscritorDerivados(salida / 'derivados.nc', datos, nivel_inicio, nivel_fin,
+                                                   columnas=columnas)
+        contexto = {
+            'dx': malla.dx,
+            'tipo': lectura.tipo_calculo(),
+            'geometria': malla,
+            'tiempos': tiempos,
+            'nivel_inicio': nivel_inicio,
+            'n_niveles': nivel_fin - nivel_inicio,
+            'graficar': graficar,
+            'salida': salida,
+            'umbral': args.umbral,
+            'umbral_percentil': args.umbral_percentil,
+            'criterios': [c.strip() for c in args.criterios.split(',') if c.strip()],
+            'umbral_criterios': args.umbral_criterios,
+            'modo_umbral': args.modo_umbral,
+            'ventana_umbral': args.ventana_umbral,
+            'barrido': None if args.barrido is None else umbrales.interpretar_umbrales(args.barrido),
+            'bloque_tiempo': plan.bloque_tiempo,
+            'ruta_grafica': functools.partial(_ruta_grafica, salida, args.mostrar),
+            'escritor': escritor,
+            'corrida': Path(ruta_archivo).resolve().parent.name,
+            'archivo': Path(ruta_archivo).name,
+            'empaquetado': args.empaquetar,
+            'ventana': args.ventana,
+            'destendencia': args.destendencia,
+            'media': args.media,
+            'perturbaciones': args.perturbaciones,
+        }
+        if args.procesos > 1 and len(nombres) > 1:
+            grupo = GrupoProcesos(nombres, contexto, args.procesos)
+            activos = {nombre: grupo for nombre in nombres}
+        else:
+            activos = {nombre: CLASES_DIAGNOSTICO[nombre](contexto) for nombre in nombres}
+
+        # cada variable se lee una sola vez por bloque y se comparte entre todos los diagnósticos; solo los
+        # diagnósticos de varias pasadas vuelven a leer el archivo, y únicamente sus variables
+        for pasada in range(max(CLASES_DIAGNOSTICO[nombre].pasadas for nombre in nombres)):
+            participantes = [nombre for nombre in nombres if CLASES_DIAGNOSTICO[nombre].pasadas > pasada]
+            receptores = list(dict.fromkeys(activos[nombre] for nombre in participantes))
+            for diagnostico in receptores:
+                diagnostico.iniciar_pasada(pasada)
+            variables = lectura.variables_necesarias(participantes)
+            print(f"Procesando {ruta_archivo}: {len(tiempos)} tiempos, variables {', '.join(variables)}"
+                  + (f" (pasada {pasada + 1})" if pasada else ''))
+            _recorrer_bloques(datos, variables, tiempos, plan, nivel_inicio, nivel_fin, receptores,
+                              escritor if pasada == 0 else None, args.anticipar, contexto['geometria'])
+
+        for diagnostico in dict.fromkeys(activos.values()):
+            diagnostico.finalizar()
+    finally:
+        if grupo is not None:
+            grupo.cerrar()
+        if escritor is not None:
+            escritor.cerrar()
+        datos.close()
+
+
+def resolver_region(datos, args):
+    # región de interés de los argumentos: índices de tiempo, niveles de masa (inicio, fin) y columnas de
+    # west_east (inicio, fin). --alturas se resuelve con la altura media de cada nivel en el primer tiempo
+    # seleccionado, leyendo solo la ventana en x
+    tiempos = lectura.seleccionar_tiempos(datos, args.tiempos)
+    if not tiempos:
+        raise ValueError(f"ningún tiempo del archivo cae en la selección {args.tiempos}")
+    columnas = lectura.interpretar_rango_x(args.x, len(datos.dimensions['west_east']), float(datos.DX))
+    nivel_inicio, nivel_fin = 0, len(datos.dimensions['bottom_top'])
+    if args.niveles is not None:
+        seleccion = lectura.interpretar_seleccion(args.niveles, nivel_fin)
+        nivel_inicio, nivel_fin = seleccion[0], seleccion[-1] + 1
+    if args.alturas is not None:
+        bloque = lectura.leer_bloque(datos, ('PH', 'PHB'), slice(tiempos[0], tiempos[0] + 1),
+                                     columnas=slice(*columnas))
+        altura = np.asarray(diagnosticos.calcular_altura(bloque['PH'], bloque['PHB']))[0]
+        alturas_masa = ((altura[:-1] + altura[1:]) / 2).mean(axis=(1, 2))
+        nivel_inicio, nivel_fin = lectura.niveles_por_altura(alturas_masa, args.alturas, nivel_inicio, nivel_fin)
+    return tiempos, (nivel_inicio, nivel_fin), columnas
+
+
+def _recorrer_bloques(datos, variables, tiempos, plan, nivel_inicio, nivel_fin, activos, escritor=None, anticipar=0,
+                      malla=None):
+    def peticiones():
+        posicion = 0
+        for inicio, fin in lectura.agrupar_contiguos(tiempos, plan.bloque_tiempo):
+            indices = list(range(inicio, fin))
+            posiciones = slice(posicion, posicion + len(indices))
+            for nivel in lectura.bloques_niveles(nivel_inicio, nivel_fin, plan.bloque_niveles,
+                                                 planificador.HALO_NIVELES, len(datos.dimensions['bottom_top'])):
+                yield (posiciones, indices, nivel), slice(inicio, fin), slice(nivel.lectura_inicio, nivel.lectura_fin)
+            posicion = posiciones.stop
+
+    # el bloque siguiente se lee en segundo plano mientras se calcula el actual
+    columnas = None if malla is None else malla.columnas_lectura
+    for (posiciones, indices, nivel), bloque in lectura.LectorAnticipado(datos, variables, peticiones(), anticipar,
+                                                                         columnas):
+        if escritor is not None and nivel.inicio == nivel_inicio:
+            escritor.escribir_tiempos(posiciones, indices)
+        campos = diagnosticos.CamposBloque(bloque, malla)
+        if escritor is not None:
+            origen, destino = rangos_niveles(nivel, nivel_inicio, escalonado=True)
+            escritor.escribir('altura', posiciones, campos.altura[:, origen], destino)
+        for diagnostico in activos:
+            diagnostico.procesar(posiciones, indices, nivel, campos)
+        if nivel.ultimo:
+            for diagnostico in activos:
+                diagnostico.cerrar_bloque(posiciones, indices)
+
+
+def _argumentos_comunes(sub):
+    sub.add_argument('rutas', nargs='+', help='archivos netCDF de WRF')
+    sub.add_argument('--tiempos', help="tiempos a procesar: índices '18', '0:43' o '0,10,20', o fechas de Times "
+                                       "'2000-01-01T06:00', '2000-01-01T06/2000-01-01T12' (por defecto todos)")
+    sub.add_argument('--graficar', help='tiempos a graficar, índices o fechas (por defecto el primero seleccionado)')
+    sub.add_argument('--niveles', help="niveles bottom_top a leer, p. ej. '0:50' (por defecto todos)")
+    sub.add_argument('--alturas', metavar='Z0:Z1',
+                     help="niveles cuya altura media cae en el rango, en metros, p. ej. '0:3000'")
+    sub.add_argument('--x', metavar='RANGO',
+                     help="ventana en west_east: índices '500:900' o metros '10000m:25000m' (por defecto todo); "
+                          "solo se lee la ventana y un punto vecino a cada lado")
+    sub.add_argument('--bloque', type=int, help='tiempos leídos por bloque (por defecto según el plan de memoria)')
+    sub.add_argument('--bloque-niveles', type=int, help='niveles leídos por bloque (por defecto según el plan)')
+    sub.add_argument('--procesos', type=int, default=1,
+                     help='procesos entre los que se reparten los diagnósticos; leen cada bloque de memoria '
+                          'compartida sin copiarlo')
+    sub.add_argument('--anticipar', type=int, default=1,
+                     help='bloques leídos por adelantado en segundo plano (0 para leer y calcular en serie)')
+    sub.add_argument('--memoria-objetivo', type=float,
+                     help='memoria pico objetivo en GiB (por defecto la mitad de la disponible)')
+    sub.add_argument('--salida', default='resultados', help='directorio de resultados')
+    sub.add_argument('--formato', choices=FORMATOS, default='npy',
+                     help='npy por campo o un NetCDF4 comprimido (derivados.nc) con un trozo por tiempo')
+    sub.add_argument('--empaquetar', choices=escritura.MODOS_EMPAQUETADO,
+                     help='guardar la vorticidad recortada cuantizada (int16 con scale_factor/add_offset o float16)')
+    sub.add_argument('--ventana', choices=espectros.VENTANAS, default='hann', help='ventana de los espectros')
+    sub.add_argument('--destendencia', choices=espectros.DESTENDENCIAS, default='lineal',
+                     help='tendencia que se quita en west_east antes de la FFT')
+    sub.add_argument('--media', choices=MEDIAS, default='tiempo',
+                     help='media que se resta en la descomposición: temporal o temporal y en west_east')
+    sub.add_argument('--perturbaciones', action='store_true',
+                     help="guardar también los campos u', w' y θ' de la descomposición")
+    sub.add_argument('--umbral', type=float, help='umbral fijo de vorticidad para zonas de turbulencia')
+    sub.add_argument('--umbral-percentil', type=float, default=75,
+                     help='percentil usado como umbral si no se da --umbral')
+    sub.add_argument('--modo-umbral', choices=umbrales.MODOS_UMBRAL, default='global',
+                     help='conjunto sobre el que se toma el percentil del umbral: todo el campo, cada nivel, '
+                          'cada tiempo o una ventana móvil en west_east por tiempo y nivel')
+    sub.add_argument('--ventana-umbral', type=int, default=101,
+                     help='ancho en puntos de west_east de la ventana de --modo-umbral ventana')
+    sub.add_argument('--barrido', metavar='UMBRALES',
+                     help="umbrales de vorticidad para el barrido de sensibilidad, 'inicio:fin:n' o lista con comas")
+    sub.add_argument('--criterios', default=','.join(vortices.CRITERIOS),
+                     help=f"criterios de vórtices a calcular ({', '.join(vortices.CRITERIOS)})")
+    sub.add_argument('--umbral-criterios', type=float,
+                     help='umbral fijo para los criterios de vórtices, p. ej. 0 (por defecto el percentil)')
+    _argumento_precision(sub)
+    sub.add_argument('--instrumentar', metavar='RUTA',
+                     help='guardar tiempos y memoria por etapa en un JSON '
+                          f'(también con {instrumentacion.VARIABLE_REPORTE})')
+    sub.add_argument('--traza', metavar='RUTA',
+                     help=f'guardar una traza para chrome://tracing (también con {instrumentacion.VARIABLE_TRAZA})')
+
+
+def _argumento_precision(sub):
+    sub.add_argument('--precision', choices=tuple(lectura.PRECISIONES), default='float32',
+                     help='tipo en que se leen los campos y se calculan los diagnósticos (float64 ocupa el doble)')
+
+
+def crear_parser():
+    parser = argparse.ArgumentParser(description='Diagnósticos de salidas WRF de Titán')
+    subparsers = parser.add_subparsers(dest='comando', required=True)
+
+    for comando in DIAGNOSTICOS + ('all',):
+        sub = subparsers.add_parser(comando, help='todos los diagnósticos en una sola lectura' if comando == 'all'
+                                    else f'diagnóstico de {comando}')
+        _argumentos_comunes(sub)
+        sub.add_argument('--mostrar', action='store_true', help='mostrar las gráficas en vez de guardarlas')
+
+    sub = subparsers.add_parser('pipeline', help='cadena de vorticidad que solo recalcula las etapas con cambios')
+    _argumentos_comunes(sub)
+    _argumentos_pipeline(sub)
+
+    sub = subparsers.add_parser('trayectorias', help='advección de partículas con RK4 por el flujo x-z')
+    sub.add_argument('rutas', nargs='+', help='archivos netCDF de WRF')
+    sub.add_argument('--tiempos', help="salidas contiguas a recorrer, p. ej. '0:43' o "
+                                       "'2000-01-01T06/2000-01-01T12' (por defecto todas)")
+    sub.add_argument('--salida', default='resultados', help='directorio de resultados')
+    sub.add_argument('--particulas', type=int, default=10000, help='número de partículas')
+    sub.add_argument('--region', help="región inicial 'x0:x1,z0:z1' en metros (por defecto todo el dominio)")
+    sub.add_argument('--paso', type=float, default=10.0, help='paso de integración en segundos')
+    sub.add_argument('--registrar-cada', type=int, help='pasos entre posiciones guardadas (por defecto una por salida)')
+    sub.add_argument('--intervalo', type=float, help='segundos entre salidas si Times no está en el archivo')
+    sub.add_argument('--semilla', type=int, default=0)
+    _argumento_precision(sub)
+    sub.add_argument('--instrumentar', metavar='RUTA', help='guardar tiempos y memoria por etapa en un JSON')
+    sub.add_argument('--traza', metavar='RUTA', help='guardar una traza para chrome://tracing')
+
+    sub = subparsers.add_parser('seguir', help='vorticidad incremental de una corrida que sigue escribiendo')
+    sub.add_argument('rutas', nargs='+', help='archivos netCDF de WRF')
+    sub.add_argument('--salida', default='resultados', help='directorio de resultados')
+    sub.add_argument('--intervalo', type=float, default=60.0, help='segundos entre revisiones del archivo')
+    sub.add_argument('--una-vez', action='store_true', help='procesar los tiempos nuevos y terminar')
+    sub.add_argument('--reiniciar', action='store_true', help='descartar el estado guardado y empezar de cero')
+    sub.add_argument('--sin-graficas', action='store_true', help='no graficar los tiempos nuevos')
+    sub.add_argument('--bloque', type=int, default=1, help='tiempos leídos por bloque')
+    sub.add_argument('--anticipar', type=int, default=1, help='bloques leídos por adelantado en segundo plano')
+    sub.add_argument('--umbral', type=float, help='umbral fijo de vorticidad para zonas de turbulencia')
+    sub.add_argument('--umbral-percentil', type=float, default=75,
+                     help='percentil (del histograma acumulado) usado como umbral si no se da --umbral')
+    _argumento_precision(sub)
+    sub.add_argument('--instrumentar', metavar='RUTA', help='guardar tiempos y memoria por etapa en un JSON')
+    sub.add_argument('--traza', metavar='RUTA', help='guardar una traza para chrome://tracing')
+
+    sub = subparsers.add_parser('servir', help='servidor HTTP local de cortes x-z (PNG, JSON o binario)')
+    sub.add_argument('rutas', nargs=1, help='archivo netCDF de WRF')
+    sub.add_argument('--puerto', type=int, default=8000)
+    sub.add_argument('--cache', type=float, default=256, help='memoria de la caché de cortes e imágenes en MiB')
+    _argumento_precision(sub)
+    sub.add_argument('--instrumentar', metavar='RUTA', help='guardar tiempos y memoria por etapa en un JSON')
+    sub.add_argument('--traza', metavar='RUTA', help='guardar una traza para chrome://tracing')
+
+    sub = subparsers.add_parser('lote', help='procesar muchos archivos en paralelo con un presupuesto de memoria')
+    _argumentos_comunes(sub)
+    _argumentos_pipeline(sub)
+    sub.add_argument('--diagnosticos', choices=DIAGNOSTICOS + ('all', 'pipeline'), default='all',
+                     help='diagnóstico a ejecutar sobre cada archivo')
+    sub.add_argument('--memoria', type=float, default=4.0, help='presupuesto de memoria total en GiB')
+    sub.add_argument('--trabajadores', type=int, help='número máximo de procesos (por defecto los CPU)')
+    return parser
+
+
+def _argumentos_pipeline(sub):
+    sub.add_argument('--percentil-inferior', type=float, default=1, help='percentil inferior del recorte')
+    sub.add_argument('--percentil-superior', type=float, default=99, help='percentil superior del recorte')
+    sub.add_argument('--forzar', action='store_true', help='volver a ejecutar todas las etapas')
+
+
+def _validar_pipeline(args):
+    if args.niveles is not None or args.alturas is not None:
+        raise ValueError("la cadena pipeline procesa columnas completas; --niveles y --alturas solo valen "
+                         "para los diagnósticos")
+
+
+def ejecutar_pipeline(ruta_archivo, args):
+    _validar_pipeline(args)
+    parametros = {
+        'tiempos': args.tiempos,
+        'x': args.x,
+        'precision': args.precision,
+        'graficar': args.graficar,
+        'bloque': args.bloque,
+        'anticipar': args.anticipar,
+        'memoria_objetivo': None if args.memoria_objetivo is None else int(args.memoria_objetivo * 2**30),
+        'umbral': args.umbral,
+        'umbral_percentil': args.umbral_percentil,
+        'modo_umbral': args.modo_umbral,
+        'ventana_umbral': args.ventana_umbral,
+        'percentil_inferior': args.percentil_inferior,
+        'percentil_superior': args.percentil_superior,
+    }
+    directorio = Path(args.salida) / Path(ruta_archivo).stem
+    ejecutadas = pipeline.ejecutar_vorticidad(ruta_archivo, directorio, parametros, forzar=args.forzar)
+    print(f"{ruta_archivo}: {len(ejecutadas)} etapas ejecutadas ({', '.join(ejecutadas) or 'ninguna'})")
+
+
+def ejecutar_trayectorias(ruta_archivo, args):
+    region = None
+    if args.region:
+        region = tuple(tuple(float(v) for v in parte.split(':')) for parte in args.region.split(','))
+    ruta = trayectorias.advectar(ruta_archivo, Path(args.salida) / Path(ruta_archivo).stem, args.tiempos,
+                                 args.particulas, region, args.paso, args.registrar_cada, args.intervalo, args.semilla)
+    print(f"{ruta_archivo}: trayectorias de {args.particulas} partículas en {ruta}")
+
+
+def ejecutar_seguimiento(rutas, args):
+    # varias corridas se revisan por turnos en la misma vuelta
+    seguidas = [seguimiento.Seguimiento(ruta_archivo, Path(args.salida) / Path(ruta_archivo).stem, args.umbral,
+                                        args.umbral_percentil, bloque=args.bloque, anticipar=args.anticipar,
+                                        graficar=not args.sin_graficas, reiniciar=args.reiniciar)
+                for ruta_archivo in rutas]
+    seguimiento.seguir(seguidas, args.intervalo, args.una_vez)
+
+
+def main(argv=None):
+    args = crear_parser().parse_args(argv)
+
+    if not getattr(args, 'mostrar', False):
+        plt.switch_backend('Agg')
+    if args.instrumentar or args.traza:
+        instrumentacion.activar(args.instrumentar, args.traza)
+    lectura.establecer_precision(args.precision)
+
+    try:
+        if args.comando == 'lote':
+            import lote
+            if args.diagnosticos == 'pipeline':
+                nombres = ('pipeline',)
+            else:
+                nombres = DIAGNOSTICOS_UNA_LECTURA if args.diagnosticos == 'all' else (args.diagnosticos,)
+            if nombres == ('pipeline',):
+                _validar_pipeline(args)
+            errores = lote.ejecutar_lote(args.rutas, nombres, args, int(args.memoria * 2**30), args.trabajadores)
+            if errores:
+                raise RuntimeError(f"{len(errores)} archivos del lote terminaron con error")
+            return
+
+        if args.comando == 'seguir':
+            ejecutar_seguimiento(args.rutas, args)
+            return
+        if args.comando == 'servir':
+            servidor.servir(args.rutas[0], args.puerto, int(args.cache * 2**20))
+            return
+
+        # con --tiempos por fechas solo se procesan los archivos que tienen alguna, cada uno con sus índices
+        for ruta_archivo, tiempos in lectura.repartir_tiempos(args.rutas, args.tiempos):
+            args_archivo = copy(args)
+            args_archivo.tiempos = tiempos
+            if tiempos != args.tiempos:
+                print(f"{ruta_archivo}: tiempos {tiempos}")
+            if args.comando == 'pipeline':
+                ejecutar_pipeline(ruta_archivo, args_archivo)
+            elif args.comando == 'trayectorias':
+                ejecutar_trayectorias(ruta_archivo, args_archivo)
+            else:
+                nombres = DIAGNOSTICOS_UNA_LECTURA if args.comando == 'all' else (args.comando,)
+                procesar_archivo(ruta_archivo, nombres, args_archivo)
+    except Exception as e:
+        print(f"Error en la ejecución principal: {str(e)}")
+        raise
+    finally:
+        instrumentacion.escribir()
+
+
+if __name__ == "__main__":
+    main()
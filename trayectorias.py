@@ -0,0 +1,155 @@
+import json
+import math
+from pathlib import Path
+
+import numpy as np
+
+import diagnosticos
+import instrumentacion
+import lectura
+
+
+class TablaNiveles:
+    # búsqueda en O(1) del nivel bajo cada altura en niveles no uniformes: una tabla precalculada sobre
+    # intervalos uniformes más finos que el nivel más delgado, así cada intervalo cruza a lo más un nivel
+
+    def __init__(self, z, resolucion=2):
+        self.z = np.asarray(z, dtype=np.float64)
+        self.paso = np.diff(self.z).min() / resolucion
+        inicios = self.z[0] + np.arange(math.ceil((self.z[-1] - self.z[0]) / self.paso) + 1) * self.paso
+        self.indice = np.clip(np.searchsorted(self.z, inicios, side='right') - 1, 0, len(self.z) - 2)
+
+    def buscar(self, z):
+        # índice k con z[k] <= z < z[k+1] (acotado a la malla) y peso lineal dentro de la celda
+        casilla = np.clip(((z - self.z[0]) / self.paso).astype(np.int64), 0, len(self.indice) - 1)
+        k = self.indice[casilla]
+        k = k + ((z >= self.z[k + 1]) & (k < len(self.z) - 2))
+        peso = np.clip((z - self.z[k]) / (self.z[k + 1] - self.z[k]), 0.0, 1.0)
+        return k, peso
+
+
+class CampoInstantaneo:
+    # U y W de un tiempo en el plano x-z (promediados en south_north) con sus tablas de niveles;
+    # U vive en x = (i - ½)dx y niveles de masa, W en x = i·dx y niveles escalonados. El dominio es periódico
+    # en x, así que se agrega una columna repetida al final para cerrar la última celda
+
+    def __init__(self, bloque, dx):
+        self.dx = dx
+        u = np.asarray(bloque['U'][0]).mean(axis=1)
+        w = np.asarray(bloque['W'][0]).mean(axis=1)
+        self.n_we = w.shape[1]
+        self.u = np.concatenate([u, u[:, 1:2]], axis=1)
+        self.w = np.concatenate([w, w[:, :1]], axis=1)
+        z_stag = np.asarray(diagnosticos.calcular_altura(bloque['PH'][0], bloque['PHB'][0])).mean(axis=(1, 2))
+        self.niveles_w = TablaNiveles(z_stag)
+        self.niveles_u = TablaNiveles(0.5 * (z_stag[:-1] + z_stag[1:]))
+
+    @staticmethod
+    def _bilineal(campo, i, peso_x, k, peso_z):
+        abajo = campo[k, i] * (1 - peso_x) + campo[k, i + 1] * peso_x
+        arriba = campo[k + 1, i] * (1 - peso_x) + campo[k + 1, i + 1] * peso_x
+        return abajo * (1 - peso_z) + arriba * peso_z
+
+    def velocidad(self, x, z):
+        # x ya reducida al dominio [0, n_we·dx); índices de celda en x directos por ser uniforme
+        fx = x / self.dx
+        iu = np.floor(fx + 0.5).astype(np.int64)
+        k, peso_z = self.niveles_u.buscar(z)
+        u = self._bilineal(self.u, iu, fx + 0.5 - iu, k, peso_z)
+        iw = np.floor(fx).astype(np.int64)
+        k, peso_z = self.niveles_w.buscar(z)
+        w = self._bilineal(self.w, iw, fx - iw, k, peso_z)
+        return u, w
+
+
+def intervalo_salida(datos, tiempos):
+    # segundos entre salidas consecutivas según Times, o None si no se puede saber
+    fechas = lectura.indice_tiempos(datos)
+    if fechas is None or len(tiempos) < 2:
+        return None
+    return float((fechas[tiempos[1]] - fechas[tiempos[0]]) / np.timedelta64(1, 's')) / (tiempos[1] - tiempos[0])
+
+
+def sembrar(n_particulas, x_limites, z_limites, semilla=0):
+    rng = np.random.default_rng(semilla)
+    return rng.uniform(*x_limites, n_particulas), rng.uniform(*z_limites, n_particulas)
+
+
+@instrumentacion.medido('advectar')
+def paso_rk4(x, z, paso, velocidad, largo, z_min, z_max):
+    # un paso RK4 para todas las partículas; velocidad(fraccion, x, z) interpola en el tiempo dentro del paso
+    def evaluar(fraccion, x_eval, z_eval):
+        return velocidad(fraccion, np.mod(x_eval, largo), np.clip(z_eval, z_min, z_max))
+
+    u1, w1 = evaluar(0.0, x, z)
+    u2, w2 = evaluar(0.5, x + 0.5 * paso * u1, z + 0.5 * paso * w1)
+    u3, w3 = evaluar(0.5, x + 0.5 * paso * u2, z + 0.5 * paso * w2)
+    u4, w4 = evaluar(1.0, x + paso * u3, z + paso * w3)
+    x = x + paso / 6 * (u1 + 2 * u2 + 2 * u3 + u4)
+    z = z + paso / 6 * (w1 + 2 * w2 + 2 * w3 + w4)
+    return np.mod(x, largo), np.clip(z, z_min, z_max)
+
+
+def advectar(ruta_archivo, directorio, tiempos=None, n_particulas=10000, region=None, paso=10.0,
+             registrar_cada=None, intervalo=None, semilla=0):
+    # avanza las partículas entre salidas consecutivas leyendo solo dos tiempos a la vez; las posiciones se
+    # guardan como float32 (registro, partícula, [x, z]) en trayectorias.npy, escrito por registro
+    datos = lectura.obtener_datos(ruta_archivo)
+    try:
+        tiempos = lectura.seleccionar_tiempos(datos, tiempos)
+        if len(tiempos) < 2 or tiempos != list(range(tiempos[0], tiempos[-1] + 1)):
+            raise ValueError("las trayectorias necesitan al menos dos tiempos contiguos")
+        intervalo = intervalo or intervalo_salida(datos, tiempos)
+        if intervalo is None:
+            raise ValueError("no se pudo leer el intervalo entre salidas de Times; indicarlo con --intervalo")
+        pasos_por_salida = max(1, round(intervalo / paso))
+        paso = intervalo / pasos_por_salida
+        registrar_cada = registrar_cada or pasos_por_salida
+
+        variables = ('U', 'W', 'PH', 'PHB')
+        dx = float(datos.DX)
+        actual = CampoInstantaneo(lectura.leer_bloque(datos, variables, slice(tiempos[0], tiempos[0] + 1)), dx)
+        largo = actual.n_we * dx
+        z_min, z_max = actual.niveles_w.z[0], actual.niveles_w.z[-1]
+        if region is None:
+            region = ((0.0, largo), (z_min, z_max))
+        x, z = sembrar(n_particulas, *region, semilla=semilla)
+
+        n_pasos = (len(tiempos) - 1) * pasos_por_salida
+        n_registros = n_pasos // registrar_cada + 1
+        directorio = Path(directorio)
+        directorio.mkdir(parents=True, exist_ok=True)
+        posiciones = np.lib.format.open_memmap(directorio / 'trayectorias.npy', mode='w+', dtype=np.float32,
+                                               shape=(n_registros, n_particulas, 2))
+        segundos = np.empty(n_registros)
+        posiciones[0, :, 0], posiciones[0, :, 1] = x, z
+        segundos[0] = 0.0
+        registro = 1
+
+        for n, tiempo in enumerate(tiempos[1:]):
+            siguiente = CampoInstantaneo(lectura.leer_bloque(datos, variables, slice(tiempo, tiempo + 1)), dx)
+            for j in range(pasos_por_salida):
+                def velocidad(fraccion, x_eval, z_eval, inicio=j):
+                    # interpolación lineal en el tiempo entre las dos salidas
+                    a = (inicio + fraccion) / pasos_por_salida
+                    u0, w0 = actual.velocidad(x_eval, z_eval)
+                    u1, w1 = siguiente.velocidad(x_eval, z_eval)
+                    return (1 - a) * u0 + a * u1, (1 - a) * w0 + a * w1
+
+                x, z = paso_rk4(x, z, paso, velocidad, largo, z_min, z_max)
+                numero_paso = n * pasos_por_salida + j + 1
+                if numero_paso % registrar_cada == 0:
+                    posiciones[registro, :, 0], posiciones[registro, :, 1] = x, z
+                    segundos[registro] = numero_paso * paso
+                    registro += 1
+            actual = siguiente
+        posiciones.flush()
+    finally:
+        datos.close()
+
+    np.save(directorio / 'trayectorias_tiempos.npy', segundos)
+    with open(directorio / 'trayectorias.json', 'w') as f:
+        json.dump({'archivo': str(ruta_archivo), 'tiempos': tiempos, 'particulas': n_particulas,
+                   'paso_s': paso, 'registrar_cada': registrar_cada, 'region': region, 'semilla': semilla,
+                   'forma': list(posiciones.shape), 'columnas': ['x_m', 'z_m']}, f, indent=2)
+    return directorio / 'trayectorias.npy'
@@ -0,0 +1,111 @@
+import numpy as np
+
+import instrumentacion
+
+
+def interpretar_umbrales(texto):
+    # 'inicio:fin:n' (n valores equiespaciados, extremos incluidos) o una lista separada por comas
+    if ':' in texto:
+        inicio, fin, n = texto.split(':')
+        return np.linspace(float(inicio), float(fin), int(n))
+    return np.array([float(valor) for valor in texto.split(',') if valor.strip()])
+
+
+@instrumentacion.medido('barrido_umbrales')
+def conteos_sobre_umbrales(campo, umbrales):
+    # cuántos puntos de cada (tiempo, nivel) superan cada umbral, en una sola pasada: cada valor se ubica
+    # entre los umbrales ordenados con una búsqueda binaria y se cuenta en un histograma por fila; el
+    # acumulado desde arriba da los conteos "> umbral" de todos los umbrales a la vez. Los NaN no superan
+    # ningún umbral, igual que en campo > umbral. Devuelve (tiempo, nivel, umbral) en el orden dado
+    campo = np.asarray(campo)
+    umbrales = np.asarray(umbrales, dtype=np.float64)
+    orden = np.argsort(umbrales)
+    n_umbrales = len(umbrales)
+    n_filas = campo.shape[0] * campo.shape[1]
+
+    valores = campo.reshape(n_filas, -1)
+    # cantidad de umbrales estrictamente menores que cada valor = umbrales que el valor supera
+    superados = np.searchsorted(umbrales[orden], valores, side='left')
+    superados[np.isnan(valores)] = 0
+    filas = np.arange(n_filas)[:, None] * (n_umbrales + 1)
+    histograma = np.bincount((filas + superados).ravel(), minlength=n_filas * (n_umbrales + 1))
+    histograma = histograma.reshape(n_filas, n_umbrales + 1)
+
+    # puntos que superan el umbral j (ordenado) = los que superan al menos j + 1 umbrales
+    sobre = np.cumsum(histograma[:, :0:-1], axis=1)[:, ::-1]
+    conteos = np.empty_like(sobre)
+    conteos[:, orden] = sobre
+    return conteos.reshape(campo.shape[0], campo.shape[1], n_umbrales)
+
+
+def barrido_umbrales(campo, umbrales, tam_bloque=1):
+    # fracción de puntos sobre cada umbral por tiempo y nivel, (umbral, tiempo, nivel); equivale a
+    # (campo > u).mean(axis=(2, 3)) para cada u sin armar ninguna máscara. Se recorre por bloques de
+    # tiempos para que los índices intermedios no ocupen más que un bloque
+    por_fila = int(np.prod(campo.shape[2:]))
+    fracciones = np.empty((len(umbrales),) + campo.shape[:2])
+    for inicio in range(0, campo.shape[0], tam_bloque):
+        conteos = conteos_sobre_umbrales(campo[inicio:inicio + tam_bloque], umbrales)
+        fracciones[:, inicio:inicio + tam_bloque] = np.moveaxis(conteos, 2, 0) / por_fila
+    return fracciones
+
+
+MODOS_UMBRAL = ('global', 'nivel', 'tiempo', 'ventana')
+
+
+def _percentil_por_tramos(campo, percentil, ancho):
+    # percentil de cada tramo de ancho columnas en west_east (con todo south_north), por tiempo y nivel, en
+    # una sola partición de los datos; el último tramo puede ser más corto. Devuelve los centros de los
+    # tramos y los percentiles (tiempo, nivel, tramo)
+    n_we = campo.shape[-1]
+    completos = n_we // ancho
+    resto = n_we - completos * ancho
+    partes = []
+    centros = list(np.arange(completos) * ancho + (ancho - 1) / 2)
+    if completos:
+        tramos = campo[..., :completos * ancho].reshape(campo.shape[:3] + (completos, ancho))
+        partes.append(np.percentile(tramos, percentil, axis=(2, 4)))
+    if resto:
+        partes.append(np.percentile(campo[..., completos * ancho:], percentil, axis=(2, 3))[..., None])
+        centros.append(completos * ancho + (resto - 1) / 2)
+    return np.array(centros), np.concatenate(partes, axis=-1)
+
+
+@instrumentacion.medido('umbral_local')
+def umbral_local(campo, modo='global', percentil=75, ventana=101):
+    # umbral por percentil calculado sobre subconjuntos del campo (tiempo, nivel, sn, we), con forma
+    # difundible contra el campo:
+    #   global   un solo percentil de todo el campo
+    #   nivel    uno por nivel, sobre todos los tiempos y puntos horizontales: (1, nivel, 1, 1)
+    #   tiempo   uno por tiempo, sobre todos los niveles: (tiempo, 1, 1, 1)
+    #   ventana  uno por tiempo, nivel y columna, móvil a lo largo de west_east: (tiempo, nivel, 1, we)
+    # La ventana se resuelve con percentiles por tramos de ancho ventana interpolados linealmente entre los
+    # centros de los tramos, así cada punto entra en una sola partición y el costo es el de un percentil global
+    campo = np.asarray(campo)
+    if modo == 'global':
+        return np.percentile(campo, percentil)
+    if modo == 'nivel':
+        return np.percentile(campo, percentil, axis=(0, 2, 3), keepdims=True)
+    if modo == 'tiempo':
+        return np.percentile(campo, percentil, axis=(1, 2, 3), keepdims=True)
+    if modo == 'ventana':
+        ancho = max(1, min(int(ventana), campo.shape[-1]))
+        centros, por_tramo = _percentil_por_tramos(campo, percentil, ancho)
+        if len(centros) == 1:
+            return np.repeat(por_tramo, campo.shape[-1], axis=-1)[:, :, None, :]
+        # interpolación lineal entre centros, constante antes del primero y después del último
+        x = np.arange(campo.shape[-1])
+        derecha = np.clip(np.searchsorted(centros, x, side='right'), 1, len(centros) - 1)
+        peso = np.clip((x - centros[derecha - 1]) / (centros[derecha] - centros[derecha - 1]), 0, 1)
+        umbral = por_tramo[..., derecha - 1] * (1 - peso) + por_tramo[..., derecha] * peso
+        # los pesos son float64; el umbral vuelve al tipo del campo para que la comparación no lo suba
+        return umbral.astype(campo.dtype, copy=False)[:, :, None, :]
+    raise ValueError(f"modo de umbral desconocido: {modo} (use {', '.join(MODOS_UMBRAL)})")
+
+
+def describir_umbral(umbral):
+    # texto para los mensajes: el valor si es uno solo, el rango si es local
+    umbral = np.asarray(umbral)
+    if umbral.ndim == 0:
+        return f"{float(umbral)}"
+    return f"local de {float(umbral.min()):.4g} a {float(umbral.max()):.4g} ({umbral.size} valores)"
@@ -0,0 +1,68 @@
+from collections import namedtuple
+
+import numpy as np
+
+import diagnosticos
+import geometria
+import instrumentacion
+
+# tensor de gradiente de velocidad en el plano x-z, en la malla de w
+TensorVelocidad = namedtuple('TensorVelocidad', 'du_dx du_dz dw_dx dw_dz')
+
+
+@instrumentacion.medido('tensor_velocidad')
+def tensor_velocidad(u_interpolada, w, dx, altura, du_dz=None, espesores=None, du_dx=None, dw_dx=None):
+    # las cuatro derivadas una sola vez; du_dz se reutiliza si ya lo calculó la vorticidad y los Δz de la
+    # geometría del bloque se comparten entre las dos derivadas verticales. Las derivadas en x se pueden
+    # pasar ya calculadas sobre el halo de una ventana en x (CamposBloque.du_dx y dw_dx)
+    w = np.asarray(w)
+    altura = np.asarray(altura)
+    if espesores is None:
+        espesores = geometria.espesores_protegidos(altura)
+    if du_dz is None:
+        du_dz = diagnosticos.gradiente_z(u_interpolada, altura, espesores)
+    if du_dx is None:
+        du_dx = diagnosticos.gradiente_x(u_interpolada, dx)
+    if dw_dx is None:
+        dw_dx = diagnosticos.gradiente_x(w, dx)
+    return TensorVelocidad(du_dx, du_dz, dw_dx, diagnosticos.gradiente_z(w, altura, espesores))
+
+
+def criterio_q(tensor):
+    # Q = ½(‖Ω‖² - ‖S‖²); positivo donde la rotación domina sobre la deformación
+    a, b, c, d = tensor
+    return 0.25 * (b - c) ** 2 - 0.5 * (a ** 2 + d ** 2 + 0.5 * (b + c) ** 2)
+
+
+def criterio_lambda2(tensor):
+    # segundo autovalor de S² + Ω² con el flujo 2D embebido en 3D (el tercer autovalor es 0);
+    # negativo dentro de un vórtice y cero en una capa de cortante pura
+    a, b, c, d = tensor
+    s12 = 0.5 * (b + c)
+    w12 = 0.5 * (b - c)
+    m11 = a ** 2 + s12 ** 2 - w12 ** 2
+    m22 = d ** 2 + s12 ** 2 - w12 ** 2
+    m12 = s12 * (a + d)
+    centro = 0.5 * (m11 + m22)
+    radio = np.sqrt((0.5 * (m11 - m22)) ** 2 + m12 ** 2)
+    return np.maximum(centro - radio, np.minimum(centro + radio, 0))
+
+
+def intensidad_remolino(tensor):
+    # swirling strength: parte imaginaria de los autovalores complejos del tensor, cero si son reales
+    a, b, c, d = tensor
+    discriminante = (0.5 * (a - d)) ** 2 + b * c
+    return np.sqrt(np.maximum(-discriminante, 0))
+
+
+# cada criterio expresado como intensidad que crece dentro de los vórtices, para usar el mismo umbral
+CRITERIOS = {
+    'q': criterio_q,
+    'lambda2': lambda tensor: -criterio_lambda2(tensor),
+    'remolino': intensidad_remolino,
+}
+
+
+@instrumentacion.medido('criterios_vortices')
+def intensidades(tensor, criterios=tuple(CRITERIOS)):
+    return {nombre: CRITERIOS[nombre](tensor) for nombre in criterios}